@@ -0,0 +1,573 @@
+"""
+Нагрузочные замеры скриптов на локальных заглушках API Valhalla, 2ГИС и НСПД.
+
+Заглушки запускаются в отдельном процессе, чтобы их работа не попадала в замеры процессорного времени клиента,
+и отвечают с заданной задержкой и долей ошибок. Ответы строятся по координатам запроса или берутся
+из записанных файлов (--responses). Результаты выводятся в JSON: число запросов, запросов в секунду,
+p50/p95 задержки запроса, процессорное время клиента и пиковая память Python.
+
+Пример запуска:
+    python benchmark.py --sizes 10 50 100 --latency 0.05 --error-rate 0.01 --output benchmark.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import functools
+import io
+import json
+import math
+import os
+import random
+import socket
+import tempfile
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Process
+
+import geopandas as gpd
+import httpx
+import numpy as np
+import pandas as pd
+from shapely import linestrings
+from shapely.geometry import LineString, box
+
+import isochrone_by_valhalla
+import nspd_parser
+import route_by_2gis
+import route_by_network
+import route_by_valhalla
+from metrics import metrics
+from snap_points_to_lines import snap_points_to_lines
+from valhalla_pool import ValhallaPool
+
+# Территория, в пределах которой генерируются точки (Москва)
+BBOX = (37.35, 55.6, 37.85, 55.9)
+DEFAULT_SIZES = [10, 50, 100]
+SCENARIOS = [
+    "valhalla_routes",
+    "valhalla_isochrones",
+    "2gis_routes",
+    "2gis_matrix",
+    "nspd_harvest",
+    "snap_points",
+    "network_matrix",
+]
+# Во сколько раз точек для привязки больше, чем size (привязка не делает запросов и работает намного быстрее)
+SNAP_SCALE = 1000
+# Шаг сетки линий для привязки точек, градусы
+SNAP_GRID_STEP = 0.005
+# Число объектов НСПД в ответе на запрос одного тайла
+NSPD_FEATURES = 20
+ISOCHRONE_INTERVALS = [300, 600]
+# Ограничения Distance Matrix API на число источников и назначений в одном запросе, проверяемые заглушкой
+MATRIX_LIMIT_SOURCES = 25
+MATRIX_LIMIT_TARGETS = 25
+# Число узлов сети по каждой стороне сетки локального маршрутизатора: при 250 x 250 узлах ключи рёбер
+# (номер узла * число узлов) выходят за пределы int32
+NETWORK_GRID_NODES = 250
+# Число источников, маршруты от которых сверяются с суммой рёбер, пройденных по предшественникам
+NETWORK_CHECK_SOURCES = 5
+
+# --------------------
+
+
+class MockError(Exception):
+    """Ответ заглушки с ошибкой запроса."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Заглушка API: задержка, случайные ошибки и ответ по пути запроса."""
+
+    latency = 0.05
+    error_rate = 0.0
+    responses_dir = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        # Задержка равномерно распределена от половины до полутора заданных значений
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        if random.random() < self.error_rate:
+            self.send_json({"error": "mock error"}, status=500)
+            return
+
+        path = self.path.split("?")[0]
+        handlers = {
+            "/route": ("valhalla_route", valhalla_route),
+            "/isochrone": ("valhalla_isochrone", valhalla_isochrone),
+            "/routing/7.0.0/global": ("2gis_route", route_2gis),
+            "/get_dist_matrix": ("2gis_matrix", matrix_2gis),
+            "/api/geoportal/v1/intersects": ("nspd_intersects", nspd_intersects),
+        }
+        if path not in handlers:
+            self.send_json({"error": f"unknown path {path}"}, status=404)
+            return
+        name, handler = handlers[path]
+        recorded = recorded_response(self.responses_dir, name)
+        try:
+            self.send_json(recorded if recorded is not None else handler(body))
+        except MockError as e:
+            self.send_json({"error": str(e)}, status=e.status)
+
+    def send_json(self, data, status: int = 200):
+        raw = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+
+@functools.cache
+def recorded_response(responses_dir: str | None, name: str):
+    """Записанный ответ <responses_dir>/<name>.json или None, если его нет."""
+    if responses_dir is None:
+        return None
+    path = os.path.join(responses_dir, f"{name}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def haversine_km(lon1, lat1, lon2, lat2) -> float:
+    dlon, dlat = math.radians(lon2 - lon1), math.radians(lat2 - lat1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return 6371 * 2 * math.asin(math.sqrt(a))
+
+
+def encode_polyline6(coords: list) -> str:
+    """Кодирование [[lon, lat], ...] в polyline с точностью 6 знаков, как в ответах Valhalla."""
+    result = []
+    prev_lat = prev_lon = 0
+    for lon, lat in coords:
+        lat, lon = round(lat * 1e6), round(lon * 1e6)
+        for value in (lat - prev_lat, lon - prev_lon):
+            value = ~(value << 1) if value < 0 else value << 1
+            while value >= 0x20:
+                result.append(chr((0x20 | (value & 0x1F)) + 63))
+                value >>= 5
+            result.append(chr(value + 63))
+        prev_lat, prev_lon = lat, lon
+    return "".join(result)
+
+
+def straight_line(start, end, n: int = 10) -> list:
+    return [[start[0] + (end[0] - start[0]) * i / n, start[1] + (end[1] - start[1]) * i / n] for i in range(n + 1)]
+
+
+def valhalla_route(body: dict) -> dict:
+    start, end = [(loc["lon"], loc["lat"]) for loc in body["locations"][:2]]
+    length = haversine_km(*start, *end)
+    summary = {"length": length, "time": length / 40 * 3600}
+    return {
+        "trip": {
+            "legs": [{"shape": encode_polyline6(straight_line(start, end)), "summary": summary}],
+            "summary": summary,
+            "status": 0,
+            "units": "kilometers",
+        }
+    }
+
+
+def valhalla_isochrone(body: dict) -> dict:
+    center = body["locations"][0]
+    features = []
+    for contour in body.get("contours", []):
+        # Радиус круга пропорционален интервалу (время в минутах или расстояние в км)
+        radius = 0.002 * next(iter(v for k, v in contour.items() if k in ("time", "distance")), 1)
+        ring = [
+            [center["lon"] + radius * math.cos(a), center["lat"] + radius * math.sin(a)]
+            for a in np.linspace(0, 2 * math.pi, 33)
+        ]
+        geometry = {"type": "Polygon", "coordinates": [ring]}
+        features.append({"type": "Feature", "geometry": geometry, "properties": contour})
+    # Valhalla возвращает контуры от большего к меньшему
+    return {"type": "FeatureCollection", "features": features[::-1]}
+
+
+def route_2gis(body: dict) -> dict:
+    start, end = [(point["lon"], point["lat"]) for point in body["points"][:2]]
+    length = haversine_km(*start, *end) * 1000
+    wkt = LineString(straight_line(start, end)).wkt
+    return {
+        "status": "OK",
+        "result": [
+            {
+                "total_distance": int(length),
+                "total_duration": int(length / 40 * 3.6),
+                "maneuvers": [{"outcoming_path": {"geometry": [{"selection": wkt}]}}],
+            }
+        ],
+    }
+
+
+def matrix_2gis(body: dict) -> dict:
+    """
+    Матрица 2ГИС: расстояние по прямой и время при 40 км/ч для каждой пары источник - назначение.
+    Запрос, превышающий ограничения на размер матрицы, отклоняется с кодом 400, как в API.
+    """
+    if len(body["sources"]) > MATRIX_LIMIT_SOURCES or len(body["targets"]) > MATRIX_LIMIT_TARGETS:
+        raise MockError(400, f"Слишком большая матрица: {len(body['sources'])} x {len(body['targets'])}")
+    return {"generation_time": 0, "routes": matrix_routes(body["points"], body["sources"], body["targets"])}
+
+
+def matrix_routes(points: list[dict], sources: list[int], targets: list[int]) -> list[dict]:
+    routes = []
+    for source in sources:
+        for target in targets:
+            start, end = points[source], points[target]
+            length = haversine_km(start["lon"], start["lat"], end["lon"], end["lat"]) * 1000
+            routes.append(
+                {
+                    "source_id": source,
+                    "target_id": target,
+                    "distance": int(length),
+                    "duration": int(length / 40 * 3.6),
+                    "status": "OK",
+                }
+            )
+    return routes
+
+
+def nspd_intersects(body: dict) -> dict:
+    category = body["categories"][0]["id"]
+    ring = body["geom"]["features"][0]["geometry"]["coordinates"][0]
+    xs, ys = [c[0] for c in ring], [c[1] for c in ring]
+    minx, miny, maxx, maxy = min(xs), min(ys), max(xs), max(ys)
+    features = []
+    side = max(maxx - minx, maxy - miny) / (NSPD_FEATURES * 2)
+    for i in range(NSPD_FEATURES):
+        x = minx + (maxx - minx) * (i + 0.5) / NSPD_FEATURES
+        y = miny + (maxy - miny) * (i + 0.5) / NSPD_FEATURES
+        # Номер зависит от координат, поэтому объект на стыке тайлов получает один и тот же номер
+        number = f"77:01:{round(x * 1e4):07d}:{round(y * 1e4)}"
+        features.append(
+            {
+                "type": "Feature",
+                "id": i,
+                "geometry": {"type": "Polygon", "coordinates": [list(box(x, y, x + side, y + side).exterior.coords)]},
+                "properties": {
+                    "category": category,
+                    "categoryName": "mock",
+                    "options": {"cad_num": number, "cad_number": number},
+                },
+            }
+        )
+    return {"type": "FeatureCollection", "features": features}
+
+
+def serve(port: int, latency: float, error_rate: float, responses_dir: str | None):
+    MockHandler.latency = latency
+    MockHandler.error_rate = error_rate
+    MockHandler.responses_dir = responses_dir
+    ThreadingHTTPServer(("127.0.0.1", port), MockHandler).serve_forever()
+
+
+def start_server(port: int, latency: float, error_rate: float, responses_dir: str | None) -> Process:
+    """Запускает заглушку в отдельном процессе и ждёт, пока она начнёт принимать соединения."""
+    process = Process(target=serve, args=(port, latency, error_rate, responses_dir), daemon=True)
+    process.start()
+    for _ in range(100):
+        with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=0.1):
+            return process
+        time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError(f"Заглушка API не запустилась на порту {port}")
+
+
+@contextlib.contextmanager
+def timed(module, name: str, latencies: list):
+    """Временно заменяет функцию модуля обёрткой, записывающей длительность каждого вызова."""
+    original = getattr(module, name)
+    if asyncio.iscoroutinefunction(original):
+
+        async def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return await original(*args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - start_time)
+
+    else:
+
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - start_time)
+
+    setattr(module, name, wrapper)
+    try:
+        yield
+    finally:
+        setattr(module, name, original)
+
+
+def random_points(size: int, seed: int) -> gpd.GeoDataFrame:
+    rng = np.random.default_rng(seed)
+    xs = rng.uniform(BBOX[0], BBOX[2], size)
+    ys = rng.uniform(BBOX[1], BBOX[3], size)
+    return gpd.GeoDataFrame({"point_id": np.arange(size)}, geometry=gpd.points_from_xy(xs, ys), crs="EPSG:4326")
+
+
+def grid_lines() -> gpd.GeoDataFrame:
+    xs = np.arange(BBOX[0], BBOX[2], SNAP_GRID_STEP)
+    ys = np.arange(BBOX[1], BBOX[3], SNAP_GRID_STEP)
+    lines = [LineString([(x, BBOX[1]), (x, BBOX[3])]) for x in xs] + [
+        LineString([(BBOX[0], y), (BBOX[2], y)]) for y in ys
+    ]
+    return gpd.GeoDataFrame(geometry=lines, crs="EPSG:4326")
+
+
+def grid_network(n: int) -> gpd.GeoDataFrame:
+    """Сеть из n x n узлов: каждое ребро сетки - отдельная линия, поэтому все узлы сетки становятся узлами графа."""
+    xs = np.linspace(BBOX[0], BBOX[2], n)
+    ys = np.linspace(BBOX[1], BBOX[3], n)
+    grid_x, grid_y = np.meshgrid(xs, ys)
+    nodes = np.stack([grid_x, grid_y], axis=-1)
+    horizontal = np.stack([nodes[:, :-1], nodes[:, 1:]], axis=2).reshape(-1, 2, 2)
+    vertical = np.stack([nodes[:-1, :], nodes[1:, :]], axis=2).reshape(-1, 2, 2)
+    return gpd.GeoDataFrame(geometry=linestrings(np.concatenate([horizontal, vertical])), crs="EPSG:4326")
+
+
+def one_to_one(size: int) -> pd.DataFrame:
+    """Пары i -> i: число маршрутов равно size."""
+    return pd.DataFrame({"from": np.arange(size), "to": np.arange(size)})
+
+
+def check_matrix(result: pd.DataFrame, starts: gpd.GeoDataFrame, ends: gpd.GeoDataFrame):
+    """Сверяет матрицу с ответами заглушки: все пары по порядку from x to, расстояние и время каждой пары."""
+    points = [{"lon": geom.x, "lat": geom.y} for geom in [*starts.geometry, *ends.geometry]]
+    # Полная матрица считается без ограничения размера, как если бы её вернул один запрос
+    routes = matrix_routes(points, list(range(len(starts))), list(range(len(starts), len(points))))
+    expected = [
+        (starts["point_id"].iloc[route["source_id"]], ends["point_id"].iloc[route["target_id"] - len(starts)])
+        + (route["distance"], route["duration"])
+        for route in routes
+    ]
+    actual = list(zip(result["from"], result["to"], result["distance_meters"], result["duration_seconds"]))
+    mismatches = sum(row != expected_row for row, expected_row in zip(actual, expected))
+    if len(actual) != len(expected) or mismatches:
+        raise RuntimeError(
+            f"Матрица не совпадает с ответами заглушки: строк {len(actual)} из {len(expected)}, "
+            f"расхождений {mismatches}"
+        )
+
+
+def check_network(router: route_by_network.NetworkRouter, starts: gpd.GeoDataFrame, ends: gpd.GeoDataFrame):
+    """
+    Сверяет длины маршрутов, посчитанные по дереву кратчайших путей (tree_sums и edge_values), с суммой длин рёбер,
+    пройденных от назначения к источнику по предшественникам.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        graph, sources, targets = route_by_network.prepare(router, starts, ends, tolerance=200)
+    edges = graph["edges"]
+    edge_distance = dict(zip(zip(edges["from"], edges["to"]), edges["distance"]))
+    block = sources[:NETWORK_CHECK_SOURCES]
+    distances, _, predecessors = router.solve(graph, block, targets)
+    mismatches = 0
+    for di, source in enumerate(block):
+        for j, target in enumerate(targets):
+            if source < 0 or target < 0 or not np.isfinite(distances[di, j]):
+                continue
+            node, expected = target, 0.0
+            while node != source:
+                previous = predecessors[di, node]
+                expected += edge_distance[(previous, node)]
+                node = previous
+            mismatches += not math.isclose(distances[di, j], expected, rel_tol=1e-9, abs_tol=1e-6)
+    if mismatches:
+        raise RuntimeError(f"Длины маршрутов по сети не совпадают с суммой рёбер: расхождений {mismatches}")
+
+
+def measure(scenario: str, size: int, run, latencies: list, items: int | None = None) -> dict:
+    """Выполняет сценарий и собирает показатели. items - число обработанных объектов, если запросов нет."""
+    metrics.reset()
+    tracemalloc.start()
+    cpu_start = time.process_time()
+    start_time = time.perf_counter()
+    # Подробный вывод скриптов не смешивается с результатами
+    with contextlib.redirect_stdout(io.StringIO()):
+        run()
+    wall = time.perf_counter() - start_time
+    cpu = time.process_time() - cpu_start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    count = len(latencies) if items is None else items
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "scenario": scenario,
+        "size": size,
+        "requests": count,
+        "wall_seconds": round(wall, 3),
+        "requests_per_second": round(count / wall, 2) if wall else None,
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 2) if len(latencies_ms) else None,
+        "p95_ms": round(float(np.percentile(latencies_ms, 95)), 2) if len(latencies_ms) else None,
+        "cpu_seconds": round(cpu, 3),
+        "peak_memory_mb": round(peak / 2**20, 2),
+        # Показатели запросов и этапов, собранные самими скриптами
+        "metrics": metrics.to_dict(),
+    }
+
+
+def run_scenario(scenario: str, size: int, base_url: str, concurrency: int) -> dict:
+    latencies: list[float] = []
+    starts = random_points(size, seed=size)
+    ends = random_points(size, seed=size + 1)
+    # Скрипты обращаются к Valhalla через пул серверов, здесь - из одной заглушки без фоновой проверки состояния
+    client = ValhallaPool(
+        [base_url],
+        health_interval=None,
+        timeout=10,
+        retry_timeout=10,
+        retry_over_query_limit=True,
+        skip_api_error=False,
+    )
+
+    if scenario == "valhalla_routes":
+        route_by_valhalla.client = client
+        with timed(route_by_valhalla, "build_route", latencies):
+            return measure(
+                scenario,
+                size,
+                lambda: route_by_valhalla.build_routes(
+                    starts, "point_id", ends, "point_id", concurrency=concurrency, od=one_to_one(size)
+                ),
+                latencies,
+            )
+
+    if scenario == "valhalla_isochrones":
+        isochrone_by_valhalla.client = client
+        with timed(isochrone_by_valhalla, "build_isochrone", latencies):
+            return measure(
+                scenario,
+                size,
+                lambda: isochrone_by_valhalla.build_isochrones(
+                    starts, "point_id", ISOCHRONE_INTERVALS, concurrency=concurrency
+                ),
+                latencies,
+            )
+
+    if scenario == "2gis_routes":
+        route_by_2gis.url = f"{base_url}/routing/7.0.0/global"
+        with timed(route_by_2gis, "post_request", latencies), timed(route_by_2gis, "post_request_async", latencies):
+            return measure(
+                scenario,
+                size,
+                lambda: route_by_2gis.find_routes(
+                    starts, "point_id", ends, "point_id", concurrency=concurrency, od=one_to_one(size)
+                ),
+                latencies,
+            )
+
+    if scenario == "2gis_matrix":
+        route_by_2gis.matrix_url = f"{base_url}/get_dist_matrix"
+        matrix = {}
+
+        def run():
+            matrix["result"] = route_by_2gis.find_matrix(starts, "point_id", ends, "point_id", concurrency=concurrency)
+
+        with timed(route_by_2gis, "post_request", latencies), timed(route_by_2gis, "post_request_async", latencies):
+            report = measure(scenario, size, run, latencies)
+        # Блоки должны укладываться в ограничения заглушки, а ответы - собираться в пары без сдвигов
+        check_matrix(matrix["result"], starts, ends)
+        return report
+
+    if scenario == "nspd_harvest":
+        title, schema = next(iter(nspd_parser.LAYERS.items()))
+        # Ряд из size тайлов начального размера
+        contour = box(37.5, 55.7, 37.5 + nspd_parser.TILE_SIZE * size, 55.7 + nspd_parser.TILE_SIZE)
+
+        class MockNspd(nspd_parser.Nspd):
+            def _build_client(self):
+                return httpx.Client(base_url=base_url, timeout=30)
+
+        original_nspd, original_export = nspd_parser.Nspd, nspd_parser.EXPORT_GPKG
+        nspd_parser.Nspd, nspd_parser.EXPORT_GPKG = MockNspd, False
+        cwd = os.getcwd()
+        try:
+            with tempfile.TemporaryDirectory() as tmp, timed(nspd_parser, "harvest_tile", latencies):
+                # Выгрузка пишет файлы по относительным путям из описания слоя
+                os.chdir(tmp)
+                return measure(
+                    scenario,
+                    size,
+                    lambda: nspd_parser.harvest_layers(contour, {title: schema}, workers=concurrency),
+                    latencies,
+                )
+        finally:
+            os.chdir(cwd)
+            nspd_parser.Nspd, nspd_parser.EXPORT_GPKG = original_nspd, original_export
+
+    if scenario == "snap_points":
+        points = random_points(size * SNAP_SCALE, seed=size).to_crs("EPSG:32637")
+        lines = grid_lines().to_crs("EPSG:32637")
+        return measure(
+            scenario, size, lambda: snap_points_to_lines(points, lines, tolerance=200), latencies, items=len(points)
+        )
+
+    if scenario == "network_matrix":
+        router = route_by_network.NetworkRouter(grid_network(NETWORK_GRID_NODES))
+        report = measure(
+            scenario,
+            size,
+            lambda: route_by_network.build_matrix(router, starts, "point_id", ends, "point_id", tolerance=200),
+            latencies,
+            items=size * size,
+        )
+        # Длина при поиске по времени суммируется по дереву кратчайших путей и должна совпадать с суммой рёбер
+        check_network(router, starts, ends)
+        return report
+
+    raise ValueError(f"Неизвестный сценарий: {scenario}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры скриптов на локальных заглушках API")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Размеры входных данных")
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS, help="Сценарии")
+    parser.add_argument("--latency", type=float, default=0.05, help="Средняя задержка ответа заглушки, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов с ошибкой 500")
+    parser.add_argument("--concurrency", type=int, default=8, help="Число одновременных запросов")
+    parser.add_argument("--responses", default=None, help="Каталог с записанными ответами <имя>.json")
+    parser.add_argument("--port", type=int, default=8765, help="Порт заглушки")
+    parser.add_argument("--output", default=None, help="Файл для результатов (по умолчанию - вывод в консоль)")
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.latency, args.error_rate, args.responses)
+    base_url = f"http://127.0.0.1:{args.port}"
+    results = []
+    try:
+        for scenario in args.scenarios:
+            for size in args.sizes:
+                results.append(run_scenario(scenario, size, base_url, args.concurrency))
+    finally:
+        server.terminate()
+
+    report = {
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "concurrency": args.concurrency,
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+"""
+Запуск скриптов из командной строки.
+
+Каждая команда импортирует только нужный ей модуль при запуске, поэтому справка и короткие задачи
+не загружают geopandas, shapely, routingpy и pynspd целиком, а импорт модулей не выполняет запросов.
+
+Примеры запуска:
+    python cli.py valhalla-routes start_points.gpkg end_points.gpkg --output routes.gpkg --cache responses_cache.sqlite
+    python cli.py isochrones points.gpkg --intervals 300 600 900 --profile pedestrian --output isochrones.gpkg
+    python cli.py nspd-harvest --contour test --workers 8
+"""
+
+import argparse
+import contextlib
+
+from metrics import metrics
+
+# Число одновременных запросов на один сервер Valhalla, как в route_by_valhalla.py и isochrone_by_valhalla.py
+VALHALLA_CONCURRENCY_PER_URL = 16
+
+
+def read_points(path: str):
+    import geopandas as gpd
+
+    return gpd.read_file(path, use_arrow=True)
+
+
+def read_od(path: str | None):
+    """Таблица пар from, to из CSV или None."""
+    if path is None:
+        return None
+    import pandas as pd
+
+    return pd.read_csv(path)
+
+
+def open_cache(path: str | None):
+    if path is None:
+        return contextlib.nullcontext()
+    from response_cache import ResponseCache
+
+    return ResponseCache(path)
+
+
+def open_writer(path: str):
+    from stream_writer import StreamWriter
+
+    return StreamWriter(path)
+
+
+def print_cache_stats(cache):
+    if cache is not None:
+        print(f"Кэш: {cache.stats()}")
+
+
+def setup_valhalla(module, args):
+    """
+    Задаёт серверы Valhalla для модуля, предел контроллера запросов растёт с их числом.
+    Бюджет запросов в секунду и целевая задержка заменяют RPS и TARGET_LATENCY модуля, если заданы.
+    """
+    if args.url:
+        module.VALHALLA_URLS = args.url
+        module.controller.max_concurrency = VALHALLA_CONCURRENCY_PER_URL * len(args.url)
+    if args.rps is not None:
+        module.controller.rps = args.rps
+    if args.target_latency is not None:
+        module.controller.target_latency = args.target_latency
+
+
+def print_valhalla_stats(module):
+    print(f"Контроллер запросов: {module.controller.stats()}")
+    for node in module.get_client().stats():
+        print(f"Сервер Valhalla: {node}")
+
+
+def valhalla_routes(args):
+    import route_by_valhalla
+
+    setup_valhalla(route_by_valhalla, args)
+    route_by_valhalla.route_profile = args.profile
+    route_by_valhalla.route_options["costing"] = args.profile
+    gdf_start, gdf_end = read_points(args.start), read_points(args.end)
+    with open_cache(args.cache) as cache, open_writer(args.output) as writer:
+        route_by_valhalla.build_routes(
+            gdf_start,
+            args.start_field,
+            gdf_end,
+            args.end_field,
+            concurrency=args.concurrency,
+            cache=cache,
+            writer=writer,
+            od=read_od(args.od),
+            max_distance=args.max_distance,
+            k_nearest=args.k_nearest,
+            exclude_self=args.exclude_self,
+        )
+        print_cache_stats(cache)
+        print_valhalla_stats(route_by_valhalla)
+
+
+def valhalla_matrix(args):
+    import route_by_valhalla
+
+    setup_valhalla(route_by_valhalla, args)
+    route_by_valhalla.route_profile = args.profile
+    route_by_valhalla.route_options["costing"] = args.profile
+    gdf_start, gdf_end = read_points(args.start), read_points(args.end)
+    with open_cache(args.cache) as cache:
+        result = route_by_valhalla.build_matrix(
+            gdf_start, args.start_field, gdf_end, args.end_field, concurrency=args.concurrency, cache=cache
+        )
+        print_cache_stats(cache)
+        print_valhalla_stats(route_by_valhalla)
+    result.to_csv(args.output, index=False)
+    print(f"Матрица сохранена в {args.output}")
+
+
+def isochrones(args):
+    import isochrone_by_valhalla
+
+    setup_valhalla(isochrone_by_valhalla, args)
+    isochrone_by_valhalla.PROFILE = args.profile
+    isochrone_by_valhalla.INTERVAL_TYPE = args.interval_type
+    gdf_points = read_points(args.points)
+    with open_cache(args.cache) as cache, open_writer(args.output) as writer:
+        isochrone_by_valhalla.build_isochrones(
+            gdf_points,
+            args.field,
+            args.intervals,
+            concurrency=args.concurrency,
+            cache=cache,
+            snap_tolerance=args.snap_tolerance,
+            writer=writer,
+        )
+        print_cache_stats(cache)
+        print_valhalla_stats(isochrone_by_valhalla)
+
+
+def gis_routes(args):
+    import route_by_2gis
+
+    route_by_2gis.TRANSPORT = args.transport
+    gdf_start, gdf_end = read_points(args.start), read_points(args.end)
+    exclude = route_by_2gis.ExcludePolygons(read_points(args.exclude)) if args.exclude else None
+    with open_cache(args.cache) as cache, open_writer(args.output) as writer:
+        route_by_2gis.find_routes(
+            gdf_start,
+            args.start_field,
+            gdf_end,
+            args.end_field,
+            cache=cache,
+            writer=writer,
+            concurrency=args.concurrency,
+            exclude=exclude,
+            od=read_od(args.od),
+            max_distance=args.max_distance,
+            k_nearest=args.k_nearest,
+            exclude_self=args.exclude_self,
+        )
+        print_cache_stats(cache)
+
+
+def network_routes(args):
+    import route_by_network
+
+    router = route_by_network.NetworkRouter(
+        read_points(args.lines), speed_field=args.speed_field, oneway_field=args.oneway_field, weight=args.weight
+    )
+    gdf_start, gdf_end = read_points(args.start), read_points(args.end)
+    if args.matrix:
+        result = route_by_network.build_matrix(
+            router, gdf_start, args.start_field, gdf_end, args.end_field, args.concurrency, args.tolerance
+        )
+        result.to_csv(args.output, index=False)
+        print(f"Матрица сохранена в {args.output}")
+        return
+    with open_writer(args.output) as writer:
+        route_by_network.build_routes(
+            router, gdf_start, args.start_field, gdf_end, args.end_field, args.concurrency, args.tolerance, writer
+        )
+
+
+def read_contour(value: str):
+    """Контур выгрузки: test, moscow или путь к файлу с полигонами (объединяются в один)."""
+    import nspd_parser
+
+    if value == "test":
+        return nspd_parser.contour_test
+    if value == "moscow":
+        return nspd_parser.contour_moscow
+    return read_points(value).to_crs("EPSG:4326").geometry.union_all()
+
+
+def select_layers(titles: list[str] | None) -> dict:
+    import nspd_parser
+
+    if not titles:
+        return nspd_parser.LAYERS
+    unknown = [title for title in titles if title not in nspd_parser.LAYERS]
+    if unknown:
+        raise SystemExit(f"Неизвестные слои: {unknown}, доступны: {list(nspd_parser.LAYERS)}")
+    return {title: nspd_parser.LAYERS[title] for title in titles}
+
+
+def nspd_harvest(args):
+    import nspd_parser
+
+    nspd_parser.EXPORT_GPKG = args.gpkg
+    nspd_parser.harvest_layers(read_contour(args.contour), select_layers(args.layers), workers=args.workers)
+
+
+def nspd_sync(args):
+    import nspd_parser
+
+    nspd_parser.EXPORT_GPKG = args.gpkg
+    nspd_parser.sync_layers(
+        read_contour(args.contour),
+        select_layers(args.layers),
+        workers=args.workers,
+        max_age=args.max_age,
+        apply=args.apply,
+    )
+
+
+def snap(args):
+    import snap_points_to_lines
+
+    points, lines = read_points(args.points), read_points(args.lines)
+    if args.workers == 1:
+        result = snap_points_to_lines.snap_points_to_lines(points, lines, args.tolerance)
+    else:
+        result = snap_points_to_lines.snap_points_parallel(points, lines, args.tolerance, workers=args.workers)
+    result.to_file(args.output)
+    print(f"Точки сохранены в {args.output}")
+
+
+def add_pairs_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("start", help="Файл с точками начала маршрутов")
+    parser.add_argument("end", help="Файл с точками конца маршрутов")
+    parser.add_argument("--start-field", default="point_id", help="Поле с идентификатором точек начала")
+    parser.add_argument("--end-field", default="point_id", help="Поле с идентификатором точек конца")
+    parser.add_argument("--concurrency", type=int, default=1, help="Число одновременных запросов")
+
+
+def add_od_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--od", default=None, help="CSV с парами from, to (по умолчанию - все сочетания)")
+    parser.add_argument("--max-distance", type=float, default=None, help="Максимальное расстояние по прямой, м")
+    parser.add_argument("--k-nearest", type=int, default=None, help="Число ближайших точек конца")
+    parser.add_argument("--exclude-self", action="store_true", help="Пропускать пары с одинаковыми идентификаторами")
+
+
+def add_valhalla_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--url", nargs="+", default=None, help="Серверы Valhalla")
+    parser.add_argument("--rps", type=float, default=None, help="Максимальное число запросов в секунду к Valhalla")
+    parser.add_argument("--target-latency", type=float, default=None, help="Целевая задержка ответа Valhalla, с")
+
+
+def add_nspd_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--contour", default="test", help="test, moscow или файл с полигонами контура выгрузки")
+    parser.add_argument("--layers", nargs="+", default=None, help="Названия слоёв (по умолчанию - все)")
+    parser.add_argument("--workers", type=int, default=8, help="Число одновременно выгружаемых тайлов")
+    parser.add_argument("--gpkg", action="store_true", help="Экспортировать результат в GPKG (по частям выгрузки)")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Маршруты, изохроны, выгрузка НСПД и привязка точек к линиям")
+    parser.add_argument("--metrics", default=None, help="Файл JSON для показателей запросов и этапов")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("valhalla-routes", help="Маршруты Valhalla")
+    add_pairs_arguments(command)
+    add_od_arguments(command)
+    command.add_argument("--profile", default="auto", help="Профиль маршрутизации Valhalla")
+    add_valhalla_arguments(command)
+    command.add_argument("--cache", default=None, help="Файл SQLite с кэшем ответов")
+    command.add_argument("--output", default="routes.gpkg", help="Файл результата (.gpkg или .parquet)")
+    command.set_defaults(func=valhalla_routes)
+
+    command = commands.add_parser("valhalla-matrix", help="Матрица расстояний и времени Valhalla")
+    add_pairs_arguments(command)
+    command.add_argument("--profile", default="auto", help="Профиль маршрутизации Valhalla")
+    add_valhalla_arguments(command)
+    command.add_argument("--cache", default=None, help="Файл SQLite с кэшем ответов")
+    command.add_argument("--output", default="matrix.csv", help="CSV результата")
+    command.set_defaults(func=valhalla_matrix)
+
+    command = commands.add_parser("isochrones", help="Изохроны Valhalla")
+    command.add_argument("points", help="Файл с точками")
+    command.add_argument("--field", default="point_id", help="Поле с идентификатором точек")
+    command.add_argument("--intervals", type=int, nargs="+", default=[300, 600, 900, 1200], help="Интервалы")
+    command.add_argument("--interval-type", default="time", choices=["time", "distance"], help="Тип интервалов")
+    command.add_argument("--profile", default="pedestrian", help="Профиль маршрутизации Valhalla")
+    command.add_argument("--snap-tolerance", type=float, default=None, help="Размер ячейки группировки точек, м")
+    command.add_argument("--concurrency", type=int, default=1, help="Число одновременных запросов")
+    add_valhalla_arguments(command)
+    command.add_argument("--cache", default=None, help="Файл SQLite с кэшем ответов")
+    command.add_argument("--output", default="isochrones.gpkg", help="Файл результата (.gpkg или .parquet)")
+    command.set_defaults(func=isochrones)
+
+    command = commands.add_parser("2gis-routes", help="Маршруты 2ГИС")
+    add_pairs_arguments(command)
+    add_od_arguments(command)
+    command.add_argument("--transport", default="driving", help="Вид транспорта 2ГИС")
+    command.add_argument("--exclude", default=None, help="Файл с полигонами, которые следует избегать")
+    command.add_argument("--cache", default=None, help="Файл SQLite с кэшем ответов")
+    command.add_argument("--output", default="routes.gpkg", help="Файл результата (.gpkg или .parquet)")
+    command.set_defaults(func=gis_routes)
+
+    command = commands.add_parser("network-routes", help="Маршруты по локальному слою линий")
+    command.add_argument("lines", help="Файл со слоем линий")
+    add_pairs_arguments(command)
+    command.add_argument("--speed-field", default=None, help="Поле со скоростью, км/ч")
+    command.add_argument("--oneway-field", default=None, help="Поле одностороннего движения (yes/no/-1)")
+    command.add_argument("--weight", default="duration", choices=["duration", "distance"], help="Вес рёбер")
+    command.add_argument("--tolerance", type=float, default=500, help="Расстояние привязки точек к линиям, м")
+    command.add_argument("--matrix", action="store_true", help="Строить матрицу без геометрии маршрутов")
+    command.add_argument("--output", default="routes_local.gpkg", help="Файл результата (CSV для --matrix)")
+    command.set_defaults(func=network_routes)
+
+    command = commands.add_parser("nspd-harvest", help="Выгрузка слоёв НСПД по контуру")
+    add_nspd_arguments(command)
+    command.set_defaults(func=nspd_harvest)
+
+    command = commands.add_parser("nspd-sync", help="Инкрементальная синхронизация слоёв НСПД")
+    add_nspd_arguments(command)
+    command.add_argument("--max-age", type=float, default=None, help="Время актуальности выгруженного тайла, с")
+    command.add_argument("--apply", action="store_true", help="Применить изменения к предыдущей выгрузке")
+    command.set_defaults(func=nspd_sync)
+
+    command = commands.add_parser("snap", help="Привязка точек к линиям")
+    command.add_argument("points", help="Файл с точками")
+    command.add_argument("lines", help="Файл со слоем линий")
+    command.add_argument("--tolerance", type=float, default=None, help="Максимальное расстояние привязки")
+    command.add_argument("--workers", type=int, default=1, help="Число процессов (1 - в текущем процессе)")
+    command.add_argument("--output", default="snapped_points.gpkg", help="Файл результата")
+    command.set_defaults(func=snap)
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    args.func(args)
+    if args.metrics is not None:
+        metrics.to_json(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
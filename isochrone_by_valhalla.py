@@ -1,106 +1,283 @@
-# import time
+from concurrent.futures import ThreadPoolExecutor
 
 import geopandas as gpd
-from routingpy import Valhalla
+from routingpy.isochrone import Isochrone
 from shapely.geometry import Polygon
 from tqdm import tqdm
 
+from metrics import metrics
+from rate_controller import raise_unavailable, shared_controller
+from response_cache import ResponseCache
+from stream_writer import StreamWriter
+from valhalla_pool import shared_pool
+
 # Параметры построения изохрон
 PROFILE = "pedestrian"
 INTERVAL_TYPE = "time"
 POLYGONS = True
 PREFERENCE = "fastest"
+# Максимальное число контуров в одном запросе (ограничение Valhalla)
+MAX_CONTOURS = 4
+
+# Серверы Valhalla: запросы распределяются между ними по наименьшему числу запросов в работе
+VALHALLA_URLS = ["https://valhalla1.openstreetmap.de"]
+# Ограничения общего контроллера запросов к Valhalla: задержка ответа в секундах, выше которой число запросов
+# в работе уменьшается (меньше timeout клиента), и число запросов в секунду ко всем серверам (None - без ограничения)
+TARGET_LATENCY = 5.0
+RPS = None
 
 # --------------------
 
-# Инициализация клиента Valhalla с автоматической обработкой повторных запросов и ошибок
-client = Valhalla(
-    base_url="https://valhalla1.openstreetmap.de",
-    timeout=10,
-    retry_timeout=60,
-    retry_over_query_limit=True,
-    skip_api_error=True,
+# Общий для скриптов Valhalla контроллер числа одновременных запросов: подстраивается под ответы сервера (AIMD),
+# при 429 повторяет запрос после паузы со случайной длительностью
+controller = shared_controller(
+    "valhalla", max_concurrency=16 * len(VALHALLA_URLS), rps=RPS, target_latency=TARGET_LATENCY
 )
 
+# Клиент Valhalla создаётся при первом построении (get_client), чтобы импорт модуля не открывал соединений
+# и не запускал проверку серверов. Заданный здесь клиент (например, в benchmark.py) используется вместо общего пула
+client = None
+
+
+def get_client():
+    """
+    Клиент Valhalla с автоматической обработкой ошибок: при отказе сервера запрос повторяется на другом,
+    неотвечающие серверы исключаются из пула до восстановления. Пул общий для скриптов Valhalla.
+    """
+    if client is not None:
+        return client
+    return shared_pool(
+        VALHALLA_URLS,
+        timeout=10,
+        retry_timeout=60,
+        # Превышение лимита запросов (429) и недоступность сервера (503) обрабатывает controller,
+        # поэтому клиент сразу возвращает ошибку, а не повторяет запрос сам
+        retry_over_query_limit=False,
+        # Параметры пула общие для скриптов Valhalla (см. route_by_valhalla.get_client)
+        skip_api_error=False,
+        # Каждая попытка запроса учитывается в metrics, затем 503 пробрасывается без повторов routingpy
+        hooks={"response": [metrics.response_hook("valhalla"), raise_unavailable]},
+    )
+
 
-def build_isochrone(client, point, interval):
+def build_isochrone(client, point, intervals, cache: ResponseCache | None = None):
+    cache_options = [PROFILE, INTERVAL_TYPE, POLYGONS, PREFERENCE, intervals]
+    if cache is not None:
+        cached = cache.get("valhalla_isochrones", cache_options, [point])
+        if cached is not None:
+            return [Isochrone(**iso) if iso else None for iso in cached]
     try:
-        isochrone = client.isochrones(
-            locations=[point],
-            profile=PROFILE,
-            intervals=[interval],
-            interval_type=INTERVAL_TYPE,
-            polygons=POLYGONS,
-            preference=PREFERENCE,
-        )
+        with metrics.stage("http"):
+            isochrone = controller.run(
+                client.isochrones,
+                locations=[point],
+                profile=PROFILE,
+                intervals=intervals,
+                interval_type=INTERVAL_TYPE,
+                polygons=POLYGONS,
+                preference=PREFERENCE,
+            )
+        if cache is not None and isochrone:
+            cache.set(
+                "valhalla_isochrones",
+                cache_options,
+                [point],
+                [
+                    {
+                        "geometry": iso.geometry,
+                        "interval": iso.interval,
+                        "center": iso.center,
+                        "interval_type": iso.interval_type,
+                    }
+                    if iso
+                    else None
+                    for iso in isochrone
+                ],
+            )
         return isochrone
     except Exception as e:
+        metrics.error("valhalla", e)
         print(f"Unexpected error: {e}")
         return None
 
 
-def build_isochrones(gdf: gpd.GeoDataFrame, field_name: str, interval: int):
+def parse_isochrones(isochrones) -> list[tuple]:
+    """Преобразует ответ Valhalla в список кортежей (геометрия, интервал, тип интервала)."""
+    rows = []
+    if isochrones:
+        for iso in isochrones:
+            if iso:
+                try:
+                    isochrone_geom = Polygon(iso.geometry[0])
+                except Exception as e:
+                    print(f"Ошибка при создании полигона из изохроны: {e}")
+                    isochrone_geom = None
+                rows.append((isochrone_geom, iso.interval, iso.interval_type))
+            else:
+                rows.append((None, None, None))
+    else:
+        print("Не удалось построить ни одну изохрону")
+    return rows
+
+
+def build_isochrones(
+    gdf: gpd.GeoDataFrame,
+    field_name: str,
+    intervals: int | list[int],
+    concurrency: int = 1,
+    cache: ResponseCache | None = None,
+    snap_tolerance: float | None = None,
+    writer: StreamWriter | None = None,
+):
     """
     Построение изохрон для точек
 
     Args:
         gdf: GeoDataFrame с точками
         field_name: Имя поля с идентификатором точек
-        interval: Интервал изохроны в секундах или метрах
+        intervals: Интервал или список интервалов изохрон в секундах или метрах
+        concurrency: Максимальное число одновременных запросов к Valhalla (1 - последовательное построение),
+            фактическое число ограничивает controller по ответам сервера
+        cache: Кэш ответов, позволяющий не запрашивать повторно уже построенные изохроны (None - без кэширования)
+        snap_tolerance: Размер ячейки сетки в метрах, точки из одной ячейки получают общую изохрону,
+            построенную от их среднего положения (None - изохрона строится для каждой точки)
+        writer: Потоковая запись результатов порциями с контрольной точкой (None - результат собирается в памяти)
 
     Returns:
-        GeoDataFrame с изохронами
+        GeoDataFrame с изохронами, по одной строке на пару (start_id, interval),
+        или None, если результаты записываются через writer
     """
     gdf = gdf.copy().to_crs("EPSG:4326")
-    gdf["lon"] = gdf.geometry.x
-    gdf["lat"] = gdf.geometry.y
+
+    if isinstance(intervals, (int, float)):
+        intervals = [intervals]
+    intervals = sorted(intervals)
+    # Интервалы упаковываются в запросы по MAX_CONTOURS контуров
+    interval_chunks = [intervals[i : i + MAX_CONTOURS] for i in range(0, len(intervals), MAX_CONTOURS)]
+
+    points = list(zip(gdf.geometry.x, gdf.geometry.y))
+    start_ids = [row.get(field_name, None) for _, row in gdf.iterrows()]
+
+    # Группируем близкие точки по ячейкам сетки в метрической проекции, изохрона строится одна на группу
+    if snap_tolerance:
+        projected = gdf.geometry.to_crs(gdf.estimate_utm_crs())
+        cells = list(zip((projected.x // snap_tolerance).astype(int), (projected.y // snap_tolerance).astype(int)))
+    else:
+        cells = list(range(len(points)))
+    groups: dict = {}
+    point_groups = [groups.setdefault(cell, len(groups)) for cell in cells]
+    group_members: list[list[int]] = [[] for _ in groups]
+    for idx, group in enumerate(point_groups):
+        group_members[group].append(idx)
+    group_points = [
+        (
+            sum(points[idx][0] for idx in members) / len(members),
+            sum(points[idx][1] for idx in members) / len(members),
+        )
+        for members in group_members
+    ]
+    if snap_tolerance:
+        saved = (len(points) - len(group_points)) * len(interval_chunks)
+        print(f"Точек: {len(points)}, групп: {len(group_points)}, сэкономлено запросов: {saved}")
+
+    pending_groups = [
+        group
+        for group, members in enumerate(group_members)
+        if writer is None or any(not writer.is_done(start_ids[idx]) for idx in members)
+    ]
+    tasks = [(group, chunk) for group in pending_groups for chunk in interval_chunks]
+
+    client = get_client()
+
+    def build_task(task):
+        group, chunk = task
+        # Время запросов для подбора timeout собирается в metrics
+        return build_isochrone(client, group_points[group], chunk, cache=cache)
+
+    # Каждый ответ разбирается один раз, затем результат раздаётся всем точкам группы
+    group_rows: dict[int, list[tuple]] = {}
+    # Группы, для которых хотя бы один запрос не удался: при записи через writer они пропускаются,
+    # чтобы при перезапуске быть построенными заново
+    failed_groups: set[int] = set()
+
+    executor = ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else None
+    map_func = executor.map if executor is not None else map
+    try:
+        results = map_func(build_task, tasks)
+        for task_idx, ((group, _), isochrones) in enumerate(
+            zip(tasks, tqdm(results, total=len(tasks), desc="Building isochrones"))
+        ):
+            with metrics.stage("geometry"):
+                group_rows.setdefault(group, []).extend(parse_isochrones(isochrones))
+            if not isochrones:
+                failed_groups.add(group)
+
+            # Задачи одной группы идут подряд, после последнего контура группа готова к записи
+            if writer is None or (task_idx + 1) % len(interval_chunks):
+                continue
+            if group in failed_groups:
+                del group_rows[group]
+                continue
+            with metrics.stage("write"):
+                for idx in group_members[group]:
+                    if writer.is_done(start_ids[idx]):
+                        continue
+                    writer.write(
+                        start_ids[idx],
+                        [
+                            {
+                                "geometry": geom,
+                                "start_id": start_ids[idx],
+                                "interval": interval,
+                                "interval_type": interval_type,
+                            }
+                            for geom, interval, interval_type in group_rows[group]
+                        ],
+                    )
+            del group_rows[group]
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if writer is not None:
+            writer.flush()
+
+    if writer is not None:
+        return None
 
     list_isochrones_geoms = []
     list_start_ids = []
     list_intervals = []
     list_interval_types = []
 
-    for _, row in tqdm(gdf.iterrows(), total=len(gdf), desc="Building isochrones"):
-        point = row.lon, row.lat
-        # Для определения оптимального timeout
-        # start_time = time.time()
-        isochrones = build_isochrone(client, point, interval)
-        # end_time = time.time()
-        # print(f"Время построения изохроны: {end_time - start_time} секунд")
-        if isochrones:
-            for iso in isochrones:
-                if iso:
-                    try:
-                        isochrone_geom = Polygon(iso.geometry[0])
-                    except Exception as e:
-                        print(f"Ошибка при создании полигона из изохроны: {e}")
-                        isochrone_geom = None
-                    list_isochrones_geoms.append(isochrone_geom)
-                    list_intervals.append(iso.interval)
-                    list_interval_types.append(iso.interval_type)
-                else:
-                    list_isochrones_geoms.append(None)
-                    list_intervals.append(None)
-                    list_interval_types.append(None)
-            list_start_ids.append(row.get(field_name, None))
-        else:
-            print("Не удалось построить ни одну изохрону")
-
-    result_gdf = gpd.GeoDataFrame(
-        {
-            "geometry": list_isochrones_geoms,
-            "start_id": list_start_ids,
-            "interval": list_intervals,
-            "interval_type": list_interval_types,
-        },
-        geometry="geometry",
-        crs="EPSG:4326",
-    )
+    for start_id, group in zip(start_ids, point_groups):
+        for isochrone_geom, interval, interval_type in group_rows[group]:
+            list_isochrones_geoms.append(isochrone_geom)
+            list_start_ids.append(start_id)
+            list_intervals.append(interval)
+            list_interval_types.append(interval_type)
+
+    with metrics.stage("dataframe"):
+        result_gdf = gpd.GeoDataFrame(
+            {
+                "geometry": list_isochrones_geoms,
+                "start_id": list_start_ids,
+                "interval": list_intervals,
+                "interval_type": list_interval_types,
+            },
+            geometry="geometry",
+            crs="EPSG:4326",
+        )
 
     return result_gdf
 
 
-# Пример использования
-gdf_points = gpd.read_file("points.gpkg", use_arrow=True)
-result = build_isochrones(gdf_points, "point_id", 15)
-result.to_file("isochrones.gpkg")
+if __name__ == "__main__":
+    # Пример использования
+    gdf_points = gpd.read_file("points.gpkg", use_arrow=True)
+    with ResponseCache("responses_cache.sqlite") as cache, StreamWriter("isochrones.gpkg") as writer:
+        build_isochrones(gdf_points, "point_id", [300, 600, 900, 1200], cache=cache, writer=writer)
+        print(f"Кэш: {cache.stats()}")
+        print(f"Контроллер запросов: {controller.stats()}")
+        for node in get_client().stats():
+            print(f"Сервер Valhalla: {node}")
+    metrics.to_json("isochrones_metrics.json")
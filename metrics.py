@@ -0,0 +1,220 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# Верхние границы корзин гистограммы задержек запросов, с
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Коды ответа, после которых клиенты повторяют запрос
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class Metrics:
+    """
+    Сбор показателей запросов к внешним API и этапов обработки.
+    Используется скриптами route_by_valhalla.py, isochrone_by_valhalla.py, route_by_2gis.py и nspd_parser.py
+    через общий объект metrics, чтобы подбирать timeout и размер задач по фактическим данным.
+
+    Собираются гистограммы задержек запросов, число ответов по кодам, повторы и превышения лимита запросов (429),
+    ошибки по классам, объём переданных данных и суммарное время этапов (http, geometry, dataframe, write).
+    Результат выгружается в JSON или в текстовый формат Prometheus.
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        """
+        Args:
+            buckets: Верхние границы корзин гистограммы задержек, с
+        """
+        self.buckets = tuple(sorted(buckets))
+        # Показатели обновляются из нескольких потоков
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Обнуляет все показатели."""
+        with self._lock:
+            # (provider, endpoint) -> число запросов в каждой корзине (последняя - больше всех границ), сумма, число
+            self._latency: dict[tuple, dict] = {}
+            self._statuses: dict[tuple, int] = defaultdict(int)
+            self._counters: dict[tuple, int] = defaultdict(int)
+            self._errors: dict[tuple, int] = defaultdict(int)
+            self._bytes: dict[tuple, int] = defaultdict(int)
+            self._stage_seconds: dict[str, float] = defaultdict(float)
+            self._stage_calls: dict[str, int] = defaultdict(int)
+
+    def observe_request(
+        self,
+        provider: str,
+        seconds: float,
+        status,
+        endpoint: str = "",
+        sent: int = 0,
+        received: int = 0,
+    ):
+        """
+        Записывает один выполненный запрос.
+
+        Args:
+            provider: Имя API (valhalla, 2gis, nspd)
+            seconds: Длительность запроса
+            status: Код ответа или ok/error
+            endpoint: Путь запроса
+            sent: Размер тела запроса, байт
+            received: Размер ответа, байт
+        """
+        key = (provider, endpoint)
+        with self._lock:
+            histogram = self._latency.setdefault(
+                key, {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            )
+            bucket = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+            histogram["counts"][bucket] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+            self._statuses[(provider, endpoint, str(status))] += 1
+            self._bytes[(provider, "sent")] += sent
+            self._bytes[(provider, "received")] += received
+            if status == 429:
+                self._counters[("over_query_limit", provider)] += 1
+
+    def count(self, name: str, provider: str, value: int = 1):
+        """Увеличивает счётчик (retries, over_query_limit и т.п.)."""
+        with self._lock:
+            self._counters[(name, provider)] += value
+
+    def error(self, provider: str, error):
+        """Записывает ошибку по имени её класса."""
+        name = error if isinstance(error, str) else type(error).__name__
+        with self._lock:
+            self._errors[(provider, name)] += 1
+
+    def add_stage(self, name: str, seconds: float):
+        with self._lock:
+            self._stage_seconds[name] += seconds
+            self._stage_calls[name] += 1
+
+    @contextmanager
+    def stage(self, name: str):
+        """Учитывает время выполнения блока в суммарном времени этапа."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start_time)
+
+    def response_hook(self, provider: str):
+        """
+        Обработчик ответов requests (hooks={"response": ...}). Учитывает каждую попытку запроса,
+        в том числе повторы, которые клиент выполняет сам (например, routingpy при 429).
+        """
+
+        def hook(response, *args, **kwargs):
+            request_body = response.request.body or b""
+            self.observe_request(
+                provider,
+                response.elapsed.total_seconds(),
+                response.status_code,
+                endpoint=urlparse(response.url).path,
+                sent=len(request_body),
+                received=len(response.content),
+            )
+            if response.status_code in RETRY_STATUSES:
+                self.count("retries", provider)
+
+        return hook
+
+    def to_dict(self) -> dict:
+        """Все показатели в виде словаря, пригодного для JSON."""
+        with self._lock:
+            return {
+                "buckets": list(self.buckets),
+                "latency": [
+                    {"provider": provider, "endpoint": endpoint, **histogram}
+                    for (provider, endpoint), histogram in self._latency.items()
+                ],
+                "responses": [
+                    {"provider": provider, "endpoint": endpoint, "status": status, "count": count}
+                    for (provider, endpoint, status), count in self._statuses.items()
+                ],
+                "counters": [
+                    {"name": name, "provider": provider, "value": value}
+                    for (name, provider), value in self._counters.items()
+                ],
+                "errors": [
+                    {"provider": provider, "error": error, "count": count}
+                    for (provider, error), count in self._errors.items()
+                ],
+                "bytes": [
+                    {"provider": provider, "direction": direction, "value": value}
+                    for (provider, direction), value in self._bytes.items()
+                ],
+                "stages": [
+                    {"stage": name, "seconds": seconds, "calls": self._stage_calls[name]}
+                    for name, seconds in self._stage_seconds.items()
+                ],
+            }
+
+    def to_json(self, path: str | None = None) -> str:
+        """Показатели в JSON, при заданном path также записываются в файл."""
+        text = json.dumps(self.to_dict(), ensure_ascii=False, indent=2)
+        if path is not None:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+        return text
+
+    @staticmethod
+    def _labels(**labels) -> str:
+        """Метки в формате Prometheus: в значениях экранируются обратная косая черта, кавычки и переводы строк."""
+        escaped = {
+            key: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            for key, value in labels.items()
+        }
+        return ",".join(f'{key}="{value}"' for key, value in escaped.items())
+
+    def to_prometheus(self) -> str:
+        """Показатели в текстовом формате Prometheus."""
+        data = self.to_dict()
+        lines = ["# TYPE request_latency_seconds histogram"]
+        for item in data["latency"]:
+            labels = self._labels(provider=item["provider"], endpoint=item["endpoint"])
+            cumulative = 0
+            for bound, count in zip([*self.buckets, "+Inf"], item["counts"]):
+                cumulative += count
+                lines.append(f'request_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"request_latency_seconds_sum{{{labels}}} {item['sum']}")
+            lines.append(f"request_latency_seconds_count{{{labels}}} {item['count']}")
+
+        lines.append("# TYPE responses_total counter")
+        for item in data["responses"]:
+            labels = self._labels(provider=item["provider"], endpoint=item["endpoint"], status=item["status"])
+            lines.append(f"responses_total{{{labels}}} {item['count']}")
+
+        for name in sorted({item["name"] for item in data["counters"]}):
+            lines.append(f"# TYPE {name}_total counter")
+            for item in data["counters"]:
+                if item["name"] == name:
+                    lines.append(f"{name}_total{{{self._labels(provider=item['provider'])}}} {item['value']}")
+
+        lines.append("# TYPE errors_total counter")
+        for item in data["errors"]:
+            labels = self._labels(provider=item["provider"], error=item["error"])
+            lines.append(f"errors_total{{{labels}}} {item['count']}")
+
+        lines.append("# TYPE bytes_total counter")
+        for item in data["bytes"]:
+            labels = self._labels(provider=item["provider"], direction=item["direction"])
+            lines.append(f"bytes_total{{{labels}}} {item['value']}")
+
+        lines.append("# TYPE stage_seconds_total counter")
+        for item in data["stages"]:
+            lines.append(f"stage_seconds_total{{{self._labels(stage=item['stage'])}}} {item['seconds']}")
+        lines.append("# TYPE stage_calls_total counter")
+        for item in data["stages"]:
+            lines.append(f"stage_calls_total{{{self._labels(stage=item['stage'])}}} {item['calls']}")
+        return "\n".join(lines) + "\n"
+
+
+# Общий объект показателей для всех скриптов
+metrics = Metrics()
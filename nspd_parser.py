@@ -1,13 +1,26 @@
+import hashlib
 import json
+import math
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
 from datetime import date
+from queue import Queue
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
-from shapely import from_wkt
+from shapely import STRtree, from_wkt, to_wkb
+from shapely.geometry import box
 from tqdm import tqdm
 
 from pynspd import Nspd, NspdFeature  # 1.1.2
 
+from metrics import metrics
+from stream_writer import StreamWriter
+
 
 def convert_date_to_str(date_value):
     """Преобразует дату в строку (если это datetime.date) или возвращает исходное значение."""
@@ -23,228 +36,705 @@ contour_moscow = from_wkt(
     "Polygon((36.80313264 55.14221029, 37.96747125 55.14221029, 37.96747125 56.02123908, 36.80313264 56.02123908, 36.80313264 55.14221029))"
 )
 
-# Парсинг земельных участков по контуру
-with Nspd() as nspd:
-    data = []
-
-    for i in tqdm(
-        nspd.search_in_contour_iter(contour_moscow, NspdFeature.by_title("Земельные участки из ЕГРН"), only_intersects=True),
-        desc="Обработка участков",
-    ):
-
-        if not i.properties.options.no_coords:
-            data.append(
-                {
-                    # Поля для выгрузки
-                    "cad_num": i.properties.options.cad_num,
-                    "quarter_cad_number": i.properties.options.quarter_cad_number,
-                    "objdoc_id": i.properties.options.objdoc_id,
-                    "registers_id": i.properties.options.registers_id,
-                    "land_record_type": i.properties.options.land_record_type,
-                    "land_record_subtype": i.properties.options.land_record_subtype,
-                    "land_record_reg_date": convert_date_to_str(i.properties.options.land_record_reg_date),
-                    "readable_address": i.properties.options.readable_address,
-                    "specified_area": i.properties.options.specified_area,
-                    "declared_area": i.properties.options.declared_area,
-                    "area": i.properties.options.area,
-                    "status": i.properties.options.status,
-                    "land_record_category_type": i.properties.options.land_record_category_type,
-                    "permitted_use_established_by_document": i.properties.options.permitted_use_established_by_document,
-                    "ownership_type": i.properties.options.ownership_type,
-                    "cost_value": i.properties.options.cost_value,
-                    "cost_index": i.properties.options.cost_index,
-                    "cost_application_date": convert_date_to_str(i.properties.options.cost_application_date),
-                    "cost_approvement_date": convert_date_to_str(i.properties.options.cost_approvement_date),
-                    "cost_determination_date": convert_date_to_str(i.properties.options.cost_determination_date),
-                    "cost_registration_date": convert_date_to_str(i.properties.options.cost_registration_date),
-                    "determination_couse": i.properties.options.determination_couse,
-                    "geometry": i.geometry.to_multi_shape(),
-                }
+# Параметры разбиения контура на тайлы
+TILE_SIZE = 0.05  # начальный размер тайла в градусах
+TILE_MIN_SIZE = 0.005  # тайлы меньше этого размера не дробятся
+TILE_MAX_FEATURES = 5000  # тайл с большим числом объектов считается плотным и дробится на 4 части
+TILE_RETRIES = 3
+# Число объектов, накапливаемых в памяти перед записью в файл
+CHUNK_SIZE = 10000
+# Формат выгрузки: "parquet" - GeoParquet (каталог частей) со списками в виде списков Arrow, "gpkg" - GPKG
+OUTPUT_FORMAT = "parquet"
+# Экспортировать итоговую выгрузку GeoParquet в GPKG (файл из schema["output"]), экспорт идёт по частям выгрузки
+EXPORT_GPKG = False
+
+# Описание выгружаемых слоёв: ключ - название слоя в NspdFeature.by_title,
+# key - поле с кадастровым номером для удаления дубликатов на границах тайлов,
+# fields - поля для выгрузки (имена совпадают с атрибутами properties.options)
+LAYERS = {
+    "Земельные участки из ЕГРН": {
+        "output": "land_plots.gpkg",
+        "key": "cad_num",
+        "desc": "Обработка участков",
+        "fields": [
+            "cad_num",
+            "quarter_cad_number",
+            "objdoc_id",
+            "registers_id",
+            "land_record_type",
+            "land_record_subtype",
+            "land_record_reg_date",
+            "readable_address",
+            "specified_area",
+            "declared_area",
+            "area",
+            "status",
+            "land_record_category_type",
+            "permitted_use_established_by_document",
+            "ownership_type",
+            "cost_value",
+            "cost_index",
+            "cost_application_date",
+            "cost_approvement_date",
+            "cost_determination_date",
+            "cost_registration_date",
+            "determination_couse",
+        ],
+    },
+    "Здания": {
+        "output": "buildings.gpkg",
+        "key": "cad_num",
+        "desc": "Обработка зданий",
+        "fields": [
+            "cad_num",
+            "quarter_cad_number",
+            "objdoc_id",
+            "registers_id",
+            "build_record_type_value",
+            "build_record_registration_date",
+            "readable_address",
+            "building_name",
+            "purpose",
+            "build_record_area",
+            "status",
+            "ownership_type",
+            "cost_value",
+            "cost_index",
+            "floors",
+            "underground_floors",
+            "materials",
+            "year_built",
+            "year_commisioning",
+            "cultural_heritage_object",
+            "united_cad_number",
+            "facility_cad_number",
+            "cost_application_date",
+            "cost_approvement_date",
+            "cost_determination_date",
+            "cost_registration_date",
+            "cultural_heritage_val",
+            "determination_couse",
+            "intersected_cad_numbers",
+            "permitted_use_name",
+            # "united_cad_numbers",  # выгружается списком, у всех значение NULL
+        ],
+    },
+    "Сооружения": {
+        "output": "installations.gpkg",
+        "key": "cad_number",
+        "desc": "Обработка сооружений",
+        "fields": [
+            "cad_number",
+            "quarter_cad_number",
+            # "objdoc_id",
+            # "registers_id",
+            "object_type_value",
+            "registration_date",
+            "address_readable_address",
+            "params_name",
+            "params_purpose",
+            "params_height",
+            "params_depth",
+            "params_occurence_depth",
+            "params_extension",
+            "params_volume",
+            "params_built_up_area",
+            "params_area",
+            "object_previously_posted",
+            "ownership_type",
+            "cost_value",
+            "cost_index",
+            "params_floors",
+            "params_underground_floors",
+            "params_year_built",
+            "params_year_commisioning",
+            # "cultural_heritage_object",
+            # "united_cad_number",
+            "facility_cad_number",
+            "cost_application_date",
+            "cost_approvement_date",
+            "cost_determination_date",
+            "cost_registration_date",
+            "cultural_heritage_val",
+            "determination_couse",
+            "permitted_uses_name",
+            # "right_type",  # не парсится
+            "status",
+        ],
+    },
+    "Объекты незавершенного строительства": {
+        "output": "unfinished_constructions.gpkg",
+        "key": "cad_num",
+        "desc": "Обработка объектов незавершенного строительства",
+        "fields": [
+            "cad_num",
+            "quarter_cad_number",
+            "objdoc_id",
+            "registers_id",
+            "object_under_construction_record_record_type_value",
+            "registration_date",
+            "readable_address",
+            "object_under_construction_record_name",
+            "height",
+            "depth",
+            "occurence_depth",
+            "extension",
+            "volume",
+            "built_up_area",
+            "common_data_status",
+            "ownership_type",
+            "cost_value",
+            "cost_index",
+            "degree_readiness",
+            "purpose",
+            "facility_cad_number",
+            "area",
+            "cost_application_date",
+            "cost_approvement_date",
+            "cost_determination_date",
+            "cost_registration_date",
+            "determination_couse",
+            "name",
+            "right_type",
+            "status",
+            "type_value",
+        ],
+    },
+}
+
+
+class NspdPool:
+    """Пул сессий Nspd, общий для потоков, выгружающих слои и тайлы."""
+
+    def __init__(self, size: int):
+        self._stack = ExitStack()
+        self._queue: Queue = Queue()
+        for _ in range(size):
+            self._queue.put(self._stack.enter_context(Nspd()))
+
+    @contextmanager
+    def session(self):
+        client = self._queue.get()
+        try:
+            yield client
+        finally:
+            self._queue.put(client)
+
+    def close(self):
+        self._stack.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def feature_to_record(feature, fields: list[str]) -> dict:
+    """Копирует поля объекта по описанию слоя, даты преобразуются в строки, списки остаются списками."""
+    options = feature.properties.options
+    record = {field: convert_date_to_str(getattr(options, field, None)) for field in fields}
+    record["geometry"] = feature.geometry.to_multi_shape()
+    return record
+
+
+def layer_path(schema: dict, suffix: str = "") -> str:
+    """Путь к файлу слоя в формате OUTPUT_FORMAT, suffix добавляется к имени (например, _delta)."""
+    stem = schema["output"].removesuffix(".gpkg")
+    return f"{stem}{suffix}.parquet" if OUTPUT_FORMAT == "parquet" else f"{stem}{suffix}.gpkg"
+
+
+def tiles_path(schema: dict, suffix: str = "") -> str:
+    """Путь к индексу тайлов слоя (TileIndex), suffix добавляется к имени (например, _delta)."""
+    return schema["output"].replace(".gpkg", f"{suffix}_tiles.json")
+
+
+def read_layer(path: str) -> gpd.GeoDataFrame:
+    if path.endswith(".parquet"):
+        return gpd.read_parquet(path)
+    return gpd.read_file(path, use_arrow=True)
+
+
+def lists_to_json(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """Преобразует списки (в том числе прочитанные из GeoParquet массивы) в JSON для записи в GPKG."""
+    gdf = gdf.copy()
+    for col in gdf.columns.drop(gdf.geometry.name):
+        if gdf[col].dtype == object:
+            gdf[col] = [
+                json.dumps(value.tolist() if isinstance(value, np.ndarray) else value)
+                if isinstance(value, (list, np.ndarray))
+                else value
+                for value in gdf[col]
+            ]
+    return gdf
+
+
+def write_layer(gdf: gpd.GeoDataFrame, path: str):
+    """Перезаписывает слой целиком."""
+    if path.endswith(".parquet"):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        gdf.to_parquet(os.path.join(path, "part-000000.parquet"))
+    else:
+        lists_to_json(gdf).to_file(path, driver="GPKG")
+
+
+def make_tiles(contour, size: float) -> list:
+    """Разбивает контур на регулярную сетку тайлов заданного размера."""
+    minx, miny, maxx, maxy = contour.bounds
+    tiles = []
+    for ix in range(math.ceil((maxx - minx) / size)):
+        for iy in range(math.ceil((maxy - miny) / size)):
+            tile = box(
+                minx + ix * size,
+                miny + iy * size,
+                min(minx + (ix + 1) * size, maxx),
+                min(miny + (iy + 1) * size, maxy),
             )
-
-    df = pd.DataFrame(data)
-    gdf = gpd.GeoDataFrame(df, geometry="geometry", crs="EPSG:4326")
-
-    output_gpkg = "land_plots.gpkg"
-    gdf.to_file(output_gpkg, driver="GPKG")
-
-    print(f"Данные сохранены в {output_gpkg}")
-
-# Парсинг зданий по контуру
-with Nspd() as nspd:
-    data = []
-
-    for i in tqdm(
-        nspd.search_in_contour_iter(contour_moscow, NspdFeature.by_title("Здания"), only_intersects=True), desc="Обработка зданий"
-    ):
-
-        if not i.properties.options.no_coords:
-            data.append(
-                {
-                    "cad_num": i.properties.options.cad_num,
-                    "quarter_cad_number": i.properties.options.quarter_cad_number,
-                    "objdoc_id": i.properties.options.objdoc_id,
-                    "registers_id": i.properties.options.registers_id,
-                    "build_record_type_value": i.properties.options.build_record_type_value,
-                    "build_record_registration_date": convert_date_to_str(i.properties.options.build_record_registration_date),
-                    "readable_address": i.properties.options.readable_address,
-                    "building_name": i.properties.options.building_name,
-                    "purpose": i.properties.options.purpose,
-                    "build_record_area": i.properties.options.build_record_area,
-                    "status": i.properties.options.status,
-                    "ownership_type": i.properties.options.ownership_type,
-                    "cost_value": i.properties.options.cost_value,
-                    "cost_index": i.properties.options.cost_index,
-                    "floors": i.properties.options.floors,
-                    "underground_floors": i.properties.options.underground_floors,
-                    "materials": i.properties.options.materials,
-                    "year_built": i.properties.options.year_built,
-                    "year_commisioning": i.properties.options.year_commisioning,
-                    "cultural_heritage_object": i.properties.options.cultural_heritage_object,
-                    "united_cad_number": i.properties.options.united_cad_number,
-                    "facility_cad_number": i.properties.options.facility_cad_number,
-                    "cost_application_date": convert_date_to_str(i.properties.options.cost_application_date),
-                    "cost_approvement_date": convert_date_to_str(i.properties.options.cost_approvement_date),
-                    "cost_determination_date": convert_date_to_str(i.properties.options.cost_determination_date),
-                    "cost_registration_date": convert_date_to_str(i.properties.options.cost_registration_date),
-                    "cultural_heritage_val": i.properties.options.cultural_heritage_val,
-                    "determination_couse": i.properties.options.determination_couse,
-                    "intersected_cad_numbers": i.properties.options.intersected_cad_numbers,
-                    "permitted_use_name": i.properties.options.permitted_use_name,
-                    # "united_cad_numbers": i.properties.options.united_cad_numbers, # выгружается списком, у всех значение NULL
-                    "geometry": i.geometry.to_multi_shape(),
-                }
-            )
-
-    df = pd.DataFrame(data)
-    for col in df.columns:
-        if df[col].apply(lambda x: isinstance(x, list)).any():
-            df[col] = df[col].apply(lambda x: json.dumps(x) if isinstance(x, list) else x)
-    gdf = gpd.GeoDataFrame(df, geometry="geometry", crs="EPSG:4326")
-
-    output_gpkg = "buildings.gpkg"
-    gdf.to_file(output_gpkg, driver="GPKG")
-
-    print(f"Данные сохранены в {output_gpkg}")
-
-
-# Парсинг сооружений по контуру
-with Nspd() as nspd:
-    data = []
-
-    for i in tqdm(
-        nspd.search_in_contour_iter(contour_moscow, NspdFeature.by_title("Сооружения"), only_intersects=True), desc="Обработка сооружений"
+            if not contour.intersects(tile):
+                continue
+            if not contour.contains(tile):
+                tile = tile.intersection(contour)
+            tiles.extend(getattr(tile, "geoms", [tile]))
+    return [tile for tile in tiles if tile.geom_type == "Polygon" and not tile.is_empty]
+
+
+def split_tile(tile) -> list:
+    """Делит тайл на 4 части."""
+    minx, miny, maxx, maxy = tile.bounds
+    return make_tiles(tile, max(maxx - minx, maxy - miny) / 2)
+
+
+def tile_key(tile) -> tuple:
+    """Ключ тайла в контрольной точке."""
+    return tuple(round(c, 6) for c in tile.bounds)
+
+
+def pending_tiles(tiles: list, is_done) -> list:
+    """
+    Тайлы, которые ещё предстоит выгрузить. Выгруженные тайлы (is_done(ключ) истинно) пропускаются,
+    раздробленные при предыдущем запуске заменяются своими частями.
+    """
+    result = []
+    for tile in tiles:
+        key = tile_key(tile)
+        if is_done(key):
+            continue
+        if is_done(("split", key)):
+            result.extend(pending_tiles(split_tile(tile), is_done))
+        else:
+            result.append(tile)
+    return result
+
+
+def normalize_value(value):
+    """Приводит значение к единому виду для хэширования: значения из файла и из NSPD должны совпадать."""
+    if hasattr(value, "tolist"):
+        value = value.tolist()
+    if isinstance(value, list):
+        # Списки в GPKG хранятся как JSON
+        return json.dumps(value)
+    if isinstance(value, float):
+        if math.isnan(value):
+            return None
+        if value.is_integer():
+            return int(value)
+    return value
+
+
+def content_hash(record: dict, fields: list[str]) -> str:
+    """Хэш атрибутов и геометрии объекта."""
+    values = json.dumps([normalize_value(record.get(field)) for field in fields], ensure_ascii=False, default=str)
+    geometry = record.get("geometry")
+    wkb = to_wkb(geometry, hex=True) if geometry is not None else ""
+    return hashlib.sha1(f"{values}|{wkb}".encode("utf-8")).hexdigest()
+
+
+def record_key(record: dict, schema: dict, record_hash: str):
+    """Кадастровый номер объекта, для объектов без номера - хэш содержимого."""
+    key = record.get(schema["key"])
+    return key if key is not None and key == key else record_hash
+
+
+def layer_keys(gdf: gpd.GeoDataFrame, schema: dict) -> list:
+    """Ключи объектов слоя (record_key) в порядке строк."""
+    return [record_key(record, schema, content_hash(record, schema["fields"])) for record in gdf.to_dict("records")]
+
+
+class TileIndex:
+    """Время выгрузки и хэш содержимого тайлов слоя, хранится в JSON рядом с выходным файлом."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tiles: dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.tiles = json.load(f)
+
+    def get(self, key) -> dict | None:
+        return self.tiles.get(json.dumps(key))
+
+    def update(self, key, records_hashes: list[str]):
+        tile_hash = hashlib.sha1("".join(sorted(records_hashes)).encode("utf-8")).hexdigest()
+        self.tiles[json.dumps(key)] = {"hash": tile_hash, "fetched_at": time.time()}
+
+    def is_fresh(self, key, max_age: float) -> bool:
+        entry = self.get(key)
+        return entry is not None and time.time() - entry["fetched_at"] < max_age
+
+    def save(self, path: str | None = None):
+        with open(path or self.path, "w", encoding="utf-8") as f:
+            json.dump(self.tiles, f)
+
+
+def harvest_tile(pool: NspdPool, tile, title: str, fields: list[str]) -> tuple[list[dict], bool, float]:
+    """
+    Выгрузка объектов слоя в пределах тайла с повторами при ошибках
+
+    Returns:
+        Список записей, признак плотного тайла (выгрузка прервана, тайл нужно раздробить), время выгрузки в секундах
+    """
+    minx, miny, maxx, maxy = tile.bounds
+    can_split = max(maxx - minx, maxy - miny) > TILE_MIN_SIZE
+    for attempt in range(TILE_RETRIES):
+        start_time = time.perf_counter()
+        records = []
+        count = 0
+        dense = False
+        try:
+            with pool.session() as nspd, metrics.stage("http"):
+                for i in nspd.search_in_contour_iter(tile, NspdFeature.by_title(title), only_intersects=True):
+                    count += 1
+                    if not i.properties.options.no_coords:
+                        records.append(feature_to_record(i, fields))
+                    if can_split and count >= TILE_MAX_FEATURES:
+                        dense = True
+                        break
+            elapsed = time.perf_counter() - start_time
+            # Запросы выполняет pynspd, поэтому задержка учитывается на уровне тайла
+            metrics.observe_request("nspd", elapsed, "ok", endpoint=title)
+            return records, dense, elapsed
+        except Exception as e:
+            metrics.observe_request("nspd", time.perf_counter() - start_time, "error", endpoint=title)
+            metrics.error("nspd", e)
+            if attempt == TILE_RETRIES - 1:
+                raise
+            metrics.count("retries", "nspd")
+            time.sleep(2**attempt)
+
+
+def iter_tiles(pool: NspdPool, executor: ThreadPoolExecutor, tiles: list, title: str, schema: dict):
+    """
+    Параллельная выгрузка тайлов, плотные тайлы дробятся и их части ставятся в очередь.
+
+    Yields:
+        Тайл, список записей (None при ошибке), признак раздробленного тайла, время выгрузки в секундах или ошибка
+    """
+    pending = {executor.submit(harvest_tile, pool, tile, title, schema["fields"]): tile for tile in tiles}
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            tile = pending.pop(future)
+            try:
+                records, dense, elapsed = future.result()
+            except Exception as e:
+                print(f"Ошибка при выгрузке тайла {tile_key(tile)}: {e}")
+                yield tile, None, False, e
+                continue
+
+            if dense:
+                for child in split_tile(tile):
+                    pending[executor.submit(harvest_tile, pool, child, title, schema["fields"])] = child
+            yield tile, records, dense, elapsed
+
+
+def tile_stats(tile, records, dense, elapsed, new_features: int, status: str | None = None) -> dict:
+    """Строка статистики по тайлу."""
+    if records is None:
+        return {"bounds": tile_key(tile), "status": "error", "features": 0, "new_features": 0, "seconds": None}
+    return {
+        "bounds": tile_key(tile),
+        "status": status or ("split" if dense else "ok"),
+        "features": len(records),
+        "new_features": new_features,
+        "seconds": elapsed,
+    }
+
+
+def harvest_layer(
+    pool: NspdPool, executor: ThreadPoolExecutor, contour, title: str, schema: dict, writer: StreamWriter
+) -> pd.DataFrame:
+    """
+    Выгрузка одного слоя по контуру, разбитому на тайлы.
+    Тайлы выгружаются параллельно, плотные тайлы дробятся, объекты на границах тайлов удаляются по кадастровому номеру.
+    Ошибка в одном тайле не прерывает выгрузку слоя.
+    Объекты записываются порциями через writer вместе с ключами выгруженных тайлов,
+    поэтому перезапущенная выгрузка продолжается с места остановки.
+
+    Args:
+        pool: Пул сессий Nspd
+        executor: Пул потоков для выгрузки тайлов
+        contour: Контур, в пределах которого выгружаются объекты
+        title: Название слоя в NspdFeature.by_title
+        schema: Описание слоя из LAYERS
+        writer: Потоковая запись объектов слоя
+
+    Returns:
+        DataFrame со статистикой по тайлам
+    """
+    # Кадастровые номера, записанные при предыдущих запусках, тоже участвуют в удалении дубликатов
+    seen = set(writer.read_column(schema["key"]))
+    stats = []
+    index = TileIndex(tiles_path(schema))
+
+    tiles = pending_tiles(make_tiles(contour, TILE_SIZE), writer.is_done)
+    with tqdm(desc=schema["desc"], unit=" объектов") as progress:
+        for tile, records, dense, elapsed in iter_tiles(pool, executor, tiles, title, schema):
+            if records is None:
+                stats.append(tile_stats(tile, records, dense, elapsed, 0))
+                continue
+
+            new_records = []
+            for record in records:
+                key = record.get(schema["key"])
+                if key is not None:
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                new_records.append(record)
+            # Объекты раздробленного тайла сохраняются, его части в контрольной точке восстанавливаются по ключу
+            key = ("split", tile_key(tile)) if dense else tile_key(tile)
+            with metrics.stage("write"):
+                writer.write(key, new_records)
+            index.update(key, [content_hash(record, schema["fields"]) for record in records])
+            progress.update(len(new_records))
+            stats.append(tile_stats(tile, records, dense, elapsed, len(new_records)))
+
+    writer.flush()
+    index.save()
+    return pd.DataFrame(stats, columns=["bounds", "status", "features", "new_features", "seconds"])
+
+
+def sync_layer(
+    pool: NspdPool, executor: ThreadPoolExecutor, contour, title: str, schema: dict, max_age: float | None = None
+) -> pd.DataFrame:
+    """
+    Инкрементальная синхронизация слоя с предыдущей выгрузкой (layer_path(schema)).
+    Объекты сопоставляются по кадастровому номеру и хэшу атрибутов и геометрии, в <файл>_delta
+    записываются только добавленные, изменённые и удалённые объекты (поле change), в <файл>_changes.csv - журнал
+    изменений. Тайлы, содержимое которых не изменилось, не сравниваются пообъектно, а тайлы, выгруженные
+    менее max_age секунд назад, не запрашиваются вовсе. Новые хэши тайлов сохраняются в <файл>_delta_tiles.json
+    и становятся индексом только при apply_delta, поэтому неприменённые изменения найдутся и при следующей
+    синхронизации.
+
+    Args:
+        pool: Пул сессий Nspd
+        executor: Пул потоков для выгрузки тайлов
+        contour: Контур, в пределах которого выгружаются объекты
+        title: Название слоя в NspdFeature.by_title
+        schema: Описание слоя из LAYERS
+        max_age: Время в секундах, в течение которого выгруженный тайл считается актуальным (None - выгружать все)
+
+    Returns:
+        DataFrame со статистикой по тайлам
+    """
+    output_path = layer_path(schema)
+    delta_path = layer_path(schema, "_delta")
+    changes_csv = schema["output"].replace(".gpkg", "_changes.csv")
+    for path in (delta_path, f"{delta_path}.checkpoint", tiles_path(schema, "_delta")):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    previous = read_layer(output_path) if os.path.exists(output_path) else None
+    previous_hashes = {}
+    previous_keys = []
+    if previous is not None:
+        for record in previous.to_dict("records"):
+            record_hash = content_hash(record, schema["fields"])
+            previous_keys.append(record_key(record, schema, record_hash))
+            previous_hashes[previous_keys[-1]] = record_hash
+
+    index = TileIndex(tiles_path(schema))
+    tiles = make_tiles(contour, TILE_SIZE)
+    if max_age is not None:
+        tiles = pending_tiles(tiles, lambda key: index.is_fresh(key, max_age))
+
+    writer = StreamWriter(delta_path, chunk_size=CHUNK_SIZE)
+    current_keys = set()
+    fetched_tiles = []
+    changes = []
+    stats = []
+    with tqdm(desc=schema["desc"], unit=" объектов") as progress:
+        for tile, records, dense, elapsed in iter_tiles(pool, executor, tiles, title, schema):
+            if records is None:
+                stats.append(tile_stats(tile, records, dense, elapsed, 0))
+                continue
+            progress.update(len(records))
+
+            key = ("split", tile_key(tile)) if dense else tile_key(tile)
+            if not dense:
+                fetched_tiles.append(tile)
+            hashes = [content_hash(record, schema["fields"]) for record in records]
+            previous_entry = index.get(key)
+            index.update(key, hashes)
+
+            # Содержимое тайла не изменилось - пообъектное сравнение не нужно
+            if previous_entry is not None and previous_entry["hash"] == index.get(key)["hash"]:
+                current_keys.update(record_key(record, schema, h) for record, h in zip(records, hashes))
+                stats.append(tile_stats(tile, records, dense, elapsed, 0, status="unchanged"))
+                continue
+
+            rows = []
+            for record, record_hash in zip(records, hashes):
+                object_key = record_key(record, schema, record_hash)
+                if object_key in current_keys:
+                    continue
+                current_keys.add(object_key)
+                if object_key not in previous_hashes:
+                    change = "insert"
+                elif previous_hashes[object_key] != record_hash:
+                    change = "update"
+                else:
+                    continue
+                rows.append({**record, "change": change})
+                changes.append({"key": object_key, "change": change, "tile": tile_key(tile)})
+            writer.write(key, rows)
+            stats.append(tile_stats(tile, records, dense, elapsed, len(rows)))
+
+    # Удалёнными считаются объекты предыдущей выгрузки внутри полностью выгруженных тайлов,
+    # которые не встретились сейчас
+    if previous is not None and fetched_tiles:
+        tree = STRtree(previous.geometry.representative_point().array)
+        deleted = set()
+        for tile in fetched_tiles:
+            for idx in tree.query(tile, predicate="contains").tolist():
+                if previous_keys[idx] not in current_keys:
+                    deleted.add(idx)
+        rows = [
+            {
+                **{k: v.tolist() if hasattr(v, "tolist") else v for k, v in previous.iloc[idx].to_dict().items()},
+                "change": "delete",
+            }
+            for idx in sorted(deleted)
+        ]
+        changes.extend({"key": previous_keys[idx], "change": "delete", "tile": None} for idx in sorted(deleted))
+        writer.write("deleted", rows)
+
+    writer.flush()
+    # Индекс тайлов описывает снимок layer_path(schema), поэтому обновляется только вместе с ним в apply_delta
+    index.save(tiles_path(schema, "_delta"))
+    changes_df = pd.DataFrame(changes, columns=["key", "change", "tile"])
+    changes_df["synced_at"] = pd.Timestamp.now().isoformat()
+    changes_df.to_csv(changes_csv, mode="a", header=not os.path.exists(changes_csv), index=False)
+    print(f"{title}: {changes_df['change'].value_counts().to_dict()}")
+    return pd.DataFrame(stats, columns=["bounds", "status", "features", "new_features", "seconds"])
+
+
+def apply_delta(schema: dict):
+    """
+    Применяет <файл>_delta к предыдущей выгрузке, чтобы она стала снимком для следующей синхронизации,
+    и заменяет индекс тайлов хэшами, посчитанными при синхронизации.
+    """
+    output_path = layer_path(schema)
+    delta_path = layer_path(schema, "_delta")
+    if os.path.exists(delta_path):
+        delta = read_layer(delta_path)
+        previous = read_layer(output_path) if os.path.exists(output_path) else delta.iloc[0:0]
+        # Объекты сопоставляются по тому же ключу, что и при синхронизации: объекты без кадастрового номера - по хэшу
+        delta_keys = set(layer_keys(delta, schema))
+        previous_keys = layer_keys(previous, schema)
+        previous = previous.loc[np.array([key not in delta_keys for key in previous_keys], dtype=bool)]
+        current = pd.concat([previous, delta[delta["change"] != "delete"].drop(columns="change")], ignore_index=True)
+        write_layer(gpd.GeoDataFrame(current, geometry="geometry", crs="EPSG:4326"), output_path)
+    # Индекс заменяется и при пустой дельте, чтобы обновилось время выгрузки неизменившихся тайлов
+    if os.path.exists(tiles_path(schema, "_delta")):
+        os.replace(tiles_path(schema, "_delta"), tiles_path(schema))
+
+
+def export_gpkg(schema: dict):
+    """Экспорт выгрузки GeoParquet в GPKG по частям, чтобы слой не читался в память целиком."""
+    output_path = layer_path(schema)
+    if not output_path.endswith(".parquet") or not os.path.isdir(output_path):
+        return
+    if os.path.exists(schema["output"]):
+        os.remove(schema["output"])
+    for name in sorted(os.listdir(output_path)):
+        if name.endswith(".parquet"):
+            part = gpd.read_parquet(os.path.join(output_path, name))
+            lists_to_json(part).to_file(schema["output"], driver="GPKG", mode="a")
+
+
+def harvest_layers(contour, layers: dict = LAYERS, workers: int = 8):
+    """
+    Параллельная выгрузка слоёв по контуру, каждый слой дописывается в свой файл порциями,
+    статистика по тайлам - в CSV рядом с ним. Прерванная выгрузка при повторном запуске продолжается
+    по контрольной точке (<файл>.checkpoint), для выгрузки с нуля файл и контрольную точку нужно удалить.
+
+    Args:
+        contour: Контур, в пределах которого выгружаются объекты
+        layers: Описание выгружаемых слоёв
+        workers: Число одновременно выгружаемых тайлов (и сессий Nspd)
+    """
+    with (
+        NspdPool(workers) as pool,
+        ThreadPoolExecutor(max_workers=workers) as tile_executor,
+        ThreadPoolExecutor(max_workers=len(layers)) as layer_executor,
     ):
-
-        if not i.properties.options.no_coords:
-            data.append(
-                {
-                    "cad_number": i.properties.options.cad_number,
-                    "quarter_cad_number": i.properties.options.quarter_cad_number,
-                    # "objdoc_id": i.properties.options.objdoc_id,
-                    # "registers_id": i.properties.options.registers_id,
-                    "object_type_value": i.properties.options.object_type_value,
-                    "registration_date": convert_date_to_str(i.properties.options.registration_date),
-                    "address_readable_address": i.properties.options.address_readable_address,
-                    "params_name": i.properties.options.params_name,
-                    "params_purpose": i.properties.options.params_purpose,
-                    "params_height": i.properties.options.params_height,
-                    "params_depth": i.properties.options.params_depth,
-                    "params_occurence_depth": i.properties.options.params_occurence_depth,
-                    "params_extension": i.properties.options.params_extension,
-                    "params_volume": i.properties.options.params_volume,
-                    "params_built_up_area": i.properties.options.params_built_up_area,
-                    "params_area": i.properties.options.params_area,
-                    "object_previously_posted": i.properties.options.object_previously_posted,
-                    "ownership_type": i.properties.options.ownership_type,
-                    "cost_value": i.properties.options.cost_value,
-                    "cost_index": i.properties.options.cost_index,
-                    "params_floors": i.properties.options.params_floors,
-                    "params_underground_floors": i.properties.options.params_underground_floors,
-                    "params_year_built": i.properties.options.params_year_built,
-                    "params_year_commisioning": i.properties.options.params_year_commisioning,
-                    # "cultural_heritage_object": i.properties.options.cultural_heritage_object,
-                    # "united_cad_number": i.properties.options.united_cad_number,
-                    "facility_cad_number": i.properties.options.facility_cad_number,
-                    "cost_application_date": convert_date_to_str(i.properties.options.cost_application_date),
-                    "cost_approvement_date": convert_date_to_str(i.properties.options.cost_approvement_date),
-                    "cost_determination_date": convert_date_to_str(i.properties.options.cost_determination_date),
-                    "cost_registration_date": convert_date_to_str(i.properties.options.cost_registration_date),
-                    "cultural_heritage_val": i.properties.options.cultural_heritage_val,
-                    "determination_couse": i.properties.options.determination_couse,
-                    "permitted_uses_name": i.properties.options.permitted_uses_name,
-                    # "right_type": i.properties.options.right_type, # не парсится
-                    "status": i.properties.options.status,
-                    "geometry": i.geometry.to_multi_shape(),
-                }
+        writers = {title: StreamWriter(layer_path(schema), chunk_size=CHUNK_SIZE) for title, schema in layers.items()}
+        futures = {
+            title: layer_executor.submit(harvest_layer, pool, tile_executor, contour, title, schema, writers[title])
+            for title, schema in layers.items()
+        }
+        for title, future in futures.items():
+            stats = future.result()
+            stats_csv = layers[title]["output"].replace(".gpkg", "_tiles.csv")
+            stats.to_csv(stats_csv, mode="a", header=not os.path.exists(stats_csv), index=False)
+            errors = (stats["status"] == "error").sum()
+            print(
+                f"Данные сохранены в {writers[title].path}: новых объектов {writers[title].written}, "
+                f"тайлов {len(stats)}, ошибок {errors}, суммарное время тайлов {stats['seconds'].sum():.0f} с"
             )
-
-    df = pd.DataFrame(data)
-    for col in df.columns:
-        if df[col].apply(lambda x: isinstance(x, list)).any():
-            df[col] = df[col].apply(lambda x: json.dumps(x) if isinstance(x, list) else x)
-    gdf = gpd.GeoDataFrame(df, geometry="geometry", crs="EPSG:4326")
-
-    output_gpkg = "installations.gpkg"
-    gdf.to_file(output_gpkg, driver="GPKG")
-
-    print(f"Данные сохранены в {output_gpkg}")
-
-
-# Парсинг объектов незавершенного строительства по контуру
-with Nspd() as nspd:
-    data = []
-
-    for i in tqdm(
-        nspd.search_in_contour_iter(contour_moscow, NspdFeature.by_title("Объекты незавершенного строительства"), only_intersects=True),
-        desc="Обработка объектов незавершенного строительства",
+            if EXPORT_GPKG:
+                export_gpkg(layers[title])
+
+
+def sync_layers(
+    contour, layers: dict = LAYERS, workers: int = 8, max_age: float | None = None, apply: bool = False
+):
+    """
+    Параллельная инкрементальная синхронизация слоёв с предыдущей выгрузкой
+
+    Args:
+        contour: Контур, в пределах которого выгружаются объекты
+        layers: Описание выгружаемых слоёв
+        workers: Число одновременно выгружаемых тайлов (и сессий Nspd)
+        max_age: Время в секундах, в течение которого выгруженный тайл считается актуальным (None - выгружать все)
+        apply: Применить изменения к предыдущей выгрузке
+    """
+    with (
+        NspdPool(workers) as pool,
+        ThreadPoolExecutor(max_workers=workers) as tile_executor,
+        ThreadPoolExecutor(max_workers=len(layers)) as layer_executor,
     ):
-
-        if not i.properties.options.no_coords:
-            data.append(
-                {
-                    "cad_num": i.properties.options.cad_num,
-                    "quarter_cad_number": i.properties.options.quarter_cad_number,
-                    "objdoc_id": i.properties.options.objdoc_id,
-                    "registers_id": i.properties.options.registers_id,
-                    "object_under_construction_record_record_type_value": i.properties.options.object_under_construction_record_record_type_value,
-                    "registration_date": convert_date_to_str(i.properties.options.registration_date),
-                    "readable_address": i.properties.options.readable_address,
-                    "object_under_construction_record_name": i.properties.options.object_under_construction_record_name,
-                    "height": i.properties.options.height,
-                    "depth": i.properties.options.depth,
-                    "occurence_depth": i.properties.options.occurence_depth,
-                    "extension": i.properties.options.extension,
-                    "volume": i.properties.options.volume,
-                    "built_up_area": i.properties.options.built_up_area,
-                    "common_data_status": i.properties.options.common_data_status,
-                    "ownership_type": i.properties.options.ownership_type,
-                    "cost_value": i.properties.options.cost_value,
-                    "cost_index": i.properties.options.cost_index,
-                    "degree_readiness": i.properties.options.degree_readiness,
-                    "purpose": i.properties.options.purpose,
-                    "facility_cad_number": i.properties.options.facility_cad_number,
-                    "area": i.properties.options.area,
-                    "cost_application_date": convert_date_to_str(i.properties.options.cost_application_date),
-                    "cost_approvement_date": convert_date_to_str(i.properties.options.cost_approvement_date),
-                    "cost_determination_date": convert_date_to_str(i.properties.options.cost_determination_date),
-                    "cost_registration_date": convert_date_to_str(i.properties.options.cost_registration_date),
-                    "determination_couse": i.properties.options.determination_couse,
-                    "name": i.properties.options.name,
-                    "right_type": i.properties.options.right_type,
-                    "status": i.properties.options.status,
-                    "type_value": i.properties.options.type_value,
-                    "geometry": i.geometry.to_multi_shape(),
-                }
-            )
-
-    df = pd.DataFrame(data)
-    for col in df.columns:
-        if df[col].apply(lambda x: isinstance(x, list)).any():
-            df[col] = df[col].apply(lambda x: json.dumps(x) if isinstance(x, list) else x)
-    gdf = gpd.GeoDataFrame(df, geometry="geometry", crs="EPSG:4326")
-
-    output_gpkg = "unfinished_constructions.gpkg"
-    gdf.to_file(output_gpkg, driver="GPKG")
-
-    print(f"Данные сохранены в {output_gpkg}")
+        futures = {
+            title: layer_executor.submit(sync_layer, pool, tile_executor, contour, title, schema, max_age)
+            for title, schema in layers.items()
+        }
+        for title, future in futures.items():
+            stats = future.result()
+            print(f"{title}: тайлов {len(stats)}, без изменений {(stats['status'] == 'unchanged').sum()}")
+            if apply:
+                apply_delta(layers[title])
+                if EXPORT_GPKG:
+                    export_gpkg(layers[title])
+
+
+if __name__ == "__main__":
+    # Пример использования
+    harvest_layers(contour_moscow)
+    metrics.to_json("nspd_metrics.json")
+    # Еженедельное обновление: выгружаются только изменения относительно предыдущей выгрузки
+    # sync_layers(contour_moscow, max_age=6 * 24 * 3600, apply=True)
@@ -0,0 +1,137 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely import STRtree, box, distance
+
+# Имена столбцов таблицы пар: идентификаторы точек начала и конца, как в результатах построения маршрутов
+OD_FROM = "from"
+OD_TO = "to"
+
+
+def select_pairs(
+    gdf_start: gpd.GeoDataFrame,
+    start_field_name: str,
+    gdf_end: gpd.GeoDataFrame,
+    end_field_name: str,
+    od: pd.DataFrame | None = None,
+    max_distance: float | None = None,
+    k_nearest: int | None = None,
+    exclude_self: bool = False,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Отбор пар точек начала и конца маршрутов, которые имеет смысл отправлять маршрутизатору.
+    Без параметров отбора возвращает все сочетания gdf_start x gdf_end.
+
+    Расстояния считаются по прямой в метрической системе координат, ближайшие точки ищутся через STRtree.
+    Для k_nearest радиус поиска удваивается, пока у каждой точки начала не найдётся k кандидатов,
+    поэтому результат точный без перебора всех пар.
+
+    Args:
+        gdf_start: GeoDataFrame с точками начала маршрутов
+        start_field_name: Имя поля с идентификатором точек начала маршрутов
+        gdf_end: GeoDataFrame с точками конца маршрутов
+        end_field_name: Имя поля с идентификатором точек конца маршрутов
+        od: Таблица пар со столбцами from и to (идентификаторы точек), None - все сочетания
+        max_distance: Максимальное расстояние по прямой между точками пары, м (None - без ограничения)
+        k_nearest: Число ближайших точек конца для каждой точки начала (None - без ограничения)
+        exclude_self: Исключать пары с одинаковыми идентификаторами начала и конца
+
+    Returns:
+        Порядковые номера точек начала и точек конца отобранных пар, упорядоченные по началу и концу
+    """
+    if gdf_start.empty or gdf_end.empty:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    # Метрическая проекция нужна только для отбора по расстоянию
+    if max_distance is not None or k_nearest is not None:
+        crs = gdf_start.estimate_utm_crs()
+        start_geoms = np.asarray(gdf_start.geometry.to_crs(crs).array, dtype=object)
+        end_geoms = np.asarray(gdf_end.geometry.to_crs(crs).array, dtype=object)
+    start_ids = gdf_start[start_field_name].to_numpy()
+    end_ids = gdf_end[end_field_name].to_numpy()
+
+    if od is not None:
+        # Идентификаторы переводятся в порядковые номера, при повторах используется первая точка
+        start_pos = pd.Series(np.arange(len(gdf_start)), index=start_ids)
+        end_pos = pd.Series(np.arange(len(gdf_end)), index=end_ids)
+        start_pos = start_pos[~start_pos.index.duplicated()]
+        end_pos = end_pos[~end_pos.index.duplicated()]
+        i = start_pos.reindex(od[OD_FROM].to_numpy()).to_numpy()
+        j = end_pos.reindex(od[OD_TO].to_numpy()).to_numpy()
+        known = ~(np.isnan(i) | np.isnan(j))
+        if not known.all():
+            print(f"Пары с неизвестными идентификаторами пропущены: {(~known).sum()}")
+        i, j = i[known].astype(np.int64), j[known].astype(np.int64)
+    elif max_distance is not None:
+        i, j = STRtree(end_geoms).query(start_geoms, predicate="dwithin", distance=max_distance)
+    elif k_nearest is not None:
+        i, j = nearest_candidates(start_geoms, end_geoms, start_ids, end_ids, k_nearest, exclude_self)
+    else:
+        i = np.repeat(np.arange(len(gdf_start)), len(gdf_end))
+        j = np.tile(np.arange(len(gdf_end)), len(gdf_start))
+
+    keep = np.ones(len(i), dtype=bool)
+    if exclude_self:
+        keep &= start_ids[i] != end_ids[j]
+    if max_distance is not None or k_nearest is not None:
+        lengths = distance(start_geoms[i], end_geoms[j])
+        if max_distance is not None:
+            keep &= lengths <= max_distance
+    i, j = i[keep], j[keep]
+
+    if k_nearest is not None:
+        lengths = lengths[keep]
+        order = np.lexsort((j, lengths, i))
+        i, j = i[order], j[order]
+        group_start = np.searchsorted(i, i)
+        rank = np.arange(len(i)) - group_start
+        i, j = i[rank < k_nearest], j[rank < k_nearest]
+
+    order = np.lexsort((j, i))
+    total = len(gdf_start) * len(gdf_end)
+    print(f"Отобрано пар: {len(order)} из {total}")
+    return i[order], j[order]
+
+
+def nearest_candidates(
+    start_geoms: np.ndarray,
+    end_geoms: np.ndarray,
+    start_ids: np.ndarray,
+    end_ids: np.ndarray,
+    k: int,
+    exclude_self: bool,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Кандидаты для отбора k ближайших: все точки конца в радиусе, внутри которого у точки начала не меньше k точек.
+    Радиус начинается с оценки по средней плотности точек конца и удваивается для точек, которым не хватило кандидатов.
+    """
+    if len(end_geoms) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    tree = STRtree(end_geoms)
+    xmin, ymin, xmax, ymax = gpd.GeoSeries(end_geoms).total_bounds
+    diagonal = np.hypot(xmax - xmin, ymax - ymin)
+    # Дальше этого радиуса от точки начала точек конца нет (NaN для пустых геометрий)
+    max_radius = diagonal + distance(start_geoms, box(xmin, ymin, xmax, ymax))
+    radius = max(np.sqrt((xmax - xmin) * (ymax - ymin) * k / max(len(end_geoms), 1)), diagonal / 1000, 1.0)
+
+    remaining = np.arange(len(start_geoms))
+    found_i, found_j = [], []
+    while len(remaining):
+        i, j = tree.query(start_geoms[remaining], predicate="dwithin", distance=radius)
+        i = remaining[i]
+        if exclude_self:
+            other = start_ids[i] != end_ids[j]
+            i, j = i[other], j[other]
+        counts = np.bincount(i, minlength=len(start_geoms))[remaining]
+        # Радиус охватывает все точки конца - кандидатов больше не станет
+        done = (counts >= k) | ~(radius <= max_radius[remaining])
+        done_starts = np.zeros(len(start_geoms), dtype=bool)
+        done_starts[remaining[done]] = True
+        found_i.append(i[done_starts[i]])
+        found_j.append(j[done_starts[i]])
+        remaining = remaining[~done]
+        radius *= 2
+
+    if not found_i:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(found_i), np.concatenate(found_j)
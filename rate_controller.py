@@ -0,0 +1,187 @@
+import random
+import threading
+import time
+
+# Коды ответа, означающие перегрузку сервера или превышение лимита запросов
+OVERLOAD_STATUSES = {429, 503}
+# Во сколько раз уменьшается допустимое число запросов в работе при перегрузке
+DECREASE_FACTOR = 0.5
+# Вес нового замера в скользящем среднем задержки
+LATENCY_SMOOTHING = 0.2
+
+
+class ServiceUnavailable(Exception):
+    """Ответ 503, переданный контроллеру без повторов внутри клиента."""
+
+    def __init__(self, status: int, message: str | None = None):
+        self.status = status
+        self.message = message
+
+    def __str__(self):
+        return f"{self.status} ({self.message})"
+
+
+def raise_unavailable(response, *args, **kwargs):
+    """
+    Обработчик ответов requests (hooks={"response": ...}), пробрасывающий 503 сразу.
+    routingpy сам повторяет запрос при 503 до истечения retry_timeout, и параметр retry_over_query_limit
+    на это не влияет: без обработчика сервер простаивает, а затем получает пачку повторов.
+    """
+    if response.status_code == 503:
+        raise ServiceUnavailable(response.status_code, response.text)
+
+
+def is_overload(error: Exception) -> bool:
+    """Признак перегрузки по исключению клиента: код ответа в OVERLOAD_STATUSES или OverQueryLimit routingpy."""
+    return getattr(error, "status", None) in OVERLOAD_STATUSES or type(error).__name__ == "OverQueryLimit"
+
+
+class RateController:
+    """
+    Адаптивное ограничение числа одновременных запросов к внешнему API по схеме AIMD.
+
+    Каждый успешный ответ увеличивает допустимое число запросов в работе примерно на единицу за «окно»
+    (на 1/limit за ответ), ответ о перегрузке (429/503) или задержка выше target_latency уменьшает его вдвое.
+    Уменьшение происходит не чаще одного раза за среднюю задержку ответа, чтобы пачка отказов от запросов,
+    отправленных до снижения, не обрушила лимит до минимума. После перегрузки все потоки делают паузу
+    с экспоненциально растущей случайной длительностью (full jitter), а бюджет rps ограничивает частоту запросов.
+
+    Один контроллер следует использовать для всех потоков и скриптов, обращающихся к одному серверу
+    (см. shared_controller).
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 16,
+        min_concurrency: int = 1,
+        initial_concurrency: int | None = None,
+        rps: float | None = None,
+        target_latency: float | None = None,
+        max_retries: int = 5,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+    ):
+        """
+        Args:
+            max_concurrency: Максимальное число запросов в работе
+            min_concurrency: Минимальное число запросов в работе
+            initial_concurrency: Начальное число запросов в работе (None - min(4, max_concurrency))
+            rps: Максимальное число запросов в секунду (None - без ограничения)
+            target_latency: Задержка ответа в секундах, выше которой число запросов уменьшается (None - не учитывается)
+            max_retries: Число повторов запроса при перегрузке
+            backoff_base: Начальная длительность паузы после перегрузки, с
+            backoff_max: Максимальная длительность паузы, с
+        """
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(initial_concurrency or min(4, max_concurrency))
+        self.rps = rps
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.requests = 0
+        self.overloads = 0
+        self.latency: float | None = None
+
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._next_request = 0.0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+
+    def acquire(self):
+        """
+        Ждёт очереди по бюджету rps, окончания паузы после перегрузки и свободного места среди запросов в работе.
+        Место занимается только после ожидания, чтобы пауза не уменьшала число запросов, доступных после неё.
+        """
+        with self._cond:
+            now = time.monotonic()
+            start = now
+            if self.rps is not None:
+                start = max(now, self._next_request)
+                self._next_request = start + 1 / self.rps
+        if start > now:
+            time.sleep(start - now)
+        with self._cond:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    self._cond.wait(pause)
+                elif self._in_flight >= int(self.limit):
+                    self._cond.wait()
+                else:
+                    break
+            self._in_flight += 1
+
+    def release(self, latency: float, overloaded: bool = False):
+        """Освобождает место и пересчитывает лимит по результату запроса."""
+        with self._cond:
+            self._in_flight -= 1
+            self.requests += 1
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+
+            slow = self.target_latency is not None and latency > self.target_latency
+            if overloaded or slow:
+                self.overloads += overloaded
+                now = time.monotonic()
+                if now - self._last_decrease > self.latency:
+                    self.limit = max(self.min_concurrency, self.limit * DECREASE_FACTOR)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def backoff(self, attempt: int) -> float:
+        """Назначает общую паузу после перегрузки и возвращает её длительность."""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        return delay
+
+    def run(self, func, *args, **kwargs):
+        """
+        Выполняет запрос под управлением контроллера, повторяя его при перегрузке.
+        Остальные ошибки пробрасываются без повторов и не меняют лимит.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            start_time = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                overloaded = is_overload(e)
+                self.release(time.perf_counter() - start_time, overloaded=overloaded)
+                if overloaded and attempt < self.max_retries:
+                    self.backoff(attempt)
+                    continue
+                raise
+            self.release(time.perf_counter() - start_time)
+            return result
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "limit": round(self.limit, 2),
+                "in_flight": self._in_flight,
+                "requests": self.requests,
+                "overloads": self.overloads,
+                "latency": self.latency,
+            }
+
+
+# Контроллеры по именам серверов, общие для всех скриптов процесса
+_controllers: dict[str, RateController] = {}
+_controllers_lock = threading.Lock()
+
+
+def shared_controller(name: str, **kwargs) -> RateController:
+    """Возвращает общий контроллер для сервера name, при первом обращении создаёт его с параметрами kwargs."""
+    with _controllers_lock:
+        if name not in _controllers:
+            _controllers[name] = RateController(**kwargs)
+        return _controllers[name]
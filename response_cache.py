@@ -0,0 +1,114 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class ResponseCache:
+    """
+    Постоянный кэш ответов API маршрутизации в SQLite.
+    Используется скриптами route_by_valhalla.py, isochrone_by_valhalla.py и route_by_2gis.py,
+    чтобы при повторном запуске запрашивались только новые пары точек.
+
+    Ключ записи строится из провайдера, параметров запроса и координат, округлённых до precision знаков.
+    Значения хранятся в JSON, поэтому в кэш следует класть только сериализуемые данные.
+    """
+
+    def __init__(
+        self,
+        path: str = "responses_cache.sqlite",
+        precision: int = 6,
+        ttl: float | None = None,
+        max_entries: int | None = None,
+    ):
+        """
+        Args:
+            path: Путь к файлу SQLite
+            precision: Число знаков после запятой при округлении координат в ключе
+            ttl: Время жизни записи в секундах (None - бессрочно)
+            max_entries: Максимальное число записей, при превышении удаляются самые старые (None - без ограничения)
+        """
+        self.path = path
+        self.precision = precision
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # Кэш используется из нескольких потоков, поэтому доступ к соединению защищён блокировкой
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+        self._conn.commit()
+
+    def make_key(self, provider: str, options, coords) -> str:
+        """Формирует ключ записи по провайдеру, параметрам запроса и округлённым координатам."""
+        rounded = [[round(float(c), self.precision) for c in coord] for coord in coords]
+        raw = json.dumps([provider, options, rounded], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, provider: str, options, coords):
+        """Возвращает сохранённое значение или None, если записи нет или она устарела."""
+        key = self.make_key(provider, options, coords)
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and time.time() - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, provider: str, options, coords, value):
+        """Сохраняет значение и при необходимости удаляет самые старые записи."""
+        key = self.make_key(provider, options, coords)
+        raw = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at) VALUES (?, ?, ?)", (key, raw, time.time())
+            )
+            if self.max_entries is not None:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+            self._conn.commit()
+
+    def evict_expired(self) -> int:
+        """Удаляет все устаревшие записи и возвращает их количество."""
+        if self.ttl is None:
+            return 0
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+            self._conn.commit()
+        return cursor.rowcount
+
+    def stats(self) -> dict:
+        """Статистика обращений к кэшу."""
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,11 +1,25 @@
+import asyncio
+import contextlib
+import json
+import time
+from collections import deque
+from urllib.parse import urlparse
+
 import geopandas as gpd
+import pandas as pd
 import requests
-from shapely.geometry import LineString
+from shapely import STRtree, from_wkt, get_exterior_ring, get_coordinates, simplify
+from shapely.geometry import LineString, box
 from shapely.ops import linemerge
-from shapely.wkt import loads as load_wkt
+
+from metrics import metrics
+from od_pairs import select_pairs
+from response_cache import ResponseCache
+from stream_writer import StreamWriter
 
 # Параметры запросов
 url = "https://server_with_api.com/routing/7.0.0/global"
+matrix_url = "https://server_with_api.com/get_dist_matrix"
 key_2gis = "0a0bcd00-00f0-00e0-f000-00gh0i00000j"
 
 # Параметры построения маршрутов
@@ -16,27 +30,289 @@ OUTPUT = "detailed"
 LOCALE = "ru"
 ALTERNATIVE = 0
 
+# Параметры построения матрицы расстояний
+MATRIX_VERSION = "2.0"
+MATRIX_TYPE = "statistics"
+# Размер блока матрицы (источники x назначения) в пределах ограничений API
+MATRIX_MAX_SOURCES = 25
+MATRIX_MAX_TARGETS = 25
+
+# Параметры HTTP-клиента
+TIMEOUT = 30
+MAX_RETRIES = 5
+RETRY_BACKOFF = 1  # задержка перед первым повтором в секундах, далее удваивается
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
 # --------------------
-exclude_polygons = []
-# Раскомментировать, если необходимо задать области, которые следует избегать при построении маршрута
-# gdf_exclude_polygons = (
-#     gpd.read_file("polygons_to_avoid.gpkg", use_arrow=True).to_crs("EPSG:4326").explode().reset_index(drop=True)
-# )
-# exclude_polygons = []
-# for geom in gdf_exclude_polygons.geometry:
-#     coords = [{"lon": x, "lat": y} for x, y in geom.exterior.coords]
-#     exclude_polygons.append(
-#         {
-#             "points": coords,
-#             "type": "polygon",
-#             "severity": "hard",
-#         }
-#     )
+
+
+class ExcludePolygons:
+    """
+    Области, которые следует избегать при построении маршрута.
+    Полигоны упрощаются один раз и индексируются в STRtree, поэтому в каждый запрос попадают
+    только полигоны рядом с коридором между началом и концом маршрута.
+    """
+
+    def __init__(self, gdf: gpd.GeoDataFrame, simplify_tolerance: float = 0.0001, corridor_buffer: float = 0.05):
+        """
+        Args:
+            gdf: GeoDataFrame с полигонами, которые следует избегать
+            simplify_tolerance: Допуск упрощения полигонов в градусах (0 - без упрощения)
+            corridor_buffer: Буфер вокруг прямоугольника, охватывающего начало и конец маршрута, в градусах
+        """
+        geoms = gdf.to_crs("EPSG:4326").explode().reset_index(drop=True).geometry.array
+        if simplify_tolerance:
+            geoms = simplify(geoms, simplify_tolerance, preserve_topology=True)
+        self.geoms = geoms
+        self.corridor_buffer = corridor_buffer
+        self.tree = STRtree(geoms)
+        # Сериализованные полигоны, чтобы не формировать их заново для каждой пары
+        self._payloads: dict[int, dict] = {}
+
+    def _payload(self, idx: int) -> dict:
+        if idx not in self._payloads:
+            coords = get_coordinates(get_exterior_ring(self.geoms[idx]))
+            self._payloads[idx] = {
+                "points": [{"lon": x, "lat": y} for x, y in coords.tolist()],
+                "type": "polygon",
+                "severity": "hard",
+            }
+        return self._payloads[idx]
+
+    def for_pair(self, start, end) -> list[dict]:
+        """Полигоны для запроса маршрута от точки start до точки end."""
+        corridor = box(
+            min(start.x, end.x), min(start.y, end.y), max(start.x, end.x), max(start.y, end.y)
+        ).buffer(self.corridor_buffer)
+        return [self._payload(idx) for idx in sorted(self.tree.query(corridor).tolist())]
+
+
+def route_geometry(route: dict):
+    """
+    Собирает геометрию маршрута из ответа 2ГИС: пеший путь до начала, участки манёвров и пеший путь от конца.
+    Все WKT маршрута разбираются одним векторизованным вызовом from_wkt.
+    """
+    selections = []
+    begin_pedestrian_path = route.get("begin_pedestrian_path", {})
+    if begin_pedestrian_path:
+        selections.append(begin_pedestrian_path.get("geometry", {}).get("selection"))
+    for man in route.get("maneuvers", []):
+        out_path = man.get("outcoming_path", {})
+        selections.extend(geom.get("selection") for geom in out_path.get("geometry", []))
+    end_pedestrian_path = route.get("end_pedestrian_path", {})
+    if end_pedestrian_path:
+        selections.append(end_pedestrian_path.get("geometry", {}).get("selection"))
+
+    # порой при переходе с пешего пути на автомобильный встречаются линии из одной точки,
+    # такие WKT не разбираются и пропускаются
+    parts = [line for line in from_wkt(selections, on_invalid="ignore") if line is not None]
+
+    if len(parts) == 1:
+        return parts[0]
+    return linemerge(parts)
+
+
+def post_request(session: requests.Session, endpoint: str, payload: dict, params: dict) -> dict | None:
+    """Синхронный запрос к API с повторами при 429/5xx и сетевых ошибках."""
+    path = urlparse(endpoint).path
+    for attempt in range(MAX_RETRIES + 1):
+        start_time = time.perf_counter()
+        try:
+            with metrics.stage("http"):
+                response = session.post(endpoint, params=params, json=payload, timeout=TIMEOUT)
+        except requests.RequestException as e:
+            metrics.observe_request("2gis", time.perf_counter() - start_time, "error", endpoint=path)
+            metrics.error("2gis", e)
+            if attempt == MAX_RETRIES:
+                print(f"Unexpected error: {e}")
+                return None
+            metrics.count("retries", "2gis")
+            time.sleep(RETRY_BACKOFF * 2**attempt)
+            continue
+
+        metrics.observe_request(
+            "2gis",
+            response.elapsed.total_seconds(),
+            response.status_code,
+            endpoint=path,
+            sent=len(response.request.body or b""),
+            received=len(response.content),
+        )
+        if response.status_code in RETRY_STATUSES and attempt < MAX_RETRIES:
+            metrics.count("retries", "2gis")
+            time.sleep(RETRY_BACKOFF * 2**attempt)
+            continue
+        if response.status_code != 200:
+            print(f"Ошибка: {response.status_code}")
+            print(response.text)
+        try:
+            return response.json()
+        except ValueError as e:
+            # Ответ не в JSON (HTML-страница прокси, пустое тело) считается неудачным запросом
+            metrics.error("2gis", e)
+            print(f"Ответ не в формате JSON: {e}")
+            return None
+
+
+async def post_request_async(
+    session, endpoint: str, payload: dict, params: dict, limit: asyncio.Semaphore | None = None
+) -> dict | None:
+    """
+    Асинхронный запрос к API с повторами при 429/5xx и сетевых ошибках.
+    Запрос отправляется только после получения места в limit (None - без ограничения, кроме пула соединений),
+    поэтому TIMEOUT и задержка в metrics отсчитываются от отправки запроса, а не от ожидания соединения.
+    Пауза перед повтором места не занимает.
+    """
+    import aiohttp
+
+    path = urlparse(endpoint).path
+    sent = len(json.dumps(payload))
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt:
+            metrics.count("retries", "2gis")
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+        async with limit or contextlib.nullcontext():
+            start_time = time.perf_counter()
+            try:
+                async with session.post(endpoint, params=params, json=payload) as response:
+                    status, body = response.status, await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.observe_request("2gis", time.perf_counter() - start_time, "error", endpoint=path)
+                metrics.error("2gis", e)
+                if attempt == MAX_RETRIES:
+                    print(f"Unexpected error: {e}")
+                    return None
+                continue
+
+        metrics.observe_request("2gis", time.perf_counter() - start_time, status, path, sent=sent, received=len(body))
+        if status in RETRY_STATUSES and attempt < MAX_RETRIES:
+            continue
+        if status != 200:
+            print(f"Ошибка: {status}")
+            print(body.decode("utf-8", errors="replace"))
+        try:
+            return json.loads(body)
+        except ValueError as e:
+            # Ответ не в JSON (HTML-страница прокси, пустое тело) считается неудачным запросом
+            metrics.error("2gis", e)
+            print(f"Ответ не в формате JSON: {e}")
+            return None
+
+
+async def open_async_session(concurrency: int):
+    """
+    Сессия aiohttp с общим пулом соединений и keep-alive.
+    Число одновременных соединений (и запросов в работе) ограничено concurrency.
+    """
+    import aiohttp
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=TIMEOUT))
+
+
+async def post_requests_async(
+    session, endpoint: str, payloads: list[dict], params: dict, concurrency: int
+) -> list[dict | None]:
+    """
+    Параллельные запросы к API, порядок ответов совпадает с порядком payloads.
+    Одновременно отправляется не больше concurrency запросов, остальные ждут, не расходуя TIMEOUT.
+    """
+    limit = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(
+        *(post_request_async(session, endpoint, payload, params, limit) for payload in payloads)
+    )
+
+
+def fetch_routes(payloads: list[dict], cache: ResponseCache | None, concurrency: int):
+    """
+    Ответы API маршрутов для payloads в их порядке: из кэша или запросом к серверу.
+
+    В параллельном режиме запросы ставятся в очередь по мере получения ответов, а не окнами: в очереди
+    находится не больше concurrency * 4 запросов (ограничение памяти на ответы), а отправлено - не больше
+    concurrency, поэтому медленный запрос не останавливает отправку следующих, а ожидающие в очереди
+    не расходуют TIMEOUT.
+    """
+    params = {"key": key_2gis}
+
+    def store(payload, response_json):
+        # Кэшируем только содержательные ответы, ошибки сервера при повторном запуске запрашиваются заново
+        if cache is not None and response_json and response_json.get("status") in ("OK", "ROUTE_NOT_FOUND"):
+            cache.set("2gis", *cache_key(payload), response_json)
+
+    def cached(payload):
+        return cache.get("2gis", *cache_key(payload)) if cache is not None else None
+
+    if concurrency <= 1:
+        with requests.Session() as session:
+            for payload in payloads:
+                response_json = cached(payload)
+                if response_json is None:
+                    response_json = post_request(session, url, payload, params)
+                    store(payload, response_json)
+                yield response_json
+        return
+
+    # Один цикл событий и одна сессия используются для всех запросов, чтобы соединения переиспользовались
+    loop = asyncio.new_event_loop()
+    async_session = loop.run_until_complete(open_async_session(concurrency))
+    limit = asyncio.Semaphore(concurrency)
+    queue: deque = deque()
+    remaining = iter(payloads)
+
+    def submit():
+        payload = next(remaining, None)
+        if payload is None:
+            return False
+        response_json = cached(payload)
+        if response_json is not None:
+            queue.append((payload, response_json, None))
+        else:
+            task = loop.create_task(post_request_async(async_session, url, payload, params, limit))
+            queue.append((payload, None, task))
+        return True
+
+    try:
+        while len(queue) < max(concurrency * 4, 1) and submit():
+            pass
+        while queue:
+            payload, response_json, task = queue.popleft()
+            if task is not None:
+                response_json = loop.run_until_complete(task)
+                store(payload, response_json)
+            submit()
+            yield response_json
+    finally:
+        tasks = [task for _, _, task in queue if task is not None]
+        for task in tasks:
+            task.cancel()
+        # gather без задач вне работающего цикла создаёт future другого цикла событий
+        if tasks:
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.run_until_complete(async_session.close())
+        loop.close()
+
+
+def cache_key(payload: dict) -> tuple[dict, list]:
+    """Параметры запроса и координаты точек, по которым ответ хранится в кэше."""
+    cache_options = {k: v for k, v in payload.items() if k != "points"}
+    cache_coords = [[point["lon"], point["lat"]] for point in payload["points"]]
+    return cache_options, cache_coords
 
 
 def find_routes(
-    gdf_start: gpd.GeoDataFrame, start_field_name: str, gdf_end: gpd.GeoDataFrame, end_field_name: str
-) -> gpd.GeoDataFrame:
+    gdf_start: gpd.GeoDataFrame,
+    start_field_name: str,
+    gdf_end: gpd.GeoDataFrame,
+    end_field_name: str,
+    cache: ResponseCache | None = None,
+    writer: StreamWriter | None = None,
+    concurrency: int = 1,
+    exclude: ExcludePolygons | None = None,
+    od: pd.DataFrame | None = None,
+    max_distance: float | None = None,
+    k_nearest: int | None = None,
+    exclude_self: bool = False,
+) -> gpd.GeoDataFrame | None:
     """
     Построение маршрутов между точками с помощью API 2ГИС
 
@@ -45,9 +321,17 @@ def find_routes(
         start_field_name: Имя поля с идентификатором точек начала маршрутов
         gdf_end: GeoDataFrame с точками конца маршрутов
         end_field_name: Имя поля с идентификатором точек конца маршрутов
+        cache: Кэш ответов, позволяющий не запрашивать повторно уже построенные пары (None - без кэширования)
+        writer: Потоковая запись результатов порциями с контрольной точкой (None - результат собирается в памяти)
+        concurrency: Максимальное число одновременных запросов к API (1 - последовательные запросы без aiohttp)
+        exclude: Области, которые следует избегать при построении маршрута (None - без ограничений)
+        od: Таблица пар со столбцами from и to, для которых строятся маршруты (None - все сочетания)
+        max_distance: Максимальное расстояние по прямой между точками пары, м (None - без ограничения)
+        k_nearest: Число ближайших точек конца для каждой точки начала (None - без ограничения)
+        exclude_self: Не строить маршруты между точками с одинаковыми идентификаторами
 
     Returns:
-        GeoDataFrame с маршрутами
+        GeoDataFrame с маршрутами или None, если результаты записываются через writer
     """
     list_routes: list[LineString | None] = []
     list_from_ids = []
@@ -58,97 +342,221 @@ def find_routes(
     gdf_start = gdf_start.to_crs("EPSG:4326")
     gdf_end = gdf_end.to_crs("EPSG:4326")
 
-    for _, (start_idx, start_row) in enumerate(gdf_start.iterrows()):
-        for _, (end_idx, end_row) in enumerate(gdf_end.iterrows()):
+    # Отбор пар выполняется до запросов, чтобы не строить заведомо ненужные маршруты
+    start_pos, end_pos = select_pairs(
+        gdf_start, start_field_name, gdf_end, end_field_name, od, max_distance, k_nearest, exclude_self
+    )
+
+    # Геометрии и идентификаторы извлекаются один раз, а не построением строки DataFrame для каждой пары
+    start_geoms, end_geoms = list(gdf_start.geometry), list(gdf_end.geometry)
+    start_ids, end_ids = list(gdf_start[start_field_name]), list(gdf_end[end_field_name])
+
+    jobs = []
+    for i, j in zip(start_pos, end_pos):
+        start_geom, end_geom = start_geoms[i], end_geoms[j]
+        from_id, to_id = start_ids[i], end_ids[j]
+        if writer is not None and writer.is_done((from_id, to_id)):
+            continue
+
+        payload = {
+            "route_mode": ROUTE_MODE,
+            "traffic_mode": TRAFFIC_MODE,
+            "transport": TRANSPORT,
+            "output": OUTPUT,
+            "locale": LOCALE,
+            "alternative": ALTERNATIVE,
+            "points": [
+                {"type": "stop", "lon": start_geom.x, "lat": start_geom.y},
+                {"type": "stop", "lon": end_geom.x, "lat": end_geom.y},
+            ],
+            "exclude": exclude.for_pair(start_geom, end_geom) if exclude is not None else [],
+        }
+        jobs.append((gdf_start.index[i], gdf_end.index[j], from_id, to_id, payload))
+
+    responses = fetch_routes([payload for _, _, _, _, payload in jobs], cache, concurrency)
+    try:
+        for (start_idx, end_idx, from_id, to_id, _), response_json in zip(jobs, responses):
             print(f"Начальная точка {start_idx}, Конечная точка {end_idx}")
-            payload = {
-                "route_mode": ROUTE_MODE,
-                "traffic_mode": TRAFFIC_MODE,
-                "transport": TRANSPORT,
-                "output": OUTPUT,
-                "locale": LOCALE,
-                "alternative": ALTERNATIVE,
-                "points": [
-                    {"type": "stop", "lon": start_row["geometry"].x, "lat": start_row["geometry"].y},
-                    {"type": "stop", "lon": end_row["geometry"].x, "lat": end_row["geometry"].y},
-                ],
-                "exclude": exclude_polygons,
-            }
+            response_json = response_json or {}
 
-            response = requests.post(
-                url, params={"key": key_2gis}, headers={"Content-Type": "application/json"}, json=payload
-            )
-
-            if response.status_code != 200:
-                print(f"Ошибка: {response.status_code}")
-                print(response.text)
-
-            if response.json().get("status") == "OK":
-                data = response.json()["result"]
-
-                for route in data:
-                    parts = []
-                    begin_pedestrian_path = route.get("begin_pedestrian_path", {})
-                    if begin_pedestrian_path:
-                        geom = begin_pedestrian_path.get("geometry", {})
-                        line = load_wkt(geom.get("selection"))
-                        parts.append(line)
-                    for man in route.get("maneuvers", []):
-                        out_path = man.get("outcoming_path", {})
-                        for geom in out_path.get("geometry", []):
-                            try:  # порой при переходе с пешего пути на автомобильный встречаются линии из одной точки
-                                line = load_wkt(geom["selection"])
-                                parts.append(line)
-                            except Exception:
-                                pass
-                    end_pedestrian_path = route.get("end_pedestrian_path", {})
-                    if end_pedestrian_path:
-                        geom = end_pedestrian_path.get("geometry", {})
-                        line = load_wkt(geom.get("selection"))
-                        parts.append(line)
-
-                    if len(parts) == 1:
-                        merged = parts[0]
-                    else:
-                        merged = linemerge(parts)
-
-                    list_routes.append(merged)
-                    list_distances.append(route["total_duration"])
-                    list_durations.append(route["total_duration"])
-                    list_from_ids.append(start_row[start_field_name])
-                    list_to_ids.append(end_row[end_field_name])
-
-            elif response.json().get("status") == "ROUTE_NOT_FOUND":
-                list_routes.append(None)
-                list_distances.append(0)
-                list_durations.append(0)
-                list_from_ids.append(start_row[start_field_name])
-                list_to_ids.append(end_row[end_field_name])
+            # Строки результата для текущей пары: (геометрия, расстояние, время в пути)
+            pair_rows = []
+            failed = False
+
+            if response_json.get("status") == "OK":
+                data = response_json["result"]
+
+                with metrics.stage("geometry"):
+                    for route in data:
+                        pair_rows.append((route_geometry(route), route["total_distance"], route["total_duration"]))
+
+            elif response_json.get("status") == "ROUTE_NOT_FOUND":
+                pair_rows.append((None, 0, 0))
 
             else:
+                metrics.error("2gis", str(response_json.get("status", "no_response")))
                 print("Неизвестная ошибка")
-                list_routes.append(None)
-                list_distances.append(0)
-                list_durations.append(0)
-                list_from_ids.append(start_row[start_field_name])
-                list_to_ids.append(end_row[end_field_name])
-
-            gdf_routes = gpd.GeoDataFrame(
-                {
-                    "geometry": list_routes,
-                    "from": list_from_ids,
-                    "to": list_to_ids,
-                    "distance_meters": list_distances,
-                    "duration_seconds": list_durations,
-                },
-                crs="EPSG:4326",
-            )
+                pair_rows.append((None, 0, 0))
+                failed = True
+
+            if writer is not None:
+                # Ошибки не записываются и не попадают в контрольную точку, при следующем запуске пара
+                # запрашивается заново
+                if failed:
+                    continue
+                with metrics.stage("write"):
+                    writer.write(
+                        (from_id, to_id),
+                        [
+                            {
+                                "geometry": geom,
+                                "from": from_id,
+                                "to": to_id,
+                                "distance_meters": distance,
+                                "duration_seconds": duration,
+                            }
+                            for geom, distance, duration in pair_rows
+                        ],
+                    )
+                continue
+
+            for geom, distance, duration in pair_rows:
+                list_routes.append(geom)
+                list_distances.append(distance)
+                list_durations.append(duration)
+                list_from_ids.append(from_id)
+                list_to_ids.append(to_id)
+    finally:
+        responses.close()
+
+    if writer is not None:
+        writer.flush()
+        return None
+
+    # GeoDataFrame собирается один раз из накопленных столбцов
+    with metrics.stage("dataframe"):
+        gdf_routes = gpd.GeoDataFrame(
+            {
+                "geometry": list_routes,
+                "from": list_from_ids,
+                "to": list_to_ids,
+                "distance_meters": list_distances,
+                "duration_seconds": list_durations,
+            },
+            crs="EPSG:4326",
+        )
 
     return gdf_routes
 
 
-# Пример использования
-gdf_start = gpd.read_file("start_points.gpkg", use_arrow=True)
-gdf_end = gpd.read_file("end_points.gpkg", use_arrow=True)
-gdf_routes = find_routes(gdf_start, "point_id", gdf_end, "point_id")
-gdf_routes.to_file("routes.gpkg")
+def find_matrix(
+    gdf_start: gpd.GeoDataFrame,
+    start_field_name: str,
+    gdf_end: gpd.GeoDataFrame,
+    end_field_name: str,
+    cache: ResponseCache | None = None,
+    concurrency: int = 1,
+) -> pd.DataFrame:
+    """
+    Построение матрицы расстояний и времени в пути между точками с помощью Distance Matrix API 2ГИС, без геометрии
+
+    Args:
+        gdf_start: GeoDataFrame с точками начала маршрутов
+        start_field_name: Имя поля с идентификатором точек начала маршрутов
+        gdf_end: GeoDataFrame с точками конца маршрутов
+        end_field_name: Имя поля с идентификатором точек конца маршрутов
+        cache: Кэш ответов, позволяющий не запрашивать повторно уже построенные блоки (None - без кэширования)
+        concurrency: Максимальное число одновременных запросов к API (1 - последовательные запросы без aiohttp)
+
+    Returns:
+        DataFrame с полями from, to, distance_meters, duration_seconds
+    """
+    gdf_start = gdf_start.to_crs("EPSG:4326")
+    gdf_end = gdf_end.to_crs("EPSG:4326")
+
+    start_points = [{"lon": geom.x, "lat": geom.y} for geom in gdf_start.geometry]
+    end_points = [{"lon": geom.x, "lat": geom.y} for geom in gdf_end.geometry]
+
+    # Разбиваем N x M на блоки, укладывающиеся в ограничения API на размер матрицы
+    blocks = [
+        (i, j)
+        for i in range(0, len(start_points), MATRIX_MAX_SOURCES)
+        for j in range(0, len(end_points), MATRIX_MAX_TARGETS)
+    ]
+    payloads = []
+    for i, j in blocks:
+        sources = start_points[i : i + MATRIX_MAX_SOURCES]
+        targets = end_points[j : j + MATRIX_MAX_TARGETS]
+        payloads.append(
+            {
+                "points": sources + targets,
+                "sources": list(range(len(sources))),
+                "targets": list(range(len(sources), len(sources) + len(targets))),
+                "type": MATRIX_TYPE,
+                "transport": TRANSPORT,
+            }
+        )
+
+    params = {"key": key_2gis, "version": MATRIX_VERSION}
+    responses = [cache.get("2gis_matrix", *cache_key(payload)) if cache is not None else None for payload in payloads]
+    missing = [i for i, response_json in enumerate(responses) if response_json is None]
+    missing_payloads = [payloads[i] for i in missing]
+
+    if concurrency > 1:
+
+        async def fetch():
+            async with await open_async_session(concurrency) as async_session:
+                return await post_requests_async(async_session, matrix_url, missing_payloads, params, concurrency)
+
+        fetched = asyncio.run(fetch())
+    else:
+        with requests.Session() as session:
+            fetched = [post_request(session, matrix_url, payload, params) for payload in missing_payloads]
+
+    for i, response_json in zip(missing, fetched):
+        responses[i] = response_json
+        if cache is not None and response_json and "routes" in response_json:
+            cache.set("2gis_matrix", *cache_key(payloads[i]), response_json)
+
+    distances = [[None] * len(end_points) for _ in start_points]
+    durations = [[None] * len(end_points) for _ in start_points]
+    for (i, j), payload, response_json in zip(blocks, payloads, responses):
+        if not response_json or "routes" not in response_json:
+            print(f"Не удалось построить блок матрицы {i}, {j}: {response_json}")
+            continue
+        n_sources = len(payload["sources"])
+        for route in response_json["routes"]:
+            if route.get("status") != "OK":
+                continue
+            source = i + route["source_id"]
+            target = j + route["target_id"] - n_sources
+            distances[source][target] = route.get("distance")
+            durations[source][target] = route.get("duration")
+
+    start_ids = list(gdf_start[start_field_name])
+    end_ids = list(gdf_end[end_field_name])
+    result_df = pd.DataFrame(
+        {
+            "from": [from_id for from_id in start_ids for _ in end_ids],
+            "to": [to_id for _ in start_ids for to_id in end_ids],
+            "distance_meters": [value for row in distances for value in row],
+            "duration_seconds": [value for row in durations for value in row],
+        }
+    )
+
+    return result_df
+
+
+if __name__ == "__main__":
+    # Пример использования
+    gdf_start = gpd.read_file("start_points.gpkg", use_arrow=True)
+    gdf_end = gpd.read_file("end_points.gpkg", use_arrow=True)
+    exclude = None
+    # Раскомментировать, если необходимо задать области, которые следует избегать при построении маршрута
+    # exclude = ExcludePolygons(gpd.read_file("polygons_to_avoid.gpkg", use_arrow=True))
+    with ResponseCache("responses_cache.sqlite") as cache, StreamWriter("routes.gpkg") as writer:
+        find_routes(
+            gdf_start, "point_id", gdf_end, "point_id", cache=cache, writer=writer, concurrency=8, exclude=exclude
+        )
+        print(f"Кэш: {cache.stats()}")
+    metrics.to_json("routes_2gis_metrics.json")
@@ -0,0 +1,429 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from shapely import get_coordinates, get_point
+from shapely.geometry import LineString
+from shapely.ops import substring
+from tqdm import tqdm
+
+from snap_points_to_lines import LineSnapper
+from stream_writer import StreamWriter
+
+# Скорость движения по линии, если поле скорости не задано или пусто, км/ч
+DEFAULT_SPEED = 40
+# Максимальное расстояние от точки до сети, на котором точка привязывается к линии, м
+SNAP_TOLERANCE = 500
+# Число знаков после запятой при сравнении координат концов линий (в метрах), совпадающие концы - один узел
+NODE_PRECISION = 3
+# Число источников, обрабатываемых одним вызовом Дейкстры (ограничивает память под массивы предшественников)
+SOURCES_BLOCK = 64
+# Минимальный вес ребра: нулевые значения в разреженной матрице не считаются рёбрами
+MIN_WEIGHT = 1e-9
+# Значения поля одностороннего движения (как у тега oneway OSM, без учёта регистра): движение по направлению линии,
+# против него и в обе стороны. Логические и числовые значения сопоставляются так же (True, 1 / -1 / False, 0)
+ONEWAY_FORWARD = {"yes", "true", "1"}
+ONEWAY_BACKWARD = {"-1", "reverse"}
+ONEWAY_NO = {"no", "false", "0", ""}
+
+# --------------------
+
+
+class NetworkRouter:
+    """
+    Локальная маршрутизация по слою линий без обращения к серверу.
+    Концы линий становятся узлами графа, совпадающие концы объединяются, поэтому линии должны быть разбиты
+    в местах пересечений. Точки начала и конца маршрутов привязываются к ближайшим линиям через LineSnapper
+    и вставляются в граф как дополнительные узлы, кратчайшие пути ищутся алгоритмом Дейкстры сразу
+    от блока источников до всех узлов.
+    """
+
+    def __init__(
+        self,
+        lines: gpd.GeoDataFrame,
+        speed_field: str | None = None,
+        oneway_field: str | None = None,
+        weight: str = "duration",
+    ):
+        """
+        Args:
+            lines: GeoDataFrame с линиями дорожной сети
+            speed_field: Имя поля со скоростью движения по линии в км/ч (None - DEFAULT_SPEED для всех линий)
+            oneway_field: Имя поля с признаком одностороннего движения, значения см. ONEWAY_FORWARD, ONEWAY_BACKWARD
+                и ONEWAY_NO, пустые значения - движение в обе стороны (None - все линии двусторонние)
+            weight: Минимизируемая величина: duration (время в пути) или distance (длина маршрута)
+        """
+        if weight not in ("duration", "distance"):
+            raise ValueError(f"Неизвестный вес маршрута: {weight}")
+        self.weight = weight
+
+        # Расчёт ведётся в метрической системе координат
+        self.crs = lines.estimate_utm_crs() if lines.crs is None or lines.crs.is_geographic else lines.crs
+        fields = [field for field in (speed_field, oneway_field) if field is not None]
+        lines = lines[[lines.geometry.name, *fields]].to_crs(self.crs).explode(ignore_index=True)
+        lines = lines[lines.geometry.notna() & ~lines.geometry.is_empty].reset_index(drop=True)
+        direction = oneway_direction(lines[oneway_field]) if oneway_field is not None else np.zeros(len(lines))
+        # Линии с движением против направления геометрии разворачиваются, дальше они обрабатываются как прямые
+        backward = direction < 0
+        if backward.any():
+            lines.loc[backward, lines.geometry.name] = lines.geometry[backward].reverse()
+        self.oneway = direction != 0
+        self.lines = lines
+        self.geoms = np.asarray(lines.geometry.array, dtype=object)
+        self.snapper = LineSnapper(lines)
+
+        self.lengths = lines.length.to_numpy()
+        speeds = np.full(len(lines), float(DEFAULT_SPEED))
+        if speed_field is not None:
+            values = pd.to_numeric(lines[speed_field], errors="coerce").to_numpy()
+            speeds = np.where(np.isfinite(values) & (values > 0), values, speeds)
+        self.durations = self.lengths / (speeds / 3.6)
+
+        # Узлы графа - уникальные концы линий
+        ends = np.concatenate([get_coordinates(get_point(self.geoms, 0)), get_coordinates(get_point(self.geoms, -1))])
+        _, nodes = np.unique(np.round(ends, NODE_PRECISION), axis=0, return_inverse=True)
+        nodes = nodes.ravel()
+        self.start_node = nodes[: len(lines)]
+        self.end_node = nodes[len(lines) :]
+        self.n_nodes = int(nodes.max()) + 1 if len(nodes) else 0
+
+    def attach(self, gdf: gpd.GeoDataFrame, tolerance: float = SNAP_TOLERANCE) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Привязывает точки к сети.
+
+        Returns:
+            Номер линии и доля её длины до точки привязки для каждой точки (-1 и NaN, если линия дальше tolerance)
+        """
+        geoms = np.asarray(gdf.geometry.to_crs(self.crs).array, dtype=object)
+        point_idx, line_pos, _, _, fraction = self.snapper.query(geoms, tolerance)
+        lines = np.full(len(gdf), -1)
+        lines[point_idx] = line_pos
+        fractions = np.full(len(gdf), np.nan)
+        fractions[point_idx] = fraction
+        return lines, fractions
+
+    def graph(self, line_pos: np.ndarray, fractions: np.ndarray) -> dict:
+        """
+        Строит граф с привязанными точками. Каждая линия делится привязанными к ней точками на рёбра
+        в порядке их положения вдоль линии, поэтому точки на одной линии соединяются напрямую.
+
+        Args:
+            line_pos: Номера линий привязанных точек (-1 - точка не привязана)
+            fractions: Доля длины линии до точки привязки
+
+        Returns:
+            Словарь с матрицей смежности по весу, таблицей рёбер и узлами привязанных точек
+        """
+        attached = np.flatnonzero(line_pos >= 0)
+        point_nodes = np.full(len(line_pos), -1)
+        point_nodes[attached] = self.n_nodes + np.arange(len(attached))
+        n_total = self.n_nodes + len(attached)
+
+        # Узлы вдоль каждой линии: начало, привязанные точки, конец
+        n_lines = len(self.lines)
+        all_line = np.concatenate([np.arange(n_lines), np.arange(n_lines), line_pos[attached]])
+        all_fraction = np.concatenate([np.zeros(n_lines), np.ones(n_lines), fractions[attached]])
+        all_node = np.concatenate([self.start_node, self.end_node, point_nodes[attached]])
+        order = np.lexsort((all_fraction, all_line))
+        all_line, all_fraction, all_node = all_line[order], all_fraction[order], all_node[order]
+
+        same_line = all_line[1:] == all_line[:-1]
+        edge_line = all_line[:-1][same_line]
+        edge_from, edge_to = all_node[:-1][same_line], all_node[1:][same_line]
+        fraction_from, fraction_to = all_fraction[:-1][same_line], all_fraction[1:][same_line]
+
+        # Обратные рёбра для двусторонних линий
+        back = ~self.oneway[edge_line]
+        line = np.concatenate([edge_line, edge_line[back]])
+        share = np.concatenate([fraction_to - fraction_from, (fraction_to - fraction_from)[back]])
+        edges = pd.DataFrame(
+            {
+                "from": np.concatenate([edge_from, edge_to[back]]),
+                "to": np.concatenate([edge_to, edge_from[back]]),
+                "line": line,
+                "fraction_from": np.concatenate([fraction_from, fraction_to[back]]),
+                "fraction_to": np.concatenate([fraction_to, fraction_from[back]]),
+                "distance": share * self.lengths[line],
+                "duration": share * self.durations[line],
+            }
+        )
+        # Из параллельных рёбер между одной парой узлов оставляем лучшее по весу
+        edges = edges.sort_values(["from", "to", self.weight], kind="stable").drop_duplicates(["from", "to"])
+        edges["key"] = edges["from"].to_numpy() * n_total + edges["to"].to_numpy()
+        edges = edges.sort_values("key").reset_index(drop=True)
+
+        other = "distance" if self.weight == "duration" else "duration"
+        shape = (n_total, n_total)
+        return {
+            "matrix": csr_matrix(
+                (np.maximum(edges[self.weight].to_numpy(), MIN_WEIGHT), (edges["from"], edges["to"])), shape=shape
+            ),
+            "other": other,
+            "edges": edges,
+            "point_nodes": point_nodes,
+        }
+
+    def solve(self, graph: dict, sources: np.ndarray, targets: np.ndarray) -> tuple[np.ndarray, ...]:
+        """
+        Кратчайшие пути от блока источников до назначений.
+
+        Args:
+            graph: Результат graph
+            sources: Узлы источников (-1 - точка не привязана)
+            targets: Узлы назначений (-1 - точка не привязана)
+
+        Returns:
+            Матрицы расстояний (м) и времени (с) источники x назначения и массив предшественников по узлам графа
+        """
+        n_total = graph["matrix"].shape[0]
+        distances = np.full((len(sources), len(targets)), np.nan)
+        durations = np.full((len(sources), len(targets)), np.nan)
+        predecessors = np.full((len(sources), n_total), -9999)
+        valid_sources = np.flatnonzero(sources >= 0)
+        valid_targets = np.flatnonzero(targets >= 0)
+        if len(valid_sources) == 0:
+            return distances, durations, predecessors
+
+        weight, pred = dijkstra(
+            graph["matrix"], directed=True, indices=sources[valid_sources], return_predecessors=True
+        )
+        # Вторая величина (длина при поиске по времени и наоборот) суммируется по дереву кратчайших путей
+        other = tree_sums(pred, edge_values(graph, pred, graph["other"]))
+
+        weight = weight[:, targets[valid_targets]]
+        other = other[:, targets[valid_targets]]
+        other[~np.isfinite(weight)] = np.nan
+        weight[~np.isfinite(weight)] = np.nan
+        values = {self.weight: weight, graph["other"]: other}
+        distances[np.ix_(valid_sources, valid_targets)] = values["distance"]
+        durations[np.ix_(valid_sources, valid_targets)] = values["duration"]
+        predecessors[valid_sources] = pred
+        return distances, durations, predecessors
+
+    def path_geometry(self, graph: dict, predecessors: np.ndarray, source: int, target: int) -> LineString | None:
+        """Собирает геометрию маршрута из участков линий по массиву предшественников одного источника."""
+        if source < 0 or target < 0 or (predecessors[target] < 0 and source != target):
+            return None
+        nodes = [target]
+        while nodes[-1] != source:
+            nodes.append(predecessors[nodes[-1]])
+        nodes = np.array(nodes[::-1])
+        if len(nodes) < 2:
+            return None
+
+        edges = graph["edges"]
+        n_total = graph["matrix"].shape[0]
+        rows = edges.iloc[np.searchsorted(edges["key"].to_numpy(), nodes[:-1] * n_total + nodes[1:])]
+        coords = []
+        for line, start, end in zip(rows["line"], rows["fraction_from"], rows["fraction_to"]):
+            part = get_coordinates(substring(self.geoms[line], start, end, normalized=True))
+            coords.extend(part if not coords else part[1:])
+        if len(coords) < 2:
+            return None
+        return LineString(coords)
+
+
+def oneway_direction(values: pd.Series) -> np.ndarray:
+    """
+    Направление движения по линиям из поля одностороннего движения: 1 - по направлению линии, -1 - против,
+    0 - в обе стороны. Неизвестные значения вызывают ValueError, чтобы не принять их за одностороннее движение.
+    """
+    direction = np.zeros(len(values), dtype=np.int8)
+    unknown = set()
+    for i, value in enumerate(values):
+        if pd.isna(value):
+            continue
+        if isinstance(value, (bool, np.bool_)):
+            text = str(bool(value)).lower()
+        elif isinstance(value, (int, float, np.integer, np.floating)) and float(value).is_integer():
+            text = str(int(value))
+        else:
+            text = str(value).strip().lower()
+        if text in ONEWAY_FORWARD:
+            direction[i] = 1
+        elif text in ONEWAY_BACKWARD:
+            direction[i] = -1
+        elif text not in ONEWAY_NO:
+            unknown.add(value)
+    if unknown:
+        raise ValueError(f"Неизвестные значения признака одностороннего движения: {sorted(map(str, unknown))}")
+    return direction
+
+
+def edge_values(graph: dict, predecessors: np.ndarray, field: str) -> np.ndarray:
+    """Значение поля ребра, ведущего в каждый узел из его предшественника (0 для корня и недостижимых узлов)."""
+    edges = graph["edges"]
+    n_total = graph["matrix"].shape[0]
+    nodes = np.broadcast_to(np.arange(n_total), predecessors.shape)
+    has_pred = predecessors >= 0
+    # dijkstra возвращает предшественников в int32: ключ считается в int64, чтобы не переполниться на больших сетях
+    keys = predecessors[has_pred].astype(np.int64) * n_total + nodes[has_pred]
+    idx = np.searchsorted(edges["key"].to_numpy(), keys)
+    values = np.zeros(predecessors.shape)
+    values[has_pred] = edges[field].to_numpy()[idx]
+    return values
+
+
+def tree_sums(predecessors: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    Суммы значений рёбер от корня до каждого узла дерева кратчайших путей.
+    Считаются удвоением указателей: за каждый шаг узел прибавляет накопленную сумму узла, на который указывает,
+    и переходит на его указатель, поэтому число шагов растёт как логарифм глубины дерева.
+    """
+    sums = values.copy()
+    jump = predecessors.copy()
+    while (jump >= 0).any():
+        has_jump = jump >= 0
+        target = np.where(has_jump, jump, 0)
+        sums = sums + np.where(has_jump, np.take_along_axis(sums, target, axis=1), 0)
+        jump = np.where(has_jump, np.take_along_axis(jump, target, axis=1), -1)
+    return sums
+
+
+def prepare(router: NetworkRouter, gdf_start: gpd.GeoDataFrame, gdf_end: gpd.GeoDataFrame, tolerance: float):
+    """Привязывает точки начала и конца к сети и строит граф с ними."""
+    start_lines, start_fractions = router.attach(gdf_start, tolerance)
+    end_lines, end_fractions = router.attach(gdf_end, tolerance)
+    graph = router.graph(np.concatenate([start_lines, end_lines]), np.concatenate([start_fractions, end_fractions]))
+    sources = graph["point_nodes"][: len(gdf_start)]
+    targets = graph["point_nodes"][len(gdf_start) :]
+    print(f"Не привязано к сети: начал {(sources < 0).sum()}, концов {(targets < 0).sum()}")
+    return graph, sources, targets
+
+
+def build_routes(
+    router: NetworkRouter,
+    gdf_start: gpd.GeoDataFrame,
+    start_field_name: str,
+    gdf_end: gpd.GeoDataFrame,
+    end_field_name: str,
+    concurrency: int = 1,
+    tolerance: float = SNAP_TOLERANCE,
+    writer: StreamWriter | None = None,
+):
+    """
+    Построение маршрутов между точками по локальной сети
+
+    Args:
+        router: Локальный маршрутизатор
+        gdf_start: GeoDataFrame с точками начала маршрутов
+        start_field_name: Имя поля с идентификатором точек начала маршрутов
+        gdf_end: GeoDataFrame с точками конца маршрутов
+        end_field_name: Имя поля с идентификатором точек конца маршрутов
+        concurrency: Число потоков, обрабатывающих блоки источников (1 - последовательное построение)
+        tolerance: Максимальное расстояние привязки точек к сети, м
+        writer: Потоковая запись результатов порциями с контрольной точкой (None - результат собирается в памяти)
+
+    Returns:
+        GeoDataFrame с маршрутами (distance в километрах, как у route_by_valhalla) или None,
+        если результаты записываются через writer
+    """
+    graph, sources, targets = prepare(router, gdf_start, gdf_end, tolerance)
+    start_ids = [row.get(start_field_name, None) for _, row in gdf_start.iterrows()]
+    end_ids = [row.get(end_field_name, None) for _, row in gdf_end.iterrows()]
+
+    def build_block(i):
+        block = sources[i : i + SOURCES_BLOCK]
+        distances, durations, predecessors = router.solve(graph, block, targets)
+        rows = []
+        for di, source in enumerate(block):
+            for j, target in enumerate(targets):
+                from_id, to_id = start_ids[i + di], end_ids[j]
+                if writer is not None and writer.is_done((from_id, to_id)):
+                    continue
+                shape = router.path_geometry(graph, predecessors[di], source, target)
+                distance = distances[di, j] / 1000 if np.isfinite(distances[di, j]) else None
+                rows.append({"geometry": shape, "from": from_id, "to": to_id, "distance": distance})
+        return rows
+
+    blocks = range(0, len(sources), SOURCES_BLOCK)
+    rows = []
+    executor = ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else None
+    map_func = executor.map if executor is not None else map
+    try:
+        for block_rows in tqdm(map_func(build_block, blocks), total=len(blocks), desc="Building routes"):
+            if writer is None:
+                rows.extend(block_rows)
+                continue
+            for row in block_rows:
+                writer.write((row["from"], row["to"]), [row])
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if writer is not None:
+            writer.flush()
+
+    if writer is not None:
+        return None
+
+    result_gdf = gpd.GeoDataFrame(
+        rows or {"geometry": [], "from": [], "to": [], "distance": []}, geometry="geometry", crs=router.crs
+    )
+    return result_gdf.to_crs("EPSG:4326")
+
+
+def build_matrix(
+    router: NetworkRouter,
+    gdf_start: gpd.GeoDataFrame,
+    start_field_name: str,
+    gdf_end: gpd.GeoDataFrame,
+    end_field_name: str,
+    concurrency: int = 1,
+    tolerance: float = SNAP_TOLERANCE,
+) -> pd.DataFrame:
+    """
+    Построение матрицы расстояний и времени в пути между точками по локальной сети без геометрии маршрутов
+
+    Args:
+        router: Локальный маршрутизатор
+        gdf_start: GeoDataFrame с точками начала маршрутов
+        start_field_name: Имя поля с идентификатором точек начала маршрутов
+        gdf_end: GeoDataFrame с точками конца маршрутов
+        end_field_name: Имя поля с идентификатором точек конца маршрутов
+        concurrency: Число потоков, обрабатывающих блоки источников (1 - последовательное построение)
+        tolerance: Максимальное расстояние привязки точек к сети, м
+
+    Returns:
+        DataFrame с полями from, to, distance (км), duration (с)
+    """
+    graph, sources, targets = prepare(router, gdf_start, gdf_end, tolerance)
+    start_ids = [row.get(start_field_name, None) for _, row in gdf_start.iterrows()]
+    end_ids = [row.get(end_field_name, None) for _, row in gdf_end.iterrows()]
+
+    def build_block(i):
+        distances, durations, _ = router.solve(graph, sources[i : i + SOURCES_BLOCK], targets)
+        return distances, durations
+
+    blocks = range(0, len(sources), SOURCES_BLOCK)
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(tqdm(executor.map(build_block, blocks), total=len(blocks), desc="Building matrix"))
+    else:
+        results = [build_block(i) for i in tqdm(blocks, desc="Building matrix")]
+
+    distances = np.concatenate([block[0] for block in results]) if results else np.empty((0, len(targets)))
+    durations = np.concatenate([block[1] for block in results]) if results else np.empty((0, len(targets)))
+
+    result_df = pd.DataFrame(
+        {
+            "from": [from_id for from_id in start_ids for _ in end_ids],
+            "to": [to_id for _ in start_ids for to_id in end_ids],
+            "distance": distances.ravel() / 1000,
+            "duration": durations.ravel(),
+        }
+    )
+
+    return result_df
+
+
+if __name__ == "__main__":
+    # Пример использования
+    gdf_lines = gpd.read_file("roads.gpkg", use_arrow=True)
+    gdf_start = gpd.read_file("start_points.gpkg", use_arrow=True)
+    gdf_end = gpd.read_file("end_points.gpkg", use_arrow=True)
+    router = NetworkRouter(gdf_lines, speed_field="maxspeed")
+    with StreamWriter("routes_local.gpkg") as writer:
+        build_routes(router, gdf_start, "point_id", gdf_end, "point_id", concurrency=4, writer=writer)
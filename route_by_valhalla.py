@@ -1,40 +1,114 @@
-# import time
+from concurrent.futures import ThreadPoolExecutor
 
 import geopandas as gpd
-from routingpy import Valhalla
+import pandas as pd
+from routingpy.direction import Direction
 from routingpy.exceptions import RouterApiError
+from routingpy.matrix import Matrix
 from shapely.geometry import LineString
 from tqdm import tqdm
 
+from metrics import metrics
+from rate_controller import raise_unavailable, shared_controller
+from od_pairs import select_pairs
+from response_cache import ResponseCache
+from stream_writer import StreamWriter
+from valhalla_pool import shared_pool
+
 # Параметры построения маршрутов
 route_profile = "auto"
 route_options = {"costing": "auto", "use_tolls": 0, "units": "kilometers"}
 
+# Размер блока матрицы (источники x назначения), не превышающий max_matrix_location_pairs сервера
+MATRIX_MAX_SOURCES = 50
+MATRIX_MAX_TARGETS = 50
+
+# Серверы Valhalla: запросы распределяются между ними по наименьшему числу запросов в работе
+VALHALLA_URLS = ["https://valhalla1.openstreetmap.de"]
+# Ограничения общего контроллера запросов к Valhalla: задержка ответа в секундах, выше которой число запросов
+# в работе уменьшается (меньше timeout клиента), и число запросов в секунду ко всем серверам (None - без ограничения)
+TARGET_LATENCY = 5.0
+RPS = None
+
 # --------------------
 
-# Инициализация клиента Valhalla с автоматической обработкой повторных запросов и ошибок
-client = Valhalla(
-    base_url="https://valhalla1.openstreetmap.de",
-    timeout=10,
-    retry_timeout=60,
-    retry_over_query_limit=True,
-    skip_api_error=True,
+# Результат build_route, если Valhalla ответила ошибкой запроса (например, маршрут не найден): в отличие от сбоя
+# (None) повтор запроса ничего не изменит, поэтому пара записывается с пустой геометрией
+ROUTE_NOT_FOUND = "ROUTE_NOT_FOUND"
+
+# Общий для скриптов Valhalla контроллер числа одновременных запросов: подстраивается под ответы сервера (AIMD),
+# при 429 повторяет запрос после паузы со случайной длительностью
+controller = shared_controller(
+    "valhalla", max_concurrency=16 * len(VALHALLA_URLS), rps=RPS, target_latency=TARGET_LATENCY
 )
 
+# Клиент Valhalla создаётся при первом построении (get_client), чтобы импорт модуля не открывал соединений
+# и не запускал проверку серверов. Заданный здесь клиент (например, в benchmark.py) используется вместо общего пула
+client = None
+
+
+def get_client():
+    """
+    Клиент Valhalla с автоматической обработкой ошибок: при отказе сервера запрос повторяется на другом,
+    неотвечающие серверы исключаются из пула до восстановления. Пул общий для скриптов Valhalla.
+    """
+    if client is not None:
+        return client
+    return shared_pool(
+        VALHALLA_URLS,
+        timeout=10,
+        retry_timeout=60,
+        # Превышение лимита запросов (429) и недоступность сервера (503) обрабатывает controller,
+        # поэтому клиент сразу возвращает ошибку, а не повторяет запрос сам
+        retry_over_query_limit=False,
+        # Ошибка запроса (400, маршрут не найден) пробрасывается, чтобы отличать её от сбоя сервера
+        skip_api_error=False,
+        # Каждая попытка запроса учитывается в metrics, затем 503 пробрасывается без повторов routingpy
+        hooks={"response": [metrics.response_hook("valhalla"), raise_unavailable]},
+    )
+
 
-def build_route(client, start_coord, end_coord):
+def build_route(client, start_coord, end_coord, cache: ResponseCache | None = None):
+    if cache is not None:
+        cached = cache.get("valhalla_directions", [route_profile, route_options], [start_coord, end_coord])
+        if cached is not None:
+            return Direction(geometry=cached["geometry"], duration=cached["duration"], distance=cached["distance"])
     try:
-        route = client.directions(locations=[start_coord, end_coord], profile=route_profile, options=route_options)
+        with metrics.stage("http"):
+            route = controller.run(
+                client.directions, locations=[start_coord, end_coord], profile=route_profile, options=route_options
+            )
+        if cache is not None and route:
+            cache.set(
+                "valhalla_directions",
+                [route_profile, route_options],
+                [start_coord, end_coord],
+                {"geometry": route.geometry, "duration": route.duration, "distance": route.distance},
+            )
         return route
     except RouterApiError as e:
+        metrics.error("valhalla", e)
         print(f"Router API error: {e}")
-        return None
+        return ROUTE_NOT_FOUND
     except Exception as e:
+        metrics.error("valhalla", e)
         print(f"Unexpected error: {e}")
         return None
 
 
-def build_routes(gdf_start: gpd.GeoDataFrame, start_field_name: str, gdf_end: gpd.GeoDataFrame, end_field_name: str):
+def build_routes(
+    gdf_start: gpd.GeoDataFrame,
+    start_field_name: str,
+    gdf_end: gpd.GeoDataFrame,
+    end_field_name: str,
+    concurrency: int = 1,
+    cache: ResponseCache | None = None,
+    writer: StreamWriter | None = None,
+    od: pd.DataFrame | None = None,
+    max_distance: float | None = None,
+    k_nearest: int | None = None,
+    exclude_self: bool = False,
+):
     """
     Построение маршрутов между точками
 
@@ -43,60 +117,214 @@ def build_routes(gdf_start: gpd.GeoDataFrame, start_field_name: str, gdf_end: gp
         start_field_name: Имя поля с идентификатором точек начала маршрутов
         gdf_end: GeoDataFrame с точками конца маршрутов
         end_field_name: Имя поля с идентификатором точек конца маршрутов
+        concurrency: Максимальное число одновременных запросов к Valhalla (1 - последовательное построение),
+            фактическое число ограничивает controller по ответам сервера
+        cache: Кэш ответов, позволяющий не запрашивать повторно уже построенные пары (None - без кэширования)
+        writer: Потоковая запись результатов порциями с контрольной точкой (None - результат собирается в памяти)
+        od: Таблица пар со столбцами from и to, для которых строятся маршруты (None - все сочетания)
+        max_distance: Максимальное расстояние по прямой между точками пары, м (None - без ограничения)
+        k_nearest: Число ближайших точек конца для каждой точки начала (None - без ограничения)
+        exclude_self: Не строить маршруты между точками с одинаковыми идентификаторами
 
     Returns:
-        GeoDataFrame с маршрутами
+        GeoDataFrame с маршрутами или None, если результаты записываются через writer
     """
+    # Отбор пар выполняется до запросов, чтобы не строить заведомо ненужные маршруты
+    start_pos, end_pos = select_pairs(
+        gdf_start, start_field_name, gdf_end, end_field_name, od, max_distance, k_nearest, exclude_self
+    )
+
     gdf_start = gdf_start.copy().to_crs("EPSG:4326")
     gdf_end = gdf_end.copy().to_crs("EPSG:4326")
 
+    starts = [
+        ([row.geometry.x, row.geometry.y], row.get(start_field_name, None)) for _, row in gdf_start.iterrows()
+    ]
+    ends = [([row.geometry.x, row.geometry.y], row.get(end_field_name, None)) for _, row in gdf_end.iterrows()]
+
+    # Пары формируются заранее, чтобы порядок результатов не зависел от порядка завершения запросов
+    pairs = [(starts[i][0], ends[j][0], starts[i][1], ends[j][1]) for i, j in zip(start_pos, end_pos)]
+    if writer is not None:
+        # Пропускаем пары, записанные при предыдущем запуске
+        pairs = [pair for pair in pairs if not writer.is_done(pair[2:])]
+
+    client = get_client()
+
+    def build_pair(pair):
+        start_coord, end_coord, _, _ = pair
+        # Время запросов для подбора timeout собирается в metrics
+        return build_route(client, start_coord, end_coord, cache=cache)
+
     list_routes = []
     list_from_ids = []
     list_to_ids = []
     list_distances = []
 
-    for _, row_start in tqdm(gdf_start.iterrows(), total=len(gdf_start), desc="Building routes (starts)"):
-        start_point = row_start.geometry
-        start_coord = [start_point.x, start_point.y]
-        from_id = row_start.get(start_field_name, None)
-
-        for _, row_end in gdf_end.iterrows():
-            end_point = row_end.geometry
-            end_coord = [end_point.x, end_point.y]
-            to_id = row_end.get(end_field_name, None)
-
-            # Для определения оптимального timeout
-            # start_time = time.time()
-            route = build_route(client, start_coord, end_coord)
-            # end_time = time.time()
-            # print(f"Время построения маршрута: {end_time - start_time} секунд")
-
-            if route:
-                shape = LineString([(pt[0], pt[1]) for pt in route.geometry])
-                list_routes.append(shape)
-                list_distances.append(route.distance)
-            else:
-                list_routes.append(None)
-                list_distances.append(None)
+    # executor.map возвращает результаты в порядке пар, число потоков ограничивает число запросов в работе
+    executor = ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else None
+    map_func = executor.map if executor is not None else map
+    try:
+        routes = map_func(build_pair, pairs)
+        for (_, _, from_id, to_id), route in zip(pairs, tqdm(routes, total=len(pairs), desc="Building routes")):
+            with metrics.stage("geometry"):
+                if isinstance(route, Direction):
+                    shape = LineString([(pt[0], pt[1]) for pt in route.geometry])
+                    distance = route.distance
+                else:
+                    shape = None
+                    distance = None
 
+            if writer is not None:
+                # Неудачный запрос не записывается и не попадает в контрольную точку, чтобы повториться при перезапуске.
+                # Ошибка запроса (ROUTE_NOT_FOUND) окончательна и записывается с пустой геометрией, как в памяти
+                if route is not None:
+                    with metrics.stage("write"):
+                        writer.write(
+                            (from_id, to_id), [{"geometry": shape, "from": from_id, "to": to_id, "distance": distance}]
+                        )
+                continue
+
+            list_routes.append(shape)
+            list_distances.append(distance)
             list_from_ids.append(from_id)
             list_to_ids.append(to_id)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if writer is not None:
+            writer.flush()
+
+    if writer is not None:
+        return None
+
+    with metrics.stage("dataframe"):
+        result_gdf = gpd.GeoDataFrame(
+            {
+                "geometry": list_routes,
+                "from": list_from_ids,
+                "to": list_to_ids,
+                "distance": list_distances,
+            },
+            crs="EPSG:4326",
+        )
+
+    return result_gdf
+
+
+def build_matrix_block(client, sources, targets, cache: ResponseCache | None = None):
+    if cache is not None:
+        cached = cache.get("valhalla_matrix", [route_profile, route_options, len(sources)], sources + targets)
+        if cached is not None:
+            return Matrix(durations=cached["durations"], distances=cached["distances"])
+    try:
+        with metrics.stage("http"):
+            matrix = controller.run(
+                client.matrix,
+                locations=sources + targets,
+                profile=route_profile,
+                sources=list(range(len(sources))),
+                destinations=list(range(len(sources), len(sources) + len(targets))),
+                options=route_options,
+            )
+        if cache is not None and matrix:
+            cache.set(
+                "valhalla_matrix",
+                [route_profile, route_options, len(sources)],
+                sources + targets,
+                {"durations": matrix.durations, "distances": matrix.distances},
+            )
+        return matrix
+    except RouterApiError as e:
+        metrics.error("valhalla", e)
+        print(f"Router API error: {e}")
+        return None
+    except Exception as e:
+        metrics.error("valhalla", e)
+        print(f"Unexpected error: {e}")
+        return None
+
 
-    result_gdf = gpd.GeoDataFrame(
+def build_matrix(
+    gdf_start: gpd.GeoDataFrame,
+    start_field_name: str,
+    gdf_end: gpd.GeoDataFrame,
+    end_field_name: str,
+    concurrency: int = 1,
+    cache: ResponseCache | None = None,
+) -> pd.DataFrame:
+    """
+    Построение матрицы расстояний и времени в пути между точками без геометрии маршрутов
+
+    Args:
+        gdf_start: GeoDataFrame с точками начала маршрутов
+        start_field_name: Имя поля с идентификатором точек начала маршрутов
+        gdf_end: GeoDataFrame с точками конца маршрутов
+        end_field_name: Имя поля с идентификатором точек конца маршрутов
+        concurrency: Максимальное число одновременных запросов к Valhalla (1 - последовательное построение),
+            фактическое число ограничивает controller по ответам сервера
+        cache: Кэш ответов, позволяющий не запрашивать повторно уже построенные пары (None - без кэширования)
+
+    Returns:
+        DataFrame с полями from, to, distance, duration
+    """
+    gdf_start = gdf_start.copy().to_crs("EPSG:4326")
+    gdf_end = gdf_end.copy().to_crs("EPSG:4326")
+
+    start_coords = [[geom.x, geom.y] for geom in gdf_start.geometry]
+    end_coords = [[geom.x, geom.y] for geom in gdf_end.geometry]
+    start_ids = [row.get(start_field_name, None) for _, row in gdf_start.iterrows()]
+    end_ids = [row.get(end_field_name, None) for _, row in gdf_end.iterrows()]
+
+    # Разбиваем N x M на блоки, укладывающиеся в ограничения сервера на размер матрицы
+    blocks = [
+        (i, j)
+        for i in range(0, len(start_coords), MATRIX_MAX_SOURCES)
+        for j in range(0, len(end_coords), MATRIX_MAX_TARGETS)
+    ]
+
+    client = get_client()
+
+    def build_block(block):
+        i, j = block
+        sources = start_coords[i : i + MATRIX_MAX_SOURCES]
+        targets = end_coords[j : j + MATRIX_MAX_TARGETS]
+        return build_matrix_block(client, sources, targets, cache=cache)
+
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            matrices = list(tqdm(executor.map(build_block, blocks), total=len(blocks), desc="Building matrix"))
+    else:
+        matrices = [build_block(block) for block in tqdm(blocks, desc="Building matrix")]
+
+    distances = [[None] * len(end_coords) for _ in start_coords]
+    durations = [[None] * len(end_coords) for _ in start_coords]
+    for (i, j), matrix in zip(blocks, matrices):
+        if not matrix:
+            continue
+        for di, (row_distances, row_durations) in enumerate(zip(matrix.distances, matrix.durations)):
+            distances[i + di][j : j + len(row_distances)] = row_distances
+            durations[i + di][j : j + len(row_durations)] = row_durations
+
+    result_df = pd.DataFrame(
         {
-            "geometry": list_routes,
-            "from": list_from_ids,
-            "to": list_to_ids,
-            "distance": list_distances,
-        },
-        crs="EPSG:4326",
+            "from": [from_id for from_id in start_ids for _ in end_ids],
+            "to": [to_id for _ in start_ids for to_id in end_ids],
+            "distance": [value for row in distances for value in row],
+            "duration": [value for row in durations for value in row],
+        }
     )
 
-    return result_gdf
+    return result_df
 
 
-# Пример использования
-gdf_start = gpd.read_file("start_points.gpkg", use_arrow=True)
-gdf_end = gpd.read_file("end_points.gpkg", use_arrow=True)
-result = build_routes(gdf_start, "point_id", gdf_end, "point_id")
-result.to_file("routes.gpkg")
+if __name__ == "__main__":
+    # Пример использования
+    gdf_start = gpd.read_file("start_points.gpkg", use_arrow=True)
+    gdf_end = gpd.read_file("end_points.gpkg", use_arrow=True)
+    with ResponseCache("responses_cache.sqlite") as cache, StreamWriter("routes.gpkg") as writer:
+        build_routes(gdf_start, "point_id", gdf_end, "point_id", cache=cache, writer=writer)
+        print(f"Кэш: {cache.stats()}")
+        print(f"Контроллер запросов: {controller.stats()}")
+        for node in get_client().stats():
+            print(f"Сервер Valhalla: {node}")
+    metrics.to_json("routes_valhalla_metrics.json")
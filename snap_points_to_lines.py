@@ -1,37 +1,342 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
 import geopandas as gpd
-from shapely import get_point, shortest_line
+import numpy as np
+import pandas as pd
+from shapely import (
+    STRtree,
+    box,
+    distance,
+    from_wkb,
+    get_coordinates,
+    get_parts,
+    get_point,
+    get_type_id,
+    is_empty,
+    is_missing,
+    line_locate_point,
+    linestrings,
+    multilinestrings,
+    shortest_line,
+    to_wkb,
+)
+from tqdm import tqdm
+
+
+class LineSnapper:
+    """
+    Привязка точек к одной и той же линейной сети. Пространственный индекс STRtree и массивы геометрий
+    строятся один раз при создании объекта, поэтому многократная привязка разных наборов точек
+    (остановки, адреса, GPS-треки) не перестраивает индекс и не копирует слой линий.
+    """
+
+    def __init__(self, lines: gpd.GeoDataFrame):
+        """
+        Args:
+            lines: GeoDataFrame с линиями
+        """
+        self.lines = lines
+        self.geoms = np.asarray(lines.geometry.array, dtype=object)
+        self.tree = STRtree(self.geoms)
+
+    def query(self, geoms: np.ndarray, tolerance: float | None) -> tuple[np.ndarray, ...]:
+        """
+        Находит ближайшую линию и точку на ней для массива точек.
+
+        Args:
+            geoms: Массив геометрий точек
+            tolerance: Максимальное расстояние для прилипания (None - без ограничения)
+
+        Returns:
+            Кортеж массивов для привязанных точек: порядковый номер точки, порядковый номер линии,
+            расстояние привязки, точка на линии и доля длины линии до неё
+        """
+        (point_idx, line_pos), distances = self.tree.query_nearest(
+            geoms, max_distance=tolerance, return_distance=True, all_matches=True
+        )
+        # Если точка находится на одинаковом расстоянии от нескольких линий, оставляем линию с меньшим номером,
+        # чтобы результат не зависел от устройства индекса (в том числе при параллельной привязке по частям)
+        order = np.lexsort((line_pos, point_idx))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = point_idx[order][1:] != point_idx[order][:-1]
+        point_idx, line_pos, distances = point_idx[order][first], line_pos[order][first], distances[order][first]
+        # Определяем ближайшую точку на линии (даже если она не является вершиной линии)
+        sl = shortest_line(geoms[point_idx], self.geoms[line_pos])
+        nearest = get_point(sl, 1)
+        fraction = line_locate_point(self.geoms[line_pos], nearest, normalized=True)
+        return point_idx, line_pos, distances, nearest, fraction
+
+    def snap(self, points: gpd.GeoDataFrame, tolerance: float | None) -> gpd.GeoDataFrame:
+        """
+        Привязывает точки к ближайшим линиям в пределах заданного расстояния.
+
+        Args:
+            points: GeoDataFrame с точками
+            tolerance: Максимальное расстояние для прилипания (None - без ограничения)
+
+        Returns:
+            GeoDataFrame с привязанными точками и полями line_index (индекс линии), line_number (порядковый номер
+            линии в слое), snap_distance (расстояние привязки) и line_position (доля длины линии от её начала
+            до точки привязки).
+            Для точек без линии в пределах tolerance геометрия не меняется, а поля пустые
+        """
+        geoms = np.asarray(points.geometry.array, dtype=object)
+        return snap_result(points, self.lines.index, *self.query(geoms, tolerance))
+
+    def insert_vertices(self, snapped: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+        """
+        Возвращает слой линий с новыми вершинами в точках привязки.
 
+        Args:
+            snapped: Результат snap
 
-def snap_points_to_lines(points: gpd.GeoDataFrame, lines: gpd.GeoDataFrame, tolerance: float) -> gpd.GeoDataFrame:
+        Returns:
+            GeoDataFrame с линиями
+        """
+        # Используется порядковый номер линии: индекс слоя может содержать повторы
+        mask = snapped["line_number"].notna().to_numpy()
+        line_positions = snapped["line_number"][mask].to_numpy(dtype=np.int64)
+        nearest = np.asarray(snapped.geometry.array, dtype=object)[mask]
+        geometry = insert_line_vertices(self.geoms, line_positions, nearest)
+        return self.lines.set_geometry(gpd.GeoSeries(geometry, index=self.lines.index, crs=self.lines.crs))
+
+
+def snap_result(points: gpd.GeoDataFrame, line_labels, point_idx, line_pos, distances, nearest, fraction):
+    """Собирает результат привязки из массивов LineSnapper.query (см. LineSnapper.snap)."""
+    line_index = np.full(len(points), None, dtype=object)
+    line_index[point_idx] = np.asarray(line_labels, dtype=object)[line_pos]
+    line_number = pd.array(np.full(len(points), pd.NA), dtype="Int64")
+    line_number[point_idx] = line_pos
+    snap_distance = np.full(len(points), np.nan)
+    snap_distance[point_idx] = distances
+    line_position = np.full(len(points), np.nan)
+    line_position[point_idx] = fraction
+
+    geoms = np.asarray(points.geometry.array, dtype=object).copy()
+    geoms[point_idx] = nearest
+    snapped = points.assign(
+        line_index=line_index, line_number=line_number, snap_distance=snap_distance, line_position=line_position
+    )
+    snapped[points.geometry.name] = gpd.GeoSeries(geoms, index=points.index, crs=points.crs)
+    return snapped
+
+
+def snap_points_to_lines(
+    points: gpd.GeoDataFrame, lines: gpd.GeoDataFrame, tolerance: float, insert_vertices: bool = False
+) -> gpd.GeoDataFrame | tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]:
     """
     Привязывает точки к ближайшим линиям в пределах заданного расстояния.
     Аналогична функции Snap geometries to layer в QGIS с поведением Prefer closest point, insert extra vertices where required.
+    Для многократной привязки к одним и тем же линиям используйте LineSnapper.
 
     Args:
         points: GeoDataFrame с точками
         lines: GeoDataFrame с линиями
         tolerance: Максимальное расстояние для прилипания
+        insert_vertices: Также вернуть линии с новыми вершинами в местах привязки точек
 
     Returns:
-        GeoDataFrame с привязанными точками
+        GeoDataFrame с привязанными точками, при insert_vertices - кортеж из точек и линий с добавленными вершинами
     """
-    # Оставляем только геометрию из lines и записываем в отдельный столбец для использования после sjoin_nearest
-    lines = lines.assign(linegeom=lines.geometry)[["geometry", "linegeom"]]
+    snapper = LineSnapper(lines)
+    snapped_points = snapper.snap(points, tolerance)
+
+    if not insert_vertices:
+        # Удаляем все столбцы, созданные в процессе обработки
+        return snapped_points[points.columns]
+    return snapped_points[points.columns], snapper.insert_vertices(snapped_points)
+
+
+def insert_line_vertices(lines, line_positions: np.ndarray, snap_points: np.ndarray) -> np.ndarray:
+    """
+    Вставляет в линии вершины в точках привязки. Все операции векторизованы: точки группируются по частям линий,
+    сортируются по расстоянию вдоль части и координаты всех линий пересобираются одним вызовом shapely.
+
+    Args:
+        lines: Массив геометрий линий (LineString или MultiLineString)
+        line_positions: Порядковый номер линии для каждой точки привязки
+        snap_points: Массив точек привязки, лежащих на линиях
+
+    Returns:
+        Массив линий с добавленными вершинами
+    """
+    lines = np.asarray(lines, dtype=object)
+    if len(snap_points) == 0:
+        return lines.copy()
+    parts, part_line = get_parts(lines, return_index=True)
+
+    # Для каждой точки выбираем ближайшую часть её линии (для LineString часть одна)
+    parts_per_line = np.bincount(part_line, minlength=len(lines))
+    first_part = np.concatenate([[0], np.cumsum(parts_per_line)[:-1]])
+    pair_counts = parts_per_line[line_positions]
+    pair_snap = np.repeat(np.arange(len(snap_points)), pair_counts)
+    pair_offset = np.arange(len(pair_snap)) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+    pair_part = first_part[line_positions][pair_snap] + pair_offset
+    pair_distance = distance(parts[pair_part], snap_points[pair_snap])
+    order = np.lexsort((pair_distance, pair_snap))
+    first_pair = np.concatenate([[True], pair_snap[order][1:] != pair_snap[order][:-1]])
+    snap_part = pair_part[order][first_pair]
+    snap_pos = line_locate_point(parts[snap_part], snap_points)
+
+    # Положение существующих вершин вдоль своей части
+    coords, vertex_part = get_coordinates(parts, return_index=True)
+    segments = np.hypot(*np.diff(coords, axis=0).T)
+    segments[vertex_part[1:] != vertex_part[:-1]] = 0
+    cumulative = np.concatenate([[0], np.cumsum(segments)])
+    part_start = np.searchsorted(vertex_part, np.arange(len(parts)))
+    part_start = np.minimum(part_start, len(cumulative) - 1)
+    vertex_pos = cumulative - cumulative[part_start][vertex_part]
+
+    # Объединяем вершины и точки привязки и сортируем по части и расстоянию вдоль неё
+    all_part = np.concatenate([vertex_part, snap_part])
+    all_pos = np.concatenate([vertex_pos, snap_pos])
+    all_new = np.concatenate([np.zeros(len(vertex_part), dtype=bool), np.ones(len(snap_part), dtype=bool)])
+    all_coords = np.concatenate([coords, get_coordinates(snap_points)])
+    order = np.lexsort((all_new, all_pos, all_part))
+    all_part, all_new, all_coords = all_part[order], all_new[order], all_coords[order]
+
+    # Не добавляем вершину, совпадающую с соседней (точка привязана к существующей вершине или к той же точке)
+    same_as_prev = np.zeros(len(all_part), dtype=bool)
+    same_as_prev[1:] = (all_part[1:] == all_part[:-1]) & (all_coords[1:] == all_coords[:-1]).all(axis=1)
+    same_as_next = np.zeros(len(all_part), dtype=bool)
+    same_as_next[:-1] = same_as_prev[1:] & ~all_new[1:]
+    keep = ~(all_new & (same_as_prev | same_as_next))
+
+    new_parts = linestrings(all_coords[keep], indices=all_part[keep], out=parts.copy())
+    # Линии без частей (пустые геометрии) остаются без изменений
+    result = multilinestrings(new_parts, indices=part_line, out=lines.copy())
+    # Простые линии возвращаем как LineString
+    single = (get_type_id(lines) == 1) & (parts_per_line == 1)
+    result[single] = new_parts[first_part[single]]
+    return result
+
+
+# Линии, восстановленные в процессе-обработчике из общего буфера WKB
+_worker_lines: dict = {}
+
+
+def _init_worker(shm_name: str, offsets: np.ndarray):
+    """Читает линии из общей памяти один раз на процесс-обработчик."""
+    shm = SharedMemory(name=shm_name)
+    try:
+        buffer = shm.buf
+        # Пустой отрезок буфера соответствует отсутствующей геометрии
+        wkb = [bytes(buffer[start:end]) if end > start else None for start, end in zip(offsets[:-1], offsets[1:])]
+    finally:
+        del buffer
+        shm.close()
+    _worker_lines["geoms"] = from_wkb(np.array(wkb, dtype=object))
+    _worker_lines["snapper"] = None
+
+
+def _snap_chunk(points_wkb: np.ndarray, tolerance: float | None, line_subset: np.ndarray | None):
+    """Привязывает порцию точек в процессе-обработчике и возвращает массивы LineSnapper.query с WKB точек."""
+    geoms = _worker_lines["geoms"]
+    if line_subset is None:
+        # Индекс по всем линиям строится один раз на процесс
+        if _worker_lines["snapper"] is None:
+            _worker_lines["snapper"] = LineSnapper(gpd.GeoDataFrame(geometry=geoms))
+        snapper = _worker_lines["snapper"]
+    else:
+        snapper = LineSnapper(gpd.GeoDataFrame(geometry=geoms[line_subset]))
+    point_idx, line_pos, distances, nearest, fraction = snapper.query(from_wkb(points_wkb), tolerance)
+    if line_subset is not None:
+        line_pos = line_subset[line_pos]
+    return point_idx, line_pos, distances, to_wkb(nearest), fraction
+
+
+def snap_points_parallel(
+    points: gpd.GeoDataFrame,
+    lines: gpd.GeoDataFrame,
+    tolerance: float | None,
+    workers: int | None = None,
+    chunk_size: int = 100_000,
+    tile_size: float | None = None,
+) -> gpd.GeoDataFrame:
+    """
+    Привязка большого набора точек по частям в пуле процессов. Результат совпадает с LineSnapper(lines).snap.
+
+    Линии передаются процессам один раз через общую память в виде буфера WKB, а не копируются в каждую задачу.
+    Точки делятся на порции по числу строк или, если задан tile_size, по квадратным тайлам. В режиме тайлов
+    каждая задача строит индекс только по линиям, попадающим в тайл, расширенный на tolerance, - этого
+    достаточно, так как линия дальше tolerance от тайла не может быть ближайшей для его точек.
+
+    Args:
+        points: GeoDataFrame с точками
+        lines: GeoDataFrame с линиями
+        tolerance: Максимальное расстояние для прилипания (None - без ограничения, только без tile_size)
+        workers: Число процессов (None - по числу ядер)
+        chunk_size: Максимальное число точек в одной задаче
+        tile_size: Размер тайла в единицах системы координат (None - деление по числу строк)
+
+    Returns:
+        GeoDataFrame с привязанными точками и полями line_index, line_number, snap_distance и line_position
+    """
+    if tile_size is not None and tolerance is None:
+        raise ValueError("Для деления на тайлы требуется задать tolerance")
+
+    point_geoms = np.asarray(points.geometry.array, dtype=object)
+    line_geoms = np.asarray(lines.geometry.array, dtype=object)
+
+    # Порции точек: (порядковые номера точек, номера линий для привязки или None - все линии)
+    if tile_size is None:
+        chunks = [(np.arange(i, min(i + chunk_size, len(points))), None) for i in range(0, len(points), chunk_size)]
+    else:
+        coords = get_coordinates(point_geoms)
+        valid = ~(is_missing(point_geoms) | is_empty(point_geoms))
+        valid_idx = np.flatnonzero(valid)
+        cells = np.floor(coords / tile_size).astype(np.int64)
+        tile_ids, tile_of_point = np.unique(cells, axis=0, return_inverse=True)
+        tile_of_point = tile_of_point.ravel()
+        halo_boxes = box(
+            tile_ids[:, 0] * tile_size - tolerance,
+            tile_ids[:, 1] * tile_size - tolerance,
+            (tile_ids[:, 0] + 1) * tile_size + tolerance,
+            (tile_ids[:, 1] + 1) * tile_size + tolerance,
+        )
+        box_idx, line_idx = STRtree(line_geoms).query(halo_boxes)
+        line_order = np.argsort(box_idx, kind="stable")
+        line_splits = np.searchsorted(box_idx[line_order], np.arange(1, len(tile_ids)))
+        tile_lines = np.split(line_idx[line_order], line_splits)
 
-    # Для каждой точки находим ближайшую линию
-    snapped_points = gpd.sjoin_nearest(left_df=points, right_df=lines, how="left", max_distance=tolerance)
+        point_order = np.argsort(tile_of_point, kind="stable")
+        point_splits = np.searchsorted(tile_of_point[point_order], np.arange(1, len(tile_ids)))
+        chunks = []
+        for tile_points, subset in zip(np.split(valid_idx[point_order], point_splits), tile_lines):
+            for i in range(0, len(tile_points), chunk_size):
+                chunks.append((tile_points[i : i + chunk_size], np.sort(subset)))
 
-    # Удаляем дубликаты (точка находится на одинаковом расстоянии от нескольких линий)
-    snapped_points = snapped_points[~snapped_points.index.duplicated()]
+    # Общий буфер WKB линий и смещения каждой линии в нём
+    wkb = to_wkb(line_geoms)
+    offsets = np.concatenate([[0], np.cumsum([len(item) if item is not None else 0 for item in wkb])])
+    shm = SharedMemory(create=True, size=max(int(offsets[-1]), 1))
+    shm.buf[: offsets[-1]] = b"".join(item for item in wkb if item is not None)
 
-    # Определяем ближайшую точку на линии (даже если она не является вершиной линии)
-    mask = snapped_points["linegeom"].notna()
-    sl = shortest_line(snapped_points.loc[mask, "geometry"].array, snapped_points.loc[mask, "linegeom"].array)
-    nearest = get_point(sl, 1)
-    """ # Вариант только через geopandas
-    sl = snapped_points.loc[mask, "geometry"].shortest_line(snapped_points.loc[mask, "linegeom"])
-    nearest = sl.interpolate(1, normalized=True) """
-    snapped_points.loc[mask, "geometry"] = nearest
+    results = []
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(shm.name, offsets))
+    try:
+        # Число задач в работе ограничено, чтобы WKB всех порций точек не находились в памяти одновременно
+        window = (workers or os.cpu_count() or 1) * 2
+        pending = deque()
+        with tqdm(total=len(chunks), desc="Snapping points") as progress:
+            for chunk_idx, line_subset in chunks:
+                pending.append(
+                    (chunk_idx, executor.submit(_snap_chunk, to_wkb(point_geoms[chunk_idx]), tolerance, line_subset))
+                )
+                while len(pending) >= window or (pending and len(results) + len(pending) == len(chunks)):
+                    chunk_idx, future = pending.popleft()
+                    point_idx, line_pos, distances, nearest, fraction = future.result()
+                    results.append((chunk_idx[point_idx], line_pos, distances, from_wkb(nearest), fraction))
+                    progress.update()
+    finally:
+        executor.shutdown(cancel_futures=True)
+        shm.close()
+        shm.unlink()
 
-    # Удаляем все столбцы, созданные в процессе обработки
-    return snapped_points[points.columns]
+    if not results:
+        return snap_result(points, lines.index, *(np.array([], dtype=int) for _ in range(5)))
+    arrays = [np.concatenate(parts) for parts in zip(*results)]
+    return snap_result(points, lines.index, *arrays)
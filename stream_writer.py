@@ -0,0 +1,199 @@
+import json
+import os
+
+import geopandas as gpd
+from shapely import get_type_id, to_wkb
+
+# Имена типов геометрии GeoParquet по shapely.get_type_id
+GEOMETRY_TYPES = ["Point", "LineString", None, "Polygon", "MultiPoint", "MultiLineString", "MultiPolygon"]
+
+
+class StreamWriter:
+    """
+    Потоковая запись результатов долгих расчётов (маршруты, изохроны) порциями фиксированного размера.
+    Результаты дописываются в GPKG или в набор файлов GeoParquet, а ключи обработанных объектов
+    сохраняются в файл контрольной точки, чтобы перезапущенный расчёт пропускал уже выполненную работу.
+
+    Формат выбирается по расширению: путь, оканчивающийся на .parquet, считается каталогом с частями GeoParquet,
+    иначе результат дописывается в слой GPKG.
+
+    Части GeoParquet собираются напрямую в типизированные таблицы Arrow: списки остаются списками Arrow,
+    геометрия хранится в WKB. Типы столбцов определяются по значениям; если в новой части тип столбца шире
+    записанного ранее (целые и дробные числа, пустой столбец и списки), записанные части перезаписываются
+    с общим типом, чтобы все части читались как один набор данных без потери значений.
+    При записи в GPKG списки преобразуются в JSON.
+    """
+
+    def __init__(self, path: str, chunk_size: int = 1000, crs: str = "EPSG:4326"):
+        """
+        Args:
+            path: Путь к выходному файлу (GPKG) или каталогу (GeoParquet)
+            chunk_size: Число строк, накапливаемых в памяти перед записью
+            crs: Система координат результата
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self.crs = crs
+        self.checkpoint_path = f"{path}.checkpoint"
+        self.parquet = path.endswith(".parquet")
+        self.written = 0
+
+        self._rows: list[dict] = []
+        self._keys: list[str] = []
+        self._schema = None
+        self._done: set[str] = set()
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, encoding="utf-8") as f:
+                self._done = {line.rstrip("\n") for line in f if line.strip()}
+
+    @staticmethod
+    def _key(key) -> str:
+        return json.dumps(key, ensure_ascii=False, default=str)
+
+    def is_done(self, key) -> bool:
+        """Проверяет, был ли объект с данным ключом записан при этом или предыдущем запуске."""
+        return self._key(key) in self._done
+
+    def write(self, key, rows: list[dict]):
+        """
+        Добавляет строки результата для одного ключа. Строки одного ключа всегда попадают в одну порцию,
+        поэтому после перезапуска объект не окажется записанным частично.
+        """
+        self._rows.extend(rows)
+        self._keys.append(self._key(key))
+        if len(self._rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Записывает накопленные строки и отмечает их ключи в контрольной точке."""
+        if not self._keys:
+            return
+        if self._rows:
+            if self.parquet:
+                self._write_parquet(self._rows)
+            else:
+                rows = [{k: json.dumps(v) if isinstance(v, list) else v for k, v in row.items()} for row in self._rows]
+                gdf = gpd.GeoDataFrame(rows, geometry="geometry", crs=self.crs)
+                gdf.to_file(self.path, driver="GPKG", mode="a" if os.path.exists(self.path) else "w")
+        # Контрольная точка обновляется только после записи данных: при сбое между этими шагами
+        # порция не потеряется, но после перезапуска будет записана повторно (см. read)
+        with open(self.checkpoint_path, "a", encoding="utf-8") as f:
+            f.writelines(f"{key}\n" for key in self._keys)
+        self._done.update(self._keys)
+        self.written += len(self._rows)
+        self._rows = []
+        self._keys = []
+
+    def _parts(self) -> list[str]:
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith(".parquet"))
+
+    @staticmethod
+    def _column(name: str, values: list):
+        import pyarrow as pa
+
+        try:
+            return pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            raise ValueError(f"Значения столбца {name} имеют несовместимые типы") from e
+
+    def _unify_schema(self, schema):
+        """Общая схема записанных частей и новой части, типы расширяются без потери значений."""
+        import pyarrow as pa
+
+        if self._schema is None:
+            return schema
+        try:
+            return pa.unify_schemas([self._schema, schema], promote_options="permissive")
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            raise ValueError(f"Типы столбцов не совпадают с записанными ранее: {e}") from e
+
+    @staticmethod
+    def _cast(table, schema):
+        """Приводит таблицу к типам столбцов schema, метаданные таблицы сохраняются."""
+        import pyarrow as pa
+
+        fields = [
+            schema.field(name) if name in schema.names else table.schema.field(name) for name in table.column_names
+        ]
+        return table.cast(pa.schema(fields, metadata=table.schema.metadata))
+
+    def _rewrite_parts(self, parts: list[str], schema):
+        """Перезаписывает ранее записанные части с расширенными типами столбцов."""
+        import pyarrow.parquet as pq
+
+        for part in parts:
+            # Часть заменяется целиком только после успешной записи временного файла
+            pq.write_table(self._cast(pq.read_table(part), schema), f"{part}.tmp")
+            os.replace(f"{part}.tmp", part)
+
+    def _write_parquet(self, rows: list[dict]):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        from pyproj import CRS
+
+        parts = self._parts()
+        if self._schema is None and parts:
+            self._schema = pa.unify_schemas([pq.read_schema(part) for part in parts], promote_options="permissive")
+
+        names = [name for name in rows[0] if name != "geometry"]
+        columns = {name: self._column(name, [row.get(name) for row in rows]) for name in names}
+        geometries = [row.get("geometry") for row in rows]
+        columns["geometry"] = pa.array(to_wkb(geometries).tolist(), type=pa.binary())
+
+        geometry_types = sorted(
+            {GEOMETRY_TYPES[type_id] for type_id in get_type_id(geometries).tolist() if 0 <= type_id < 7}
+            - {None}
+        )
+        geo = {
+            "version": "1.0.0",
+            "primary_column": "geometry",
+            "columns": {
+                "geometry": {
+                    "encoding": "WKB",
+                    "geometry_types": geometry_types,
+                    "crs": CRS(self.crs).to_json_dict(),
+                }
+            },
+        }
+        table = pa.table(columns)
+        schema = self._unify_schema(table.schema)
+        if self._schema is not None:
+            widened = [name for name in self._schema.names if schema.field(name).type != self._schema.field(name).type]
+            if widened:
+                self._rewrite_parts(parts, schema)
+        self._schema = schema
+        table = self._cast(table, schema).replace_schema_metadata({"geo": json.dumps(geo)})
+
+        os.makedirs(self.path, exist_ok=True)
+        pq.write_table(table, os.path.join(self.path, f"part-{len(parts):06d}.parquet"))
+
+    def read(self) -> gpd.GeoDataFrame:
+        """
+        Читает всё записанное в выходной файл.
+        Если процесс прервался между записью порции и обновлением контрольной точки, строки этой порции
+        встречаются в файле дважды, поэтому при чтении их следует удалять по ключевым полям (например, from и to).
+        """
+        if self.parquet:
+            return gpd.read_parquet(self.path)
+        return gpd.read_file(self.path, use_arrow=True)
+
+    def read_column(self, name: str) -> list:
+        """Читает один атрибут из записанного файла без геометрии (пустой список, если файла ещё нет)."""
+        if not os.path.exists(self.path):
+            return []
+        if self.parquet:
+            import pyarrow.parquet as pq
+
+            return pq.read_table(self.path, columns=[name]).column(name).to_pylist()
+        return gpd.read_file(self.path, columns=[name], ignore_geometry=True, use_arrow=True)[name].tolist()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,185 @@
+import threading
+import time
+
+import requests
+from routingpy import Valhalla
+from routingpy.exceptions import RouterServerError, Timeout
+
+from rate_controller import ServiceUnavailable, raise_unavailable
+
+# Число подряд неудачных запросов, после которого узел исключается из балансировки
+MAX_FAILURES = 3
+# Время, на которое исключается узел, если проверка состояния не вернула его раньше, с
+EVICTION_TIME = 60
+# Интервал проверки состояния узлов (GET /status), с
+HEALTH_INTERVAL = 30
+HEALTH_TIMEOUT = 5
+
+
+class ValhallaNode:
+    """Один сервер Valhalla в пуле и его статистика."""
+
+    def __init__(self, base_url: str, client: Valhalla):
+        self.base_url = base_url
+        self.client = client
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.seconds = 0.0
+        self.evicted_until = 0.0
+
+    def is_available(self, now: float) -> bool:
+        return now >= self.evicted_until
+
+
+class ValhallaPool:
+    """
+    Клиент Valhalla, распределяющий запросы между несколькими серверами.
+    Поддерживает те же методы directions, isochrones и matrix, что и routingpy.Valhalla, поэтому подставляется
+    вместо клиента в route_by_valhalla.py и isochrone_by_valhalla.py.
+
+    Запрос отправляется на доступный узел с наименьшим числом запросов в работе. Сетевая ошибка, таймаут
+    или ответ 5xx считаются отказом узла: запрос повторяется на другом узле, а узел после MAX_FAILURES отказов
+    подряд исключается на EVICTION_TIME секунд. Фоновая проверка GET /status исключает неотвечающие узлы
+    и возвращает восстановившиеся. Ошибки запроса (4xx, в том числе 429) пробрасываются без повтора -
+    превышение лимита обрабатывает RateController. Клиентам узлов добавляется обработчик raise_unavailable,
+    чтобы 503 не повторялся внутри routingpy до истечения retry_timeout и запрос сразу уходил на другой узел.
+    """
+
+    def __init__(self, base_urls: list[str], health_interval: float | None = HEALTH_INTERVAL, **client_kwargs):
+        """
+        Args:
+            base_urls: Адреса серверов Valhalla
+            health_interval: Интервал проверки состояния узлов в секундах (None - без фоновой проверки)
+            client_kwargs: Параметры routingpy.Valhalla, общие для всех узлов (timeout, retry_timeout и т.п.)
+        """
+        if not base_urls:
+            raise ValueError("Не задан ни один сервер Valhalla")
+        hooks = dict(client_kwargs.pop("hooks", None) or {})
+        response_hooks = hooks.get("response", [])
+        response_hooks = [response_hooks] if callable(response_hooks) else list(response_hooks)
+        if raise_unavailable not in response_hooks:
+            response_hooks.append(raise_unavailable)
+        hooks["response"] = response_hooks
+        self.nodes = [ValhallaNode(url, Valhalla(base_url=url, hooks=hooks, **client_kwargs)) for url in base_urls]
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._health_thread = None
+        if health_interval is not None:
+            self._health_thread = threading.Thread(target=self._health_loop, args=(health_interval,), daemon=True)
+            self._health_thread.start()
+
+    def directions(self, **kwargs):
+        return self._call("directions", **kwargs)
+
+    def isochrones(self, **kwargs):
+        return self._call("isochrones", **kwargs)
+
+    def matrix(self, **kwargs):
+        return self._call("matrix", **kwargs)
+
+    def _acquire(self, exclude: set) -> ValhallaNode | None:
+        """Выбирает доступный узел с наименьшим числом запросов в работе (при отсутствии - любой не из exclude)."""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [node for node in self.nodes if node not in exclude]
+            available = [node for node in candidates if node.is_available(now)]
+            # Если все узлы исключены, запрос всё равно отправляется, чтобы задача не останавливалась
+            node = min(available or candidates, key=lambda n: n.outstanding, default=None)
+            if node is not None:
+                node.outstanding += 1
+            return node
+
+    def _release(self, node: ValhallaNode, seconds: float, failed: bool):
+        with self._lock:
+            node.outstanding -= 1
+            node.requests += 1
+            node.seconds += seconds
+            if failed:
+                node.failures += 1
+                node.consecutive_failures += 1
+                if node.consecutive_failures >= MAX_FAILURES:
+                    node.evicted_until = time.monotonic() + EVICTION_TIME
+                    print(f"Сервер {node.base_url} исключён из пула на {EVICTION_TIME} с")
+            else:
+                node.consecutive_failures = 0
+
+    def _call(self, method: str, **kwargs):
+        """Выполняет запрос на выбранном узле, при отказе узла повторяет его на другом."""
+        tried = set()
+        while True:
+            node = self._acquire(tried)
+            start_time = time.perf_counter()
+            try:
+                result = getattr(node.client, method)(**kwargs)
+            except (RouterServerError, ServiceUnavailable, Timeout, requests.ConnectionError) as e:
+                self._release(node, time.perf_counter() - start_time, failed=True)
+                tried.add(node)
+                if len(tried) == len(self.nodes):
+                    raise
+                print(f"Сервер {node.base_url} не ответил ({type(e).__name__}), запрос передан другому серверу")
+                continue
+            except Exception:
+                # Ошибка запроса, а не сервера: повтор на другом узле не поможет
+                self._release(node, time.perf_counter() - start_time, failed=False)
+                raise
+            self._release(node, time.perf_counter() - start_time, failed=False)
+            return result
+
+    def check_health(self):
+        """Проверяет состояние всех узлов: неотвечающие исключаются, восстановившиеся возвращаются в пул."""
+        for node in self.nodes:
+            try:
+                healthy = requests.get(f"{node.base_url}/status", timeout=HEALTH_TIMEOUT).ok
+            except requests.RequestException:
+                healthy = False
+            with self._lock:
+                if healthy:
+                    node.evicted_until = 0.0
+                    node.consecutive_failures = 0
+                elif node.is_available(time.monotonic()):
+                    node.evicted_until = time.monotonic() + EVICTION_TIME
+                    print(f"Сервер {node.base_url} не прошёл проверку состояния и исключён из пула")
+
+    def _health_loop(self, interval: float):
+        while not self._stop.wait(interval):
+            self.check_health()
+
+    def stats(self) -> list[dict]:
+        """Статистика по узлам: запросы, отказы, средняя задержка и пропускная способность (запросов в секунду)."""
+        with self._lock:
+            now = time.monotonic()
+            elapsed = max(now - self.started, 1e-9)
+            return [
+                {
+                    "base_url": node.base_url,
+                    "available": node.is_available(now),
+                    "outstanding": node.outstanding,
+                    "requests": node.requests,
+                    "failures": node.failures,
+                    "mean_latency": node.seconds / node.requests if node.requests else None,
+                    "throughput": node.requests / elapsed,
+                }
+                for node in self.nodes
+            ]
+
+    def close(self):
+        self._stop.set()
+        if self._health_thread is not None:
+            self._health_thread.join()
+
+
+# Пулы по спискам серверов, общие для всех скриптов процесса
+_pools: dict[tuple, ValhallaPool] = {}
+_pools_lock = threading.Lock()
+
+
+def shared_pool(base_urls: list[str], **kwargs) -> ValhallaPool:
+    """Возвращает общий пул для серверов base_urls, при первом обращении создаёт его с параметрами kwargs."""
+    with _pools_lock:
+        key = tuple(base_urls)
+        if key not in _pools:
+            _pools[key] = ValhallaPool(base_urls, **kwargs)
+        return _pools[key]